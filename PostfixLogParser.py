@@ -11,6 +11,8 @@
 # ●依存
 # Elasticsearchを使用する場合は下記のインストールが必要
 # 　pip install elasticsearch
+# 遅延時間のパーセンタイル(--latency-report)を使用する場合は下記のインストールが必要
+# 　pip install numpy
 # 更に国名を使用する場合は下記のインストールとデータベースへのパスを設定する必要がある。
 # 　pip install geoip2
 # 　GeoLite2-City.mmdbは下記のURLからダウンロードしてカレントディレクトリに配置してください。
@@ -21,31 +23,111 @@
 #  --inputs=/var/log/maillog*.gz --outputdir=export --compressed=Y --year=2017 --export-type=TSV
 #
 #  inputs      : 解析対象とするログファイルを指定してください
+#  listen      : ログファイルの代わりにsyslogをUDP/TCPで受信して解析します。(例: udp://0.0.0.0:514,tcp://0.0.0.0:514)
+#                解析結果は出力先ディレクトリの「syslog.txt」に保存されます。
 #  outputdir   : 指定したディレクトリに、解析結果が元ファイルの名称に「.txt」付与されて保存されます。
 #                ディレクトリは予め作成しておいてください。
 #  year        : ログには年号が記録されていないため年号(西暦)を数字で入れてください
+#                12月から1月に戻った場合は自動的に年を繰り上げます。
+#                RFC 3339(2017-03-01T12:34:56.123456+09:00)形式の日付は年を含むため指定は不要です。
+#                RFC 3339形式の日付にタイムゾーンが記録されている場合は、実行する環境に依存しないよう
+#                UTCに変換し、タイムゾーンを付けずに出力します。
 #  compressed  : ファイルが圧縮(gzip)されている場合に指定してください。
-#  export-type : TSV or JSON or ORIG or ELS or ELSwG
+#  export-type : TSV or JSON or ORIG or RCPT or ELS or ELSwG
 #                TSVはカラムの区切りをTabで出力します。
 #                JSONは行ごとにJSON形式で出力されます。
+#                RCPTは宛先ごとの配送の試行を1行としてTabで区切って出力します。
+#                送信者やキューIDなどメッセージ単位のカラムは同じメッセージの行で同じ値になります。
 #                ORIGはgrepし易いような形式で出力します。
 #                ELSはElasticsearchへ直接出力します。
 #                ELSwGはElasticsearchへ直接出力し国名を付与します。
+#  mmap        : 非圧縮ファイルをメモリマップして解析します。postfix以外の行が半数を超えるログで効果があり、
+#                postfixの行のみのログでは通常の解析より遅くなります。(benchmarks/bench_mmap.py)
+#  line-profile: 行形式のプロファイルを指定します。(default, long_queue_id)
+#  syslog-names: マルチインスタンスの場合などに syslog_name をカンマ区切りで指定します。(例: postfix,postfix-out)
+#  queue-id-style : キューIDの形式を指定します。short(16進数), long(enable_long_queue_ids), both
+#  latency-report : 中継先ホスト・宛先ドメイン・時間枠(latency-window秒)ごとに、配送の試行ごとの遅延時間のp50/p95/p99を
+#                タブ区切りで出力します。latency-stateを指定するとスケッチを保存し、次回以降の
+#                実行やlatency-mergeで指定した他の結果と結合します。(numpyが必要)
+#  stats-only  : レコードを出力せず、メッセージ数、宛先数、バイト数、配送結果ごとの件数のみを表示します。
+#  batch-size  : 出力先にまとめて書き込むレコードの件数です。(既定: 1000)
+#                1を指定すると1件ずつ書き込みます。
+#  partition   : 出力先のディレクトリに「{日付}/{ホスト名}.{拡張子}」の形式で振り分けて出力します。
+#                先頭から解析し直したファイルのレコードを取り除けないため、manifestとは併用できません。
+#  manifest    : 処理済みファイルを記録するマニフェストファイルを指定します。
+#                変更されていないファイルは省略し、追記されたファイルは前回の続きから解析して
+#                出力に追記します。ローテートで名前が変わったファイルの出力は新しい名前に移動します。
+#                前回の終わりで解析途中だったログを続きとして解析するにはpending-storeを併用してください。
+#                改行で終わっていない最後の行は書き込み途中とみなし、次回の実行で解析します。
+#  carryover   : ローテートされた複数のファイルを更新日時の古い順に1つのパーサーで解析します。
+#                ファイルをまたがるログは1件にまとめられ、解析が終わっていないログは
+#                最後に解析したファイルの出力にのみ書き込まれます。
+#  workers     : 1つの入力をキューIDで振り分け、指定した数のプロセスで解析します。
+#                圧縮ファイルのように分割できない入力で効果があります。(mmap, carryover, stats-onlyとは併用できません)
+#                ファイルに出力する場合(TSV, JSON, ORIG, RCPT)は、ワーカーで出力する文字列に変換します。
+#  profile     : 指定した接頭辞で cProfile の結果(.stats)、工程別の時間と入力サイズ(.json)を保存します。
+#                profile-mode=sample の場合は cProfile の代わりにフレームグラフ用のスタック(.folded)を保存します。
+#  events      : キューIDを持たないsmtpdのイベント(connect, disconnect, NOQUEUE: reject)を1行1JSONで出力します。
+#  event-summary : クライアントのIPアドレスごとの接続数、拒否数、拒否の頻度をタブ区切りで出力します。
+#                集計するIPアドレスはevent-clientsの数までに制限されます。
+#  merge       : 複数のホストのログを時刻順に並べて1つのパーサーで解析し、出力先の「merged.txt」に保存します。
+#                時計のずれなどで時刻が戻った行はmerge-skew秒まで警告せずに許容します。
+#  cache-dir   : 解析済みのレコードを入力ファイルの指紋ごとに指定したディレクトリへ保存します。
+#                同じファイルを再度出力する場合は、解析せずに保存したレコードを出力します。
+#  pending-store : 解析が終わっていないログを指定したファイル(sqlite)に保存し、次のファイルや次回の実行で
+#                続きの行が現れた場合に1件のログとして出力します。pending-expire日以上更新されないログは
+#                解析が終わっていないまま出力します。メモリ上にはpending-memory件までのみ保持します。
+#  correlate   : message_idや中継先のキューIDでホストをまたがるログを結合し、
+#                経路ごとに1行1JSONで指定したファイルへ出力します。
+#
+# ●ライブラリとして使用する場合
+#  stream_records()は解析が完了したメールログを読み取り専用のRecordViewとして順に返します。
+#   for v in stream_records("/var/log/maillog", year=2017).filter(lambda v: v.complete):
+#       print(v.queue_id, v.duration, v.smtp_message)
 import re
 import argparse
+import asyncio
 import datetime
 import glob
 import os
 import logging
 import json
+import collections
+import hashlib
+import math
+import pickle
+import time
+from sys import intern
+from itertools import islice
+from operator import itemgetter
 from abc import ABCMeta, abstractmethod
 
 # LOGGING LEVEL
 LOGGING_LEVEL = logging.INFO
 # Using cProfile.
 PROFILE_FLAG = False
+# Sampling interval of --profile-mode=sample (seconds)
+PROFILE_SAMPLE_INTERVAL = 0.005
 # Buffer
 WRITE_BUFFER = 1000000
+# Number of records passed to MaillogWriter.insert_many at once
+WRITE_BATCH_SIZE = 1000
+# Maximum number of files opened by the partitioned writer
+PARTITION_MAX_HANDLES = 64
+# Bytes read and sent to the pipeline workers at once
+PIPELINE_BLOCK_SIZE = 262144
+# Number of blocks queued per pipeline worker (results are bounded to this times the workers)
+PIPELINE_QUEUE_DEPTH = 8
+# Seconds the pipeline reader waits for results while a worker queue is full
+PIPELINE_POLL_INTERVAL = 0.05
+# Number of unfinished entries kept in memory when --pending-store is used
+PENDING_MAX_MEMORY = 100000
+# Number of new queue entries between spills to the pending store
+PENDING_SPILL_INTERVAL = 10000
+# Backward clock steps (seconds) tolerated silently by --merge
+MERGE_MAX_SKEW = 5
+# Maximum number of client IPs kept by the smtpd event summary
+EVENT_MAX_CLIENTS = 100000
 # GEOIP2 city database
 GEOIP2_CITY_DATABASE="GeoLite2-City.mmdb"
 
@@ -68,13 +150,169 @@ class MaillogParser:
     """
     メールログをパースするクラスです。
     """
-    re_date = r'(?P<month>[A-Z][a-z][a-z])  ?(?P<day>\d+) (?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})'
+    re_date = r'(?P<date>(?P<month>[A-Z][a-z][a-z])  ?(?P<day>\d+) (?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})' \
+              r'|(?P<isodate>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?))'
     re_host = r'(?P<host>[^ ]*)'
-    re_proc = r'(?P<proc>\w+)'
-    re_qid = r'(?P<queue_id>[0-9A-F]+)'
     re_msg = r'(?P<message>.*)'
-    re_line = r'^%s %s postfix/%s\[\d+\]: %s:\s*%s' % (re_date, re_host, re_proc, re_qid, re_msg)
+    # キューIDの形式
+    #  short : 16進数(既定)
+    #  long  : enable_long_queue_ids = yes の場合(母音を除いた英数字)
+    re_qid_styles = {
+        "short": r'[0-9A-F]+',
+        "long": r'[0-9B-DF-HJ-NP-TV-Zb-df-hj-np-tv-z]{10,}',
+        "both": r'[0-9B-DF-HJ-NP-TV-Zb-df-hj-np-tv-z]{10,}|[0-9A-F]+',
+    }
+    # 行形式のプロファイル
+    #  syslog_names : syslog_name のリスト(マルチインスタンスの場合は postfix-out など)
+    #  queue_id     : re_qid_styles のキー
+    line_profiles = {
+        "default": {"syslog_names": ["postfix"], "queue_id": "short"},
+        "long_queue_id": {"syslog_names": ["postfix"], "queue_id": "long"},
+    }
+    # コンパイル済みのプロファイル
+    _line_patterns = {}
+    # キューIDを持たないsmtpdのイベント(接続、切断、キュー投入前の拒否)
+    re_event = r'(?P<event>connect from|disconnect from|NOQUEUE: reject:) (?P<message>.*)'
+    _event_names = {"connect from": "connect", "disconnect from": "disconnect", "NOQUEUE: reject:": "reject"}
+    _event_patterns = {}
+    # 配送エージェント(配送結果 status= を出力するプロセス)
+    delivery_agents = ("smtp", "local", "lmtp", "pipe", "virtual", "error", "retry", "discard")
+    # 宛先ごとの配送の試行(rcpt)の列
+    #  date は配送行を解析した時点のメールログの最終時刻、delays は4つの値のタプル
+    rcpt_fields = ("date", "to", "orig_to", "relay_host", "relay_ip", "relay_port",
+                   "delay", "delays", "dsn", "status", "smtp_message")
+    _rcpt_index = {name: i for i, name in enumerate(rcpt_fields)}
+    # プロセス名とハンドラの対応表 (文字列の場合は同名のメソッド)
+    # lmtp, pipe, virtual, error, retry, discard の配送結果はsmtpと同じ形式で記録される
+    service_handlers = {
+        "smtpd": "_parse_smtpd_line",
+        "cleanup": "_parse_cleanup_line",
+        "qmgr": "_parse_qmgr_line",
+        "smtp": "_parse_smtp_line",
+        "local": "_parse_local_line",
+        "lmtp": "_parse_smtp_line",
+        "pipe": "_parse_smtp_line",
+        "virtual": "_parse_smtp_line",
+        "error": "_parse_smtp_line",
+        "retry": "_parse_smtp_line",
+        "discard": "_parse_smtp_line",
+        "bounce": "_parse_bounce_line",
+    }
     _month = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    _month_index = {m: i + 1 for i, m in enumerate(_month)}
+    # メモリマップで解析する場合はbytesのまま参照する
+    _month_index.update({m.encode(): i for m, i in _month_index.items()})
+
+    @classmethod
+    def register_line_profile(cls, name, syslog_names=None, queue_id="short"):
+        """
+        行形式のプロファイルを登録します。
+        :param name:            プロファイル名
+        :param syslog_names:    syslog_name のリスト (例: ["postfix", "postfix-out", "postfix/submission"])
+        :param queue_id:        キューIDの形式 (short, long, both)
+        :return: なし
+        """
+        if queue_id not in cls.re_qid_styles:
+            raise ValueError("キューIDの形式が正しくありません。{0}".format(queue_id))
+        if not syslog_names:
+            syslog_names = ["postfix"]
+        cls.line_profiles[name] = {"syslog_names": list(syslog_names), "queue_id": queue_id}
+        cls._line_patterns.pop((name, False), None)
+        cls._line_patterns.pop((name, True), None)
+        cls._event_patterns.pop(name, None)
+
+    @classmethod
+    def line_pattern(cls, name="default", binary=False):
+        """
+        プロファイルから行の正規表現を生成します。生成した正規表現は
+        プロファイルごとに1度だけコンパイルされます。
+        master.cfで -o syslog_name=postfix/submission のように指定している場合は
+        syslog_names に postfix/submission を含めてください。
+        binaryを指定した場合は、メモリマップしたファイルの行の範囲に対して
+        match(buffer, pos, endpos)で使用するbytes用の正規表現を返します。
+        :param name:    プロファイル名
+        :param binary:  bytes用の正規表現を返す場合はTrue
+        :return:        コンパイル済みの正規表現
+        """
+        pat = cls._line_patterns.get((name, binary))
+        if pat is not None:
+            return pat
+
+        try:
+            profile = cls.line_profiles[name]
+        except KeyError:
+            raise ValueError("行形式のプロファイルが登録されていません。{0}".format(name))
+
+        names = [re.escape(n) for n in profile["syslog_names"]]
+        if len(names) == 1:
+            syslog_name = names[0]
+        else:
+            syslog_name = r'(?:%s)' % '|'.join(names)
+        qid = r'(?P<queue_id>%s)' % cls.re_qid_styles[profile["queue_id"]]
+        if binary:
+            line = r'%s %s %s/(?P<proc>[\w-]+)\[\d+\]: %s:\s*%s' % (
+                cls.re_date, cls.re_host, syslog_name, qid, cls.re_msg)
+            pat = re.compile(line.encode())
+        else:
+            line = r'^%s %s %s/(?P<proc>[\w-]+)\[\d+\]: %s:\s*%s' % (
+                cls.re_date, cls.re_host, syslog_name, qid, cls.re_msg)
+            pat = re.compile(line)
+
+        cls._line_patterns[(name, binary)] = pat
+        return pat
+
+    @classmethod
+    def event_pattern(cls, name="default"):
+        """
+        プロファイルからsmtpdのイベント(connect from, disconnect from, NOQUEUE: reject:)の
+        行の正規表現を生成します。
+        :param name:    プロファイル名
+        :return:        コンパイル済みの正規表現
+        """
+        pat = cls._event_patterns.get(name)
+        if pat is not None:
+            return pat
+
+        try:
+            profile = cls.line_profiles[name]
+        except KeyError:
+            raise ValueError("行形式のプロファイルが登録されていません。{0}".format(name))
+
+        names = [re.escape(n) for n in profile["syslog_names"]]
+        syslog_name = r'(?:%s)' % '|'.join(names)
+        pat = re.compile(r'^%s %s %s/(?P<proc>[\w-]+)\[\d+\]: %s' % (
+            cls.re_date, cls.re_host, syslog_name, cls.re_event))
+
+        cls._event_patterns[name] = pat
+        return pat
+
+    def register_handler(self, proc, handler):
+        """
+        このパーサーにプロセスのハンドラを登録します。既に登録されている場合は置き換えます。
+        ハンドラは handler(ml, store) の形式で呼び出され、storeには「, 」で分割した
+        メッセージが1つずつ渡されます。メールログの解析が完了した場合はTrueを返してください。
+        Trueを返すとparse_endがTrueになり、完了した件数に数えられます。
+        クラスの対応表(service_handlers)は変更しないため、他のパーサーには影響しません。
+        :param proc:    プロセス名 (例: smtp, lmtp, pipe)
+        :param handler: 呼び出し可能なオブジェクトか、MaillogParserのメソッド名
+        :return: なし
+        """
+        handlers = dict(self.service_handlers)
+        handlers[proc] = handler
+        self.service_handlers = handlers
+
+    def _resolve_handlers(self):
+        """
+        service_handlersからプロセス名とハンドラ(呼び出し可能なオブジェクト)の
+        ディクショナリを作成します。
+        :return: プロセス名とハンドラのディクショナリ
+        """
+        handlers = {}
+        for proc, handler in self.service_handlers.items():
+            if isinstance(handler, str):
+                handler = getattr(self, handler)
+            handlers[proc] = handler
+        return handlers
 
     def __init__(self, fn, year=None):
         """
@@ -85,6 +323,11 @@ class MaillogParser:
         """
         self._filepath = fn
         self._file_object = None
+        self._mmap = None
+        self._use_mmap = False
+        # 解析を開始する位置と解析を終えた位置(バイト)
+        self._start_offset = 0
+        self._end_offset = None
         self._parse_starttime = None
         # メールログ格納要
         self._imlogs = {}
@@ -97,6 +340,24 @@ class MaillogParser:
         # 解析が終了したレコードの件数
         self._cnt_parse_end = 0
         self._pop_parsed_line = False  # popしないほうが早い
+        # 日付解析のキャッシュ(直前の日付文字列と結果、年の繰り上げ判定用の月)
+        self._last_date_key = None
+        self._last_date = None
+        self._last_month = None
+        # parse_dated_linesで付与された、解析中の行の時刻
+        self._line_date = None
+        # RFC 3339形式のタイムゾーンの文字列とUTCとの差
+        self._utcoffsets = {}
+        # 行形式のプロファイル
+        self._line_profile = "default"
+        # smtpdのイベントの出力先
+        self._event_sink = None
+        # 解析途中のメールログの保存先
+        self._pending_store = None
+        # 宛先ごとの配送の試行(rcpt)を記録するか
+        self._collect_recipients = False
+        # 工程別の時間の計測(ParseProfiler)
+        self._profiler = None
 
     @property
     def pop_parsed_line(self):
@@ -122,7 +383,7 @@ class MaillogParser:
     def parsed_count(self):
         """
         解析済みメールログの行数を返します。qmgrプロセスがメールを
-        removedした段階でカウントアップされます。
+        removedした段階(ハンドラがTrueを返した段階)でカウントアップされます。
         :return: 解析済みメールログの行数
         """
         return self._cnt_parse_end
@@ -144,6 +405,161 @@ class MaillogParser:
         self._year = value
         if self._year is None:
             self._year = datetime.date.today().year
+        self._last_date_key = None
+        self._last_month = None
+
+    @property
+    def use_mmap(self):
+        """
+        非圧縮ファイルをメモリマップして解析するか
+        TrueかFalseの値を返します。
+        :return:
+        """
+        return self._use_mmap
+
+    @use_mmap.setter
+    def use_mmap(self, value):
+        """
+        非圧縮ファイルをメモリマップして解析するか指定します。
+        圧縮ファイルの場合は指定しても通常の読み込みを行います。
+        postfix以外の行を文字列に変換しない代わりに行ごとの検索の呼び出しが増えるため、
+        postfixの行のみのログでは通常の解析より遅くなります。postfix以外の行が多いログで指定してください。
+        :param value: True/False
+        """
+        if value:
+            self._use_mmap = True
+        else:
+            self._use_mmap = False
+
+    @property
+    def start_offset(self):
+        """
+        解析を開始する位置(バイト)を返します。
+        :return: 解析を開始する位置
+        """
+        return self._start_offset
+
+    @start_offset.setter
+    def start_offset(self, value):
+        """
+        解析を開始する位置(バイト)を指定してください。前回のend_offsetを指定すると、
+        追記された行のみを解析します。圧縮ファイルの場合は指定できません。
+        :param value: 解析を開始する位置
+        """
+        self._start_offset = int(value or 0)
+
+    @property
+    def end_offset(self):
+        """
+        解析を終えた位置(バイト)を返します。圧縮ファイルの場合はNoneを返します。
+        最後の行が改行で終わっていない(書き込み途中の)場合、その行は解析せず、その行の先頭を返します。
+        :return: 解析を終えた位置
+        """
+        return self._end_offset
+
+    @property
+    def line_profile(self):
+        """
+        行形式のプロファイル名を返します。
+        :return: プロファイル名
+        """
+        return self._line_profile
+
+    @line_profile.setter
+    def line_profile(self, value):
+        """
+        行形式のプロファイル名を指定してください。
+        :param value: register_line_profileで登録したプロファイル名
+        """
+        if value not in self.line_profiles:
+            raise ValueError("行形式のプロファイルが登録されていません。{0}".format(value))
+        self._line_profile = value
+
+    @property
+    def last_date(self):
+        """
+        最後に解析した行の日時を返します。
+        :return: datetime.datetime、解析していない場合はNone
+        """
+        return self._last_date
+
+    @property
+    def pending_store(self):
+        """
+        解析途中のメールログの保存先を返します。
+        :return: PendingStore、保存しない場合はNone
+        """
+        return self._pending_store
+
+    @pending_store.setter
+    def pending_store(self, value):
+        """
+        解析途中のメールログの保存先(PendingStore)を指定してください。
+        新しい「ホスト名/キューID」の行は保存先に同じキーがあれば続きとして解析し、
+        解析途中のメールログが保存先の上限を超えた場合は最も長く行が現れていないものから保存先に移します。
+        そのため、保存先を指定すると解析途中のメールログを行が現れた順に並べて保持します。
+        解析済みのメールログが更新されないよう、pop_parsed_lineにはTrueを指定してください。
+        :param value: PendingStore、保存しない場合はNone
+        """
+        self._pending_store = value
+        if value is not None and not isinstance(self._imlogs, collections.OrderedDict):
+            self._imlogs = collections.OrderedDict(self._imlogs)
+
+    @property
+    def collect_recipients(self):
+        """
+        宛先ごとの配送の試行をメールログの「rcpt」に記録するか
+        :return: 記録する場合はTrue
+        """
+        return self._collect_recipients
+
+    @collect_recipients.setter
+    def collect_recipients(self, value):
+        """
+        宛先ごとの配送の試行(rcpt_fieldsの列のリスト)をメールログの「rcpt」に記録するか指定します。
+        記録しない場合はメールログにrcptを含めません。(RCPT出力、遅延時間の集計、経路の結合で使用)
+        :param value: True or False
+        :return: なし
+        """
+        self._collect_recipients = bool(value)
+
+    @property
+    def profiler(self):
+        """
+        工程別の時間を計測するParseProfilerを返します。
+        :return: ParseProfiler、計測しない場合はNone
+        """
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, value):
+        """
+        parseで行の読み取り、マッチ、日付の解析、メールログの組み立ての時間を計測するParseProfilerを指定してください。
+        各工程はParseProfilerのtimed_iter、timed_callを通して呼び出されます。計測しない場合はNoneを指定してください。
+        :param value: ParseProfiler or None
+        :return: なし
+        """
+        self._profiler = value
+
+    @property
+    def event_sink(self):
+        """
+        smtpdのイベントを受け取る関数を返します。
+        :return: 関数、イベントを出力しない場合はNone
+        """
+        return self._event_sink
+
+    @event_sink.setter
+    def event_sink(self, value):
+        """
+        キューIDを持たないsmtpdのイベント(接続、切断、キュー投入前の拒否)を受け取る関数を指定してください。
+        関数はイベントのディクショナリを引数に呼び出されます。イベントは解析途中のメールログには含まれません。
+        イベントを出力する場合はメモリマップ(use_mmap)は使用されません。
+        :param value: 関数、イベントを出力しない場合はNone
+        """
+        if value is not None and not callable(value):
+            raise ValueError("event_sinkには関数を指定してください。")
+        self._event_sink = value
 
     @property
     def filepath(self):
@@ -194,7 +610,33 @@ class MaillogParser:
                 "nrcpt": 0, "orig_to": [], "dsn": [], "status": [],
                 "delay": 0.0, "delay_before_qmanager": 0.0, "delay_qmanager": 0.0,
                 "delay_con_setup": 0.0, "delay_msg_trans": 0.0, "relay_host": [],
-                "relay_ip": [], "relay_port": [], "smtp_message": []}
+                "relay_ip": [], "relay_port": [], "smtp_message": [], "bounce_queue_id": []}
+
+    @staticmethod
+    def _copy_mlog(ml):
+        """
+        メールログの複製(リストも複製)を返します。
+        :param ml:  メールログ
+        :return:    複製したメールログ
+        """
+        m = {k: v[:] if type(v) is list else v for k, v in ml.items()}
+        if "rcpt" in m:
+            m["rcpt"] = [r[:] for r in m["rcpt"]]
+        return m
+
+    @classmethod
+    def _set_rcpt(cls, ml, name, value):
+        """
+        最後の宛先の試行(to=で開始)に値を設定します。to=より前の値は無視します。
+        宛先ごとの試行を記録しない場合(メールログにrcptがない場合)は何もしません。
+        :param ml:      解析中のメールログディクショナリ
+        :param name:    rcpt_fieldsの列名
+        :param value:   値
+        :return: なし
+        """
+        rcpt = ml.get("rcpt")
+        if rcpt:
+            rcpt[-1][cls._rcpt_index[name]] = value
 
     @staticmethod
     def _parse_smtpd_line(ml, store):
@@ -247,8 +689,6 @@ class MaillogParser:
         if store == 'removed':
             # qmgrから削除された場合は、処理を完了したものとみなす
             ml["parse_end"] = True
-            self._cnt_parse_end += 1
-            # logging.debug("{0}".format(self._cnt_parse_end))
             return True
 
         else:
@@ -302,21 +742,27 @@ class MaillogParser:
                 if t_ary[1] != '<>':
                     t_ary[1] = remove_char(t_ary[1], '<>')
                 ml["orig_to"].append(t_ary[1])
+                MaillogParser._set_rcpt(ml, "orig_to", t_ary[1])
 
             # dsn
             elif t_ary[0] == 'dsn':
-                ml["dsn"].append(t_ary[1])
+                ml["dsn"].append(intern(t_ary[1]))
+                MaillogParser._set_rcpt(ml, "dsn", ml["dsn"][-1])
 
             # status
             elif t_ary[0] == 'status':
                 tmp = t_ary[1].split(" ")
-                ml["status"].append(tmp[0])
+                ml["status"].append(intern(tmp[0]))
                 ml["smtp_message"].append(" ".join(tmp[1:]))
+                MaillogParser._set_rcpt(ml, "status", ml["status"][-1])
+                MaillogParser._set_rcpt(ml, "smtp_message", ml["smtp_message"][-1])
 
             # delay
             elif t_ary[0] == 'delay':
                 try:
-                    ml["delay"] += float(t_ary[1])
+                    delay = float(t_ary[1])
+                    ml["delay"] += delay
+                    MaillogParser._set_rcpt(ml, "delay", delay)
 
                 except ValueError as ve:
                     logging.warning("delayをfloatに変換できませんでしたが、無視します - {0}".format(ve))
@@ -343,6 +789,8 @@ class MaillogParser:
                         if ml["delay_msg_trans"] < tm_trans:
                             ml["delay_msg_trans"] = tm_trans
 
+                        MaillogParser._set_rcpt(ml, "delays", (tmbefore, tm_qmng, tm_setup, tm_trans))
+
                     except ValueError as ve:
                         logging.warning("delaysをfloatに変換できませんでしたが、無視します - {0}".format(ve))
 
@@ -352,19 +800,43 @@ class MaillogParser:
                 if t_ary[1] != '<>':
                     t_ary[1] = remove_char(t_ary[1], '<>')
                 ml["envelope_to"].append(t_ary[1])
+                # 宛先ごとの試行を開始する (列はrcpt_fieldsの順)
+                if "rcpt" in ml:
+                    ml["rcpt"].append([ml["date_end_date"], t_ary[1], "", "", "", "", 0.0, None, "", "", ""])
 
             # relay
             elif t_ary[0] == 'relay':
                 # ホスト名、IPアドレス、ポート番号を取得
                 rly = re.search(r'(?P<host>[^\[]*)\[(?P<ip>[^\]]*)\]:(?P<port>[0-9]*)', t_ary[1])
                 if rly:
-                    ml["relay_host"].append(rly.group('host'))
-                    ml["relay_ip"].append(rly.group('ip'))
-                    ml["relay_port"].append(rly.group('port'))
+                    ml["relay_host"].append(intern(rly.group('host')))
+                    ml["relay_ip"].append(intern(rly.group('ip')))
+                    ml["relay_port"].append(intern(rly.group('port')))
+                    MaillogParser._set_rcpt(ml, "relay_host", ml["relay_host"][-1])
+                    MaillogParser._set_rcpt(ml, "relay_ip", ml["relay_ip"][-1])
+                    MaillogParser._set_rcpt(ml, "relay_port", ml["relay_port"][-1])
 
                 # 取得できないときはそのまま代入
                 else:
-                    ml["relay_host"].append(t_ary[1])
+                    ml["relay_host"].append(intern(t_ary[1]))
+                    MaillogParser._set_rcpt(ml, "relay_host", ml["relay_host"][-1])
+        return
+
+    @staticmethod
+    def _parse_bounce_line(ml, store):
+        """
+        bounce行をパースする
+        不達通知(DSN)を作成した場合は、通知メールのキューIDを記録する
+            sender non-delivery notification: {QUEUE_ID}
+            sender delivery status notification: {QUEUE_ID}
+            postmaster non-delivery notification: {QUEUE_ID}
+        :param ml: 解析中のメールログディクショナリ
+        :param store: メッセージ
+        :return: Void
+        """
+        t_ary = store.split('notification: ')
+        if len(t_ary) == 2:
+            ml["bounce_queue_id"].append(t_ary[1].strip())
         return
 
     @staticmethod
@@ -391,21 +863,27 @@ class MaillogParser:
                 if t_ary[1] != '<>':
                     t_ary[1] = remove_char(t_ary[1], '<>')
                 ml["orig_to"].append(t_ary[1])
+                MaillogParser._set_rcpt(ml, "orig_to", t_ary[1])
 
             # dsn
             elif t_ary[0] == 'dsn':
-                ml["dsn"].append(t_ary[1])
+                ml["dsn"].append(intern(t_ary[1]))
+                MaillogParser._set_rcpt(ml, "dsn", ml["dsn"][-1])
 
             # status
             elif t_ary[0] == 'status':
                 tmp = t_ary[1].split(' ')
-                ml["status"].append(tmp[0])
+                ml["status"].append(intern(tmp[0]))
                 ml["smtp_message"].append(" ".join(tmp[1:]))
+                MaillogParser._set_rcpt(ml, "status", ml["status"][-1])
+                MaillogParser._set_rcpt(ml, "smtp_message", ml["smtp_message"][-1])
 
             # delay
             elif t_ary[0] == 'delay':
                 try:
-                    ml["delay"] += float(t_ary[1])
+                    delay = float(t_ary[1])
+                    ml["delay"] += delay
+                    MaillogParser._set_rcpt(ml, "delay", delay)
 
                 except ValueError as ve:
                     logging.warning("delayをfloatに変換できませんでしたが、無視します - {0}".format(ve))
@@ -432,6 +910,8 @@ class MaillogParser:
                         if ml["delay_msg_trans"] < tm_trans:
                             ml["delay_msg_trans"] = tm_trans
 
+                        MaillogParser._set_rcpt(ml, "delays", (tmbefore, tm_qmng, tm_setup, tm_trans))
+
                     except ValueError as ve:
                         logging.warning("delaysをfloatに変換できませんでしたが、無視します - {0}".format(ve))
 
@@ -442,71 +922,281 @@ class MaillogParser:
                     t_ary[1] = remove_char(t_ary[1], '<>')
 
                 ml["envelope_to"].append(t_ary[1])
+                # 宛先ごとの試行を開始する (列はrcpt_fieldsの順)
+                if "rcpt" in ml:
+                    ml["rcpt"].append([ml["date_end_date"], t_ary[1], "", "", "", "", 0.0, None, "", "", ""])
 
             # relay
             elif t_ary[0] == 'relay':
                 # ホスト名、IPアドレス、ポート番号を取得
                 rly = re.search(r'(?P<host>[^\[]*)\[(?P<ip>[^\]]*)\]:(?P<port>[0-9]*)', t_ary[1])
                 if rly:
-                    ml["relay_host"].append(rly.group('host'))
-                    ml["relay_ip"].append(rly.group('ip'))
-                    ml["relay_port"].append(rly.group('port'))
+                    ml["relay_host"].append(intern(rly.group('host')))
+                    ml["relay_ip"].append(intern(rly.group('ip')))
+                    ml["relay_port"].append(intern(rly.group('port')))
+                    MaillogParser._set_rcpt(ml, "relay_host", ml["relay_host"][-1])
+                    MaillogParser._set_rcpt(ml, "relay_ip", ml["relay_ip"][-1])
+                    MaillogParser._set_rcpt(ml, "relay_port", ml["relay_port"][-1])
 
                 # 取得できないときはそのまま代入
                 else:
-                    ml["relay_host"].append(t_ary[1])
+                    ml["relay_host"].append(intern(t_ary[1]))
+                    MaillogParser._set_rcpt(ml, "relay_host", ml["relay_host"][-1])
         return
 
+    def _isodateparse(self, t) -> datetime.datetime:
+        """
+        RFC 3339(ISO-8601)形式のログ日付から日付オブジェクトを生成
+        YYYY-MM-DDThh:mm:ss[.ffffff][Z|+hh:mm] の形式を固定位置で切り出すため
+        strptimeより高速で、マイクロ秒を保持します。
+        タイムゾーンが記録されている場合は、実行する環境のタイムゾーンに依存しないようUTCに変換し、
+        年を含まない形式の日付と比較できるようタイムゾーンを持たない日付オブジェクトを返します。
+        タイムゾーンが記録されていない場合は、記録された時刻をそのまま返します。
+        :param t: 日付文字列
+        :return:  datetime.datetime
+        """
+        us = 0
+        offset = None
+        rest = t[19:]
+        if rest:
+            if rest[0] == '.':
+                i = 1
+                while i < len(rest) and rest[i].isdigit():
+                    i += 1
+                us = int((rest[1:i] + '000000')[:6])
+                rest = rest[i:]
+            if rest:
+                offset = self._utcoffsets.get(rest)
+                if offset is None:
+                    if rest == 'Z':
+                        offset = datetime.timedelta(0)
+                    else:
+                        offset = datetime.timedelta(hours=int(rest[1:3]), minutes=int(rest[-2:]))
+                        if rest[0] == '-':
+                            offset = -offset
+                    self._utcoffsets[rest] = offset
+
+        dt = datetime.datetime(
+            int(t[0:4]), int(t[5:7]), int(t[8:10]),
+            int(t[11:13]), int(t[14:16]), int(t[17:19]), us)
+        if offset:
+            dt -= offset
+        return dt
+
     def _dateparse(self, s) -> datetime.datetime:
         """
         ログ日付から日付オブジェクトを生成
         戻りはdatetime.datetime
+        同じ日付文字列が連続することが多いため、直前の結果を再利用します。
+        年が記録されていない形式では、12月から1月に戻った時点で年を繰り上げます。
+        繰り上げた後に遅れて届いた12月の行のように、直前の月より6か月を超えて先の月の行は
+        前年の行として扱い、繰り上げの判定に使用する月は更新しません。
+        parse_dated_linesで時刻が付与されている場合は、その時刻を返します。
         :param s:
         :return:
         """
-        try:
-            return datetime.datetime(
-                self._year,
-                self._month.index(s.group('month')) + 1,
-                int(s.group('day')),
-                int(s.group('hour')),
-                int(s.group('minute')),
-                int(s.group('second')))
+        if self._line_date is not None:
+            return self._line_date
+        key = s.group('date')
+        if key == self._last_date_key:
+            return self._last_date
 
-        except IndexError as ie:
-            raise ValueError("DateParse Error:{0}".format(ie))
+        try:
+            iso = s.group('isodate')
+            if iso:
+                if isinstance(iso, bytes):
+                    iso = iso.decode()
+                dt = self._isodateparse(iso)
+            else:
+                month = self._month_index[s.group('month')]
+                year = self._year
+                if self._last_month is None:
+                    self._last_month = month
+                elif self._last_month - month > 6:
+                    # 年の繰り上げ(Dec -> Jan)
+                    self._year = year = year + 1
+                    self._last_month = month
+                elif month - self._last_month > 6:
+                    # 繰り上げ後に遅れて届いた前年の行(Jan -> Dec)
+                    year -= 1
+                else:
+                    self._last_month = month
+                dt = datetime.datetime(
+                    year,
+                    month,
+                    int(s.group('day')),
+                    int(s.group('hour')),
+                    int(s.group('minute')),
+                    int(s.group('second')))
+
+        except KeyError as ke:
+            raise ValueError("DateParse Error:{0}".format(ke))
 
         except ValueError as ve:
-            raise ValueError("DateParse Error:{0}/{1}/{2} {3}:{4}:{5} - {6}".format(
-                self._year,
-                s.group('month'),
-                s.group('day'),
-                s.group('hour'),
-                s.group('minute'),
-                s.group('second'),
-                ve
-            ))
+            raise ValueError("DateParse Error:{0} ({1}) - {2}".format(key, self._year, ve))
 
         except TypeError as te:
-            raise TypeError("DateParse Error:{0}/{1}/{2} {3}:{4}:{5} - {6}".format(
-                self._year,
-                s.group('month'),
-                s.group('day'),
-                s.group('hour'),
-                s.group('minute'),
-                s.group('second'),
-                te
-            ))
+            raise TypeError("DateParse Error:{0} ({1}) - {2}".format(key, self._year, te))
 
-    def parse(self):
+        self._last_date_key = key
+        self._last_date = dt
+        return dt
+
+    def _open_matches(self, binary):
         """
-        メールログをパースします。
-        :return:
+        解析対象のファイルを開き、行の正規表現にマッチした結果を順に返すイテレータを作成します。
+        binaryがTrueの場合はファイルをメモリマップし、bytes用の正規表現で
+        ファイル全体を走査するため、マッチしない行の文字列は作成されません。
+        :param binary:  メモリマップを使用する場合はTrue
+        :return:        マッチした結果(re.Match)のイテレータ
+        """
+        if binary:
+            import mmap
+            # メモリマップしたファイルをbytesのまま走査する
+            logging.info("非圧縮ファイルとしてメモリマップで処理を実行します。")
+            try:
+                self._file_object = open(self.filepath, 'rb')
+            except IOError as ioe:
+                raise IOError("Inputファイルを開けませんでした。{0}".format(ioe))
+            try:
+                self._mmap = mmap.mmap(self._file_object.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # 空のファイルはメモリマップできない
+                self._end_offset = 0
+                return iter(())
+            matches = self._iter_mmap_matches(self._mmap)
+            if self._profiler is not None:
+                # メモリマップの場合は行への分割を行わず、読み取り(ページフォールト)はmatchに含まれる
+                matches = self._profiler.timed_iter("match", matches, "lines")
+            return matches
+
+        rows = self._open_text()
+        if not self._compressed:
+            rows = self._complete_lines(rows)
+        if self._profiler is not None:
+            rows = self._profiler.timed_iter("decompress" if self._compressed else "read", rows)
+        matches = self._search_rows(rows)
+        if self._profiler is not None:
+            matches = self._profiler.timed_iter("match", matches, "lines")
+        return matches
+
+    def _complete_lines(self, fo):
+        """
+        改行で終わる行のみを返します。最後の行が改行で終わっていない場合は書き込み途中とみなして解析せず、
+        解析を終えた位置をその行の先頭にします。続きから解析する場合は、その行の先頭から読み取ります。
+        :param fo:  テキストとして開いたファイル
+        :return:    行のイテレータ
+        """
+        last = None
+        for row in fo:
+            if last is not None:
+                yield last
+            last = row
+        if last is None:
+            return
+        if last.endswith("\n"):
+            yield last
+        else:
+            logging.info("最後の行が改行で終わっていないため、解析しません。")
+            self._end_offset = fo.tell() - len(last.encode(fo.encoding))
+
+    def _search_rows(self, rows):
+        """
+        行の正規表現を各行に実行し、マッチした結果を返すイテレータを作成します。
+        :param rows:    行(文字列)のイテレータ
+        :return:        マッチした結果(re.Match)のイテレータ
+        """
+        pat_postfix = self.line_pattern(self._line_profile)
+        if self._event_sink is None:
+            # 行をパースする(date, host, proc, queue_id, message)
+            # マッチしなかった行(None)は取り除く
+            return filter(None, map(pat_postfix.search, rows))
+        return self._iter_with_events(rows, pat_postfix)
+
+    def _iter_with_events(self, rows, pat_postfix):
+        """
+        行の正規表現にマッチしなかった行のうち、smtpdのイベントをevent_sinkに渡します。
+        :param rows:        行(文字列)のイテレータ
+        :param pat_postfix: 行の正規表現
+        :return:            行の正規表現にマッチした結果(re.Match)
+        """
+        search = pat_postfix.search
+        search_event = self.event_pattern(self._line_profile).search
+        sink = self._event_sink
+        for row in rows:
+            s = search(row)
+            if s:
+                yield s
+                continue
+            e = search_event(row)
+            if e:
+                sink(self._create_event(e))
+
+    def _create_event(self, e):
+        """
+        smtpdのイベントの行からイベントのディクショナリを作成します。
+        :param e:   smtpdのイベントの正規表現にマッチした結果
+        :return:    イベントのディクショナリ
+        """
+        event = self._event_names[e.group('event')]
+        message = e.group('message')
+        ev = {
+            "date": self._dateparse(e),
+            "host": intern(e.group('host')),
+            "proc": intern(e.group('proc')),
+            "event": event,
+            "client_host": None,
+            "client_ip": None,
+            "helo": None,
+            "sender": None,
+            "recipient": None,
+            "reject_stage": None,
+            "reject_code": None,
+            "dsn": None,
+            "reason": None,
+        }
+        if event == "reject":
+            # RCPT from unknown[192.0.2.1]: 554 5.7.1 <x@example.com>: Relay access denied;
+            #   from=<a@example.net> to=<x@example.com> proto=ESMTP helo=<example.net>
+            r = re.match(r'(?P<stage>[\w-]+) from (?P<client_host>[^\[\s]*)\[(?P<client_ip>[^\]]*)\](?::\d+)?: '
+                         r'(?P<code>\d{3}) (?:(?P<dsn>\d\.\d{1,3}\.\d{1,3}) )?(?P<reason>.*?)(?:; (?P<attrs>\w+=.*))?$',
+                         message)
+            if r:
+                ev["reject_stage"] = intern(r.group('stage'))
+                ev["client_host"] = r.group('client_host')
+                ev["client_ip"] = r.group('client_ip')
+                ev["reject_code"] = intern(r.group('code'))
+                if r.group('dsn'):
+                    ev["dsn"] = intern(r.group('dsn'))
+                ev["reason"] = r.group('reason')
+                for k, v in re.findall(r'(\w+)=<([^>]*)>', r.group('attrs') or ""):
+                    if k == "from":
+                        ev["sender"] = v
+                    elif k == "to":
+                        ev["recipient"] = v
+                    elif k == "helo":
+                        ev["helo"] = v
+            else:
+                ev["reason"] = message
+        else:
+            cl = re.match(r'(?P<hostname>[^\[\s]*)\[(?P<ip>[^\]]*)\]', message)
+            if cl:
+                ev["client_host"] = cl.group('hostname')
+                ev["client_ip"] = cl.group('ip')
+        return ev
+
+    def _open_text(self):
+        """
+        解析対象のファイルをテキストとして開きます。
+        start_offsetが指定されている場合は、その位置から読み取ります。
+        :return: ファイルオブジェクト
         """
-        pat_postfix = re.compile(self.re_line)
         # ファイルを読み取り専用で開く
+        self._end_offset = None
         if self._compressed:
             import gzip
+            if self._start_offset:
+                raise ValueError("圧縮ファイルは途中から解析できません。")
             # 圧縮ファイルは圧縮ファイルとして読み取る
             logging.info("圧縮ファイルとして処理を実行します。")
             try:
@@ -520,169 +1210,3182 @@ class MaillogParser:
                 self._file_object = open(self.filepath, 'rt')
             except IOError as ioe:
                 raise IOError("Inputファイルを開けませんでした。{0}".format(ioe))
+            if self._start_offset:
+                self._file_object.seek(self._start_offset)
+        return self._file_object
+
+    def _iter_mmap_matches(self, mm):
+        """
+        メモリマップしたファイルから行の正規表現にマッチした結果を順に返します。
+        syslog_nameの共通部分(「 postfix」など)をバッファ上で検索し、見つかった行に対してのみ
+        正規表現を実行するため、postfix以外の行は文字列にもマッチ結果にもなりません。
+        :param mm:  メモリマップしたファイル
+        :return:    マッチした結果(re.Match)
+        """
+        match = self.line_pattern(self._line_profile, binary=True).match
+        names = self.line_profiles[self._line_profile]["syslog_names"]
+        literal = (" " + os.path.commonprefix(names)).encode()
+        find = mm.find
+        rfind = mm.rfind
+        pos = self._start_offset
+        # 改行で終わっていない最後の行は書き込み途中とみなして解析しない
+        end = max(rfind(b'\n', pos) + 1, pos)
+        while True:
+            p = find(literal, pos, end)
+            if p < 0:
+                self._end_offset = end
+                return
+            ls = rfind(b'\n', pos, p) + 1
+            if ls == 0:
+                ls = pos
+            le = find(b'\n', p, end)
+            s = match(mm, ls, le)
+            if s:
+                yield s
+            pos = le + 1
+
+    def _close_input(self):
+        """
+        解析対象のファイルを閉じます。
+        :return: なし
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file_object is not None:
+            if self._end_offset is None and not self._compressed:
+                try:
+                    self._end_offset = self._file_object.tell()
+                except (OSError, ValueError):
+                    pass
+            self._file_object.close()
+            self._file_object = None
+
+    def parse(self):
+        """
+        メールログをパースします。
+        :return:
+        """
+        binary = self._use_mmap and not self._compressed and self._event_sink is None
+        matches = self._open_matches(binary)
+        records = self._parse_matches(matches, binary)
+        if self._profiler is not None:
+            records = self._profiler.timed_iter("parse", records, "records", chunk=1)
+
+        try:
+            yield from records
+
+        finally:
+            self._close_input()
+        return
+
+    def parse_lines(self, rows):
+        """
+        ファイル以外(syslogの受信など)から受け取った行をパースします。
+        状態(解析途中のメールログ)は呼び出しをまたいで引き継がれるため、
+        行をまとめて何度も渡すことができます。
+        :param rows:    行(文字列)のイテレータ
+        :return:        解析が完了したメールログ
+        """
+        return self._parse_matches(self._search_rows(rows), False)
+
+    def parse_dated_lines(self, pairs):
+        """
+        時刻を付与した行をパースします。行の日付は文字列から解析せずに、付与した時刻を使用します。
+        年の異なる複数の入力を並べる場合(MaillogMerger)に、入力ごとの年で解析した時刻を使用します。
+        時刻がNoneの行は、parse_linesと同様に行の日付を解析します。
+        :param pairs:   (時刻, 行)のイテレータ
+        :return:        解析が完了したメールログ
+        """
+        return self._parse_matches(self._search_rows(self._dated_rows(pairs)), False)
+
+    def _dated_rows(self, pairs):
+        """
+        付与された時刻を、行を正規表現にマッチさせる間の日付として設定します。
+        行は1行ずつ取り出されてマッチするため、マッチした結果を解析する時点では
+        その行の時刻が設定されています。
+        :param pairs:   (時刻, 行)のイテレータ
+        :return:        行のイテレータ
+        """
+        try:
+            for dt, row in pairs:
+                self._line_date = dt
+                yield row
+        finally:
+            self._line_date = None
+
+    def _parse_matches(self, matches, binary):
+        """
+        行の正規表現にマッチした結果からメールログを組み立てます。
+        :param matches: マッチした結果(re.Match)のイテレータ
+        :param binary:  マッチした結果がbytesの場合はTrue
+        :return:        解析が完了したメールログ
+        """
+        # プロセス名ごとのハンドラ
+        handlers = self._resolve_handlers()
+        # bytesのプロセス名、ホスト名を文字列に変換した結果
+        decoded = {}
+        # 解析途中のメールログの保存先と、前回保存先に移してからの新しいキューIDの数
+        pending = self._pending_store
+        new_keys = 0
+        collect = self._collect_recipients
+        dateparse = self._dateparse
+        if self._profiler is not None:
+            dateparse = self._profiler.timed_call("date", dateparse)
+
+        for s in matches:
+            proc, host = s.group('proc', 'host')  # groupで何度も直接参照すると遅い
+            # プロセス名とホスト名は種類が少ないため、internして同じ文字列オブジェクトを共有する
+            if binary:
+                # デコード結果を再利用する
+                if proc not in decoded:
+                    decoded[proc] = intern(proc.decode())
+                if host not in decoded:
+                    decoded[host] = intern(host.decode())
+                proc = decoded[proc]
+                host = decoded[host]
+            else:
+                proc = intern(proc)
+                host = intern(host)
+
+            # ハンドラが登録されているプロセスの場合は下記の処理を実行する
+            # pickup, scache, anvil, trivial-rewrite などは登録されていないため無視する
+            handler = handlers.get(proc)
+            if handler is not None:
+
+                # 既存の解析済みログに含まれるか確認する
+                qid, message = s.group('queue_id', 'message')
+                if binary:
+                    qid = qid.decode()
+                    message = message.decode()
+                skey = "{0}/{1}".format(host, qid)
+                if skey in self._imlogs:
+                    ml = self._imlogs[skey]
+                    if pending is not None:
+                        # 保存先に移す順序(LRU)のため、最後に行が現れたものとする
+                        self._imlogs.move_to_end(skey)
+                    if ml["parse_end"]:
+                        # 解析が完了して返したメールログは、まとめて書き込むまでに更新されないよう複製して続ける
+                        ml = self._imlogs[skey] = self._copy_mlog(ml)
+                else:
+                    ml = None
+                    if pending is not None:
+                        # 保存先にあれば続きとして解析する
+                        ml = pending.take(skey)
+                        new_keys += 1
+                        if new_keys >= PENDING_SPILL_INTERVAL:
+                            pending.spill(self._imlogs)
+                            new_keys = 0
+                    if ml is None:
+                        ml = self._create_mlog()
+                        ml["queue_id"] = qid
+                    if collect:
+                        # 保存先から取り出したメールログは記録していない場合がある
+                        ml.setdefault("rcpt", [])
+                    self._imlogs[skey] = ml
+
+                # 日付(strptimeの処理コストが高いため変更) - 0.4
+                dt = dateparse(s)
+                if ml["date_start_date"] is None:
+                    ml["date_start_date"] = dt
+                    ml["date_end_date"] = dt
+                elif ml["date_end_date"] < dt:
+                    ml["date_end_date"] = dt
+                elif ml["date_start_date"] > dt:
+                    ml["date_start_date"] = dt
+
+                # プロセス
+                ml["proc"].append(proc)
+
+                # ホスト名
+                ml["host"] = host
+
+                # ハンドラがTrueを返した場合は解析が完了したものとみなす
+                for store in message.split(", "):
+                    if handler(ml, store):
+                        # 登録したハンドラが完了を返した場合も、qmgrのremovedと同様に完了として数える
+                        ml["parse_end"] = True
+                        self._cnt_parse_end += 1
+                        yield ml
+                        # 不要になった配列を削除する
+                        if self._pop_parsed_line:
+                            self._imlogs.pop(skey, None)
+
+    def scan_summary(self):
+        """
+        メールログのレコードを組み立てずに集計のみを行います。
+        日付の解析やメールログディクショナリの作成を行わず、qmgr行と配送エージェントの行から
+        メッセージ数、宛先数、バイト数、配送結果(status)ごとの件数を直接数えます。
+        qmgr行(from=, size=, nrcpt=)は再送時にも出力されるため、キューIDごとに1度だけ数えます。
+        :return: 集計結果のディクショナリ
+        """
+        binary = self._use_mmap and not self._compressed
+        matches = self._open_matches(binary)
+
+        if binary:
+            enc = str.encode
+            pat_size = re.compile(br', size=(\d+), nrcpt=(\d+)')
+            pat_status = re.compile(br', status=(\w+)')
+        else:
+            enc = str
+            pat_size = re.compile(r', size=(\d+), nrcpt=(\d+)')
+            pat_status = re.compile(r', status=(\w+)')
+        qmgr = enc("qmgr")
+        removed = enc("removed")
+        agents = frozenset(enc(a) for a in self.delivery_agents)
+
+        seen = set()
+        messages = recipients = size = cnt_removed = 0
+        status = collections.Counter()
+        try:
+            for s in matches:
+                proc, message = s.group('proc', 'message')
+                if proc == qmgr:
+                    if message == removed:
+                        cnt_removed += 1
+                        continue
+                    q = pat_size.search(message)
+                    if q:
+                        key = s.group('host', 'queue_id')
+                        if key not in seen:
+                            seen.add(key)
+                            messages += 1
+                            size += int(q.group(1))
+                            recipients += int(q.group(2))
+                elif proc in agents:
+                    q = pat_status.search(message)
+                    if q:
+                        status[q.group(1)] += 1
+
+        finally:
+            self._close_input()
+
+        summary = {"messages": messages, "recipients": recipients, "bytes": size, "removed": cnt_removed,
+                   "sent": 0, "deferred": 0, "bounced": 0}
+        for k, v in status.items():
+            if binary:
+                k = k.decode()
+            summary[k] = summary.get(k, 0) + v
+        return summary
+
+    def get_noncomplete_maillog(self):
+        for m in self._imlogs.values():
+            if m["parse_end"] == False:
+                yield m
+
+
+class RecordView:
+    """
+    解析が完了したメールログを読み取り専用で参照するクラスです。
+    メールログのディクショナリをコピーせずに保持し、リストは参照時にタプルとして返します。
+    smtp_message(連結した応答メッセージ)とduration(最初から最後の行までの時間)は
+    最初に参照した時点で計算します。
+    stream_recordsはpop_parsed_line=Trueで解析するため、参照中にメールログが更新されることはありません。
+    """
+    __slots__ = ("_m", "_smtp_message", "_duration")
+
+    def __init__(self, m: dict):
+        object.__setattr__(self, "_m", m)
+        object.__setattr__(self, "_smtp_message", None)
+        object.__setattr__(self, "_duration", None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("RecordViewは変更できません。")
+
+    def __delattr__(self, key):
+        raise AttributeError("RecordViewは変更できません。")
+
+    def __repr__(self):
+        return "RecordView(host={0!r}, queue_id={1!r}, complete={2!r})".format(
+            self._m["host"], self._m["queue_id"], self._m["parse_end"])
+
+    @property
+    def host(self) -> str:
+        return self._m["host"]
+
+    @property
+    def queue_id(self) -> str:
+        return self._m["queue_id"]
+
+    @property
+    def complete(self) -> bool:
+        """
+        :return: qmgrがremovedを出力して解析が完了した場合はTrue
+        """
+        return self._m["parse_end"]
+
+    @property
+    def start(self) -> datetime.datetime:
+        return self._m["date_start_date"]
+
+    @property
+    def end(self) -> datetime.datetime:
+        return self._m["date_end_date"]
+
+    @property
+    def duration(self) -> datetime.timedelta:
+        """
+        :return: 最初の行から最後の行までの時間
+        """
+        if self._duration is None:
+            object.__setattr__(self, "_duration", self._m["date_end_date"] - self._m["date_start_date"])
+        return self._duration
+
+    @property
+    def proc(self) -> tuple:
+        return tuple(self._m["proc"])
+
+    @property
+    def client_host(self) -> str:
+        return self._m["client_host"]
+
+    @property
+    def client_ip(self) -> str:
+        return self._m["client_ip"]
+
+    @property
+    def message_id(self) -> str:
+        return self._m["message_id"]
+
+    @property
+    def envelope_from(self) -> str:
+        return self._m["envelope_from"]
+
+    @property
+    def envelope_to(self) -> tuple:
+        return tuple(self._m["envelope_to"])
+
+    @property
+    def orig_to(self) -> tuple:
+        return tuple(self._m["orig_to"])
+
+    @property
+    def size(self) -> int:
+        return self._m["size"]
+
+    @property
+    def nrcpt(self) -> int:
+        return self._m["nrcpt"]
+
+    @property
+    def relay_host(self) -> tuple:
+        return tuple(self._m["relay_host"])
+
+    @property
+    def relay_ip(self) -> tuple:
+        return tuple(self._m["relay_ip"])
+
+    @property
+    def relay_port(self) -> tuple:
+        return tuple(self._m["relay_port"])
+
+    @property
+    def dsn(self) -> tuple:
+        return tuple(self._m["dsn"])
+
+    @property
+    def status(self) -> tuple:
+        return tuple(self._m["status"])
+
+    @property
+    def delay(self) -> float:
+        return self._m["delay"]
+
+    @property
+    def delays(self) -> tuple:
+        """
+        :return: (delay_before_qmanager, delay_qmanager, delay_con_setup, delay_msg_trans)
+        """
+        m = self._m
+        return m["delay_before_qmanager"], m["delay_qmanager"], m["delay_con_setup"], m["delay_msg_trans"]
+
+    @property
+    def bounce_queue_id(self) -> tuple:
+        return tuple(self._m["bounce_queue_id"])
+
+    @property
+    def smtp_message(self) -> str:
+        """
+        :return: 応答メッセージを「,」で連結した文字列
+        """
+        if self._smtp_message is None:
+            object.__setattr__(self, "_smtp_message", ','.join(self._m["smtp_message"]))
+        return self._smtp_message
+
+    @property
+    def recipients(self) -> tuple:
+        """
+        stream_records(recipients=True)で解析した場合のみ参照できます。
+        :return: 宛先ごとの配送の試行(RecipientRow)のタプル
+        """
+        if "rcpt" not in self._m:
+            raise ValueError("宛先ごとの配送の試行は記録されていません。stream_records(recipients=True)を指定してください。")
+        return tuple(RecipientRow(self, a) for a in self._m["rcpt"])
+
+    @property
+    def record(self) -> dict:
+        """
+        保持しているメールログのディクショナリをコピーせずに返します。
+        Writerへの書き込みなど、読み取りのみを行う場合に使用してください。変更する場合はto_dictを使用してください。
+        :return: メールログのディクショナリ
+        """
+        return self._m
+
+    def to_dict(self) -> dict:
+        """
+        メールログのディクショナリのコピーを返します。リストもコピーします。
+        :return: メールログのディクショナリ
+        """
+        d = {k: list(v) if isinstance(v, list) else v for k, v in self._m.items()}
+        if "rcpt" in d:
+            d["rcpt"] = [list(a) for a in d["rcpt"]]
+        return d
+
+
+class RecipientRow:
+    """
+    宛先ごとの配送の試行を1行として読み取り専用で参照するクラスです。
+    メッセージ単位の値(ホスト名、キューID、送信者など)はコピーせず、親のRecordViewを参照します。
+    1つの試行はメールログのrcptの要素(列はMaillogParser.rcpt_fieldsの順)をそのまま参照します。
+    """
+    __slots__ = ("_parent", "_a")
+
+    def __init__(self, parent: RecordView, attempt: list):
+        object.__setattr__(self, "_parent", parent)
+        object.__setattr__(self, "_a", attempt)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("RecipientRowは変更できません。")
+
+    def __delattr__(self, key):
+        raise AttributeError("RecipientRowは変更できません。")
+
+    def __repr__(self):
+        return "RecipientRow(queue_id={0!r}, to={1!r}, status={2!r})".format(
+            self._parent.queue_id, self._a[1], self._a[9])
+
+    @property
+    def parent(self) -> RecordView:
+        return self._parent
+
+    @property
+    def host(self) -> str:
+        return self._parent.host
+
+    @property
+    def queue_id(self) -> str:
+        return self._parent.queue_id
+
+    @property
+    def message_id(self) -> str:
+        return self._parent.message_id
+
+    @property
+    def envelope_from(self) -> str:
+        return self._parent.envelope_from
+
+    @property
+    def date(self) -> datetime.datetime:
+        """
+        :return: 配送行を解析した時点のメールログの最終時刻
+        """
+        return self._a[0]
+
+    @property
+    def to(self) -> str:
+        return self._a[1]
+
+    @property
+    def orig_to(self) -> str:
+        return self._a[2]
+
+    @property
+    def relay_host(self) -> str:
+        return self._a[3]
+
+    @property
+    def relay_ip(self) -> str:
+        return self._a[4]
+
+    @property
+    def relay_port(self) -> str:
+        return self._a[5]
+
+    @property
+    def delay(self) -> float:
+        return self._a[6]
+
+    @property
+    def delays(self) -> tuple:
+        """
+        :return: (before_qmgr, qmgr, setup, trans)、記録されていない場合はNone
+        """
+        return self._a[7]
+
+    @property
+    def dsn(self) -> str:
+        return self._a[8]
+
+    @property
+    def status(self) -> str:
+        return self._a[9]
+
+    @property
+    def smtp_message(self) -> str:
+        return self._a[10]
+
+
+class RecordStream:
+    """
+    RecordViewなどを順に返すイテレータに、filter, map, batchなどの処理をつなげるクラスです。
+    処理は要素を取り出した時点で1件ずつ行われ、要素はコピーされません。
+    各メソッドは新しいRecordStreamを返します。1つのRecordStreamは1度だけ反復できます。
+    """
+    __slots__ = ("_it",)
+
+    def __init__(self, iterable):
+        self._it = iter(iterable)
+
+    def __iter__(self):
+        return self._it
+
+    def __next__(self):
+        return next(self._it)
+
+    def filter(self, predicate) -> "RecordStream":
+        """
+        :param predicate:   要素を受け取り、残す場合にTrueを返す関数
+        :return:            RecordStream
+        """
+        return RecordStream(filter(predicate, self._it))
+
+    def map(self, func) -> "RecordStream":
+        """
+        :param func:    要素を受け取り、変換した値を返す関数
+        :return:        RecordStream
+        """
+        return RecordStream(map(func, self._it))
+
+    def batch(self, size) -> "RecordStream":
+        """
+        要素をsize件ずつのリストにまとめます。最後のリストはsize件未満になる場合があります。
+        :param size:    1つのリストの件数
+        :return:        リストを返すRecordStream
+        """
+        if size < 1:
+            raise ValueError("batchの件数は1以上を指定してください。")
+        return RecordStream(self._batch(self._it, size))
+
+    def recipients(self) -> "RecordStream":
+        """
+        RecordViewを宛先ごとの配送の試行(RecipientRow)に展開します。
+        :return:    RecipientRowを返すRecordStream
+        """
+        return RecordStream(r for v in self._it for r in v.recipients)
+
+    @staticmethod
+    def _batch(it, size):
+        buf = []
+        for x in it:
+            buf.append(x)
+            if len(buf) >= size:
+                yield buf
+                buf = []
+        if buf:
+            yield buf
+
+    def write_to(self, mtw, batch_size=WRITE_BATCH_SIZE) -> int:
+        """
+        RecordView、もしくはmapで変換したメールログのディクショナリをWriterにまとめて書き込みます。
+        Writerは接続済みのものを指定してください。
+        :param mtw:         MaillogWriter
+        :param batch_size:  insert_manyに渡す件数
+        :return:            書き込んだ件数
+        """
+        cnt = 0
+        for views in self.batch(batch_size):
+            mtw.insert_many([self._record(v) for v in views])
+            cnt += len(views)
+        return cnt
+
+    @staticmethod
+    def _record(v) -> dict:
+        """
+        :param v:   RecordViewかメールログのディクショナリ
+        :return:    メールログのディクショナリ
+        """
+        if isinstance(v, RecordView):
+            return v.record
+        if isinstance(v, dict):
+            return v
+        raise TypeError("Writerに書き込めない要素です。{0}".format(type(v).__name__))
+
+
+def stream_records(fn, year=None, compressed=False, line_profile="default", include_incomplete=True,
+                   recipients=False) -> RecordStream:
+    """
+    ログファイルを解析し、解析が完了したメールログをRecordViewとして順に返します。
+    include_incompleteがTrueの場合は、最後に解析が終わっていないメールログも返します。
+    :param fn:                  ファイル名
+    :param year:                年
+    :param compressed:          圧縮ファイルの場合はTrue
+    :param line_profile:        行形式のプロファイル名
+    :param include_incomplete:  解析が終わっていないメールログも返す場合はTrue
+    :param recipients:          宛先ごとの配送の試行(RecordView.recipients)を記録する場合はTrue
+    :return:                    RecordViewを返すRecordStream
+    """
+    mp = MaillogParser(fn, year)
+    mp.compressed = compressed
+    mp.line_profile = line_profile
+    mp.pop_parsed_line = True
+    mp.collect_recipients = recipients
+
+    def views():
+        for m in mp.parse():
+            yield RecordView(m)
+        if include_incomplete:
+            for m in list(mp.get_noncomplete_maillog()):
+                yield RecordView(m)
+
+    return RecordStream(views())
+
+
+class MaillogPipeline:
+    """
+    1つの入力を複数のプロセスで解析するクラスです。
+    読み取りプロセス(呼び出し元)は入力を行の途中で切れないブロック(bytes)に分け、同じブロックを全てのワーカーへ送ります。
+    各ワーカーはブロックの各行から「proc[pid]: 」の後のキューIDを取り出し、そのCRC32をワーカー数で割った余りが
+    自分の番号の行のみを解析します。同じキューIDの行は常に同じワーカーが解析するため、各ワーカーは
+    解析途中のメールログ(_imlogs)の一部のみを持ちます。読み取りプロセスは行ごとの処理を行いません。
+    formatterにテキストを書き込むWriterのクラス(formats_textがTrue)を指定すると、ワーカーは解析が完了したメールログを
+    書き込む文字列に変換して返し、parseは文字列を返します。メールログ自体はプロセス間で受け渡しません。
+    ワーカーには行形式のプロファイル、年、宛先ごとの試行を記録するか、プロセスのハンドラを引き継ぎます。
+    register_handlerで登録したハンドラは、プロセスの起動方式がspawnの場合はpickleできる(モジュールの関数など)必要があります。
+    結果を返すキューも上限(PIPELINE_QUEUE_DEPTH×ワーカー数)を持ち、書き込みが遅い場合は
+    ワーカーと読み取りが待たされます。読み取りプロセスはワーカーへの送信を待つ間も結果を受け取ります。
+    ワーカーで例外が発生した場合は同じ例外を、ワーカーが異常終了した場合はRuntimeErrorを読み取りプロセスで送出します。
+    """
+
+    def __init__(self, parser, workers, block_size=PIPELINE_BLOCK_SIZE, formatter=None):
+        """
+        :param parser:      入力ファイル、圧縮状態、年、行形式のプロファイルを設定済みのMaillogParser
+        :param workers:     ワーカープロセスの数
+        :param block_size:  1度に読み取って送るバイト数
+        :param formatter:   ワーカーで文字列に変換する場合は、MaillogWriterを継承したクラス
+        """
+        if workers < 1:
+            raise ValueError("ワーカー数は1以上を指定してください。")
+        if formatter is not None and not formatter.formats_text:
+            raise ValueError("文字列に変換できないWriterです。{0}".format(formatter.__name__))
+        self._parser = parser
+        self._workers = workers
+        self._block_size = block_size
+        self._formatter = formatter
+        self._noncomplete = []
+        self._parsed_count = 0
+        self._running = 0
+        self._procs = []
+        self._end_offset = None
+
+    @property
+    def parsed_count(self):
+        """
+        全てのワーカーが解析したメールログの件数を返します。
+        :return: 件数
+        """
+        return self._parsed_count
+
+    @property
+    def end_offset(self):
+        """
+        解析を終えた位置(バイト)を返します。圧縮ファイルの場合はNoneを返します。
+        MaillogParserと同様に、改行で終わっていない最後の行は解析せず、その行の先頭を返します。
+        :return: 解析を終えた位置
+        """
+        return self._end_offset
+
+    @staticmethod
+    def _select(block, index, workers, encoding):
+        """
+        ブロックの行のうち、このワーカーが解析する行を選んで文字列にします。
+        hash()はプロセスごとに値が異なる場合があるため、キューIDのCRC32で選びます。
+        「]: 」を含まない行は解析できないため、どのワーカーも選びません。
+        :param block:   改行で終わるブロック(bytes)
+        :param index:   ワーカーの番号
+        :param workers: ワーカーの数
+        :param encoding:    入力の文字コード
+        :return:        行(文字列)のリスト
+        """
+        import zlib
+
+        crc32 = zlib.crc32
+        rows = []
+        append = rows.append
+        if b"\r" in block:
+            # テキストとして読み取る場合と同様に、CRLFの改行をLFにする
+            block = block.replace(b"\r\n", b"\n")
+        for row in block.split(b"\n"):
+            i = row.find(b"]: ")
+            if i >= 0 and crc32(row[i + 3:row.find(b":", i + 3)]) % workers == index:
+                append(row)
+        if not rows:
+            return rows
+        # 選んだ行をまとめてデコードする
+        return b"\n".join(rows).decode(encoding).split("\n")
+
+    @staticmethod
+    def _work(index, workers, in_q, out_q, encoding, year, profile_name, profile,
+              collect_recipients=False, handlers=None, formatter=None):
+        """
+        ワーカープロセスの処理です。受け取ったブロックから担当の行を選んでparse_linesで解析し、
+        解析が完了したメールログ(formatterを指定した場合は書き込む文字列)をまとめて返します。
+        入力の終わり(None)を受け取ると、解析が終わっていないメールログと解析件数を返します。
+        例外が発生した場合は、例外と発生箇所(トレースバック)を返して終了します。
+        :param index:           ワーカーの番号
+        :param workers:         ワーカーの数
+        :param in_q:            ブロックを受け取るキュー
+        :param out_q:           結果を返すキュー
+        :param encoding:        入力の文字コード
+        :param year:            年
+        :param profile_name:    行形式のプロファイル名
+        :param profile:         行形式のプロファイル
+        :param collect_recipients:  宛先ごとの配送の試行を記録する場合はTrue
+        :param handlers:            プロセスのハンドラ(service_handlers)
+        :param formatter:           文字列に変換するMaillogWriterのクラス
+        :return: なし
+        """
+        try:
+            MaillogParser.line_profiles[profile_name] = profile
+            mp = MaillogParser(None, year)
+            if handlers is not None:
+                mp.service_handlers = handlers
+            mp.pop_parsed_line = True
+            mp.line_profile = profile_name
+            mp.collect_recipients = collect_recipients
+            fmt = formatter() if formatter is not None else None
+            select = MaillogPipeline._select
+            for block in iter(in_q.get, None):
+                records = list(mp.parse_lines(select(block, index, workers, encoding)))
+                if not records:
+                    continue
+                if fmt is not None:
+                    out_q.put(("text", fmt.format_many(records)))
+                else:
+                    out_q.put(("records", records))
+            out_q.put(("end", (list(mp.get_noncomplete_maillog()), mp.parsed_count)))
+        except BaseException as e:
+            import traceback
+
+            detail = traceback.format_exc()
+            try:
+                # 読み取りプロセスで復元できない例外は、メッセージのみを返す
+                pickle.loads(pickle.dumps(e))
+            except Exception:
+                e = RuntimeError("{0}: {1}".format(type(e).__name__, e))
+            out_q.put(("error", (e, detail)))
+
+    @staticmethod
+    def _intern(m):
+        """
+        ワーカーから受け取ったメールログの文字列をinternし直します。
+        プロセス間の受け渡し(pickle)で別々のオブジェクトになった種類の少ない値を、再び共有させます。
+        :param m:   メールログ
+        :return:    なし
+        """
+        m["host"] = intern(m["host"])
+        for name in ("proc", "dsn", "status", "relay_host", "relay_ip", "relay_port"):
+            m[name] = [intern(v) for v in m[name]]
+        for r in m.get("rcpt", ()):
+            for i in MaillogPipeline._rcpt_interned:
+                if r[i]:
+                    r[i] = intern(r[i])
+
+    _rcpt_interned = tuple(MaillogParser._rcpt_index[name] for name in
+                           ("relay_host", "relay_ip", "relay_port", "dsn", "status"))
+
+    def _check_workers(self):
+        """
+        異常終了したワーカーがないか確認します。
+        結果(終了の通知)を返さずに終了したワーカーがあると、結果を待ち続けることになるためです。
+        :return: なし
+        """
+        for i, proc in enumerate(self._procs):
+            if proc.exitcode not in (None, 0):
+                raise RuntimeError("ワーカープロセス({0})が異常終了しました。終了コード: {1}".format(i, proc.exitcode))
+
+    def _receive(self, out_q, timeout=0):
+        """
+        ワーカーからの結果を1件受け取ります。
+        結果が届かなかった場合は、ワーカーが異常終了していないか確認してからqueue.Emptyを送出します。
+        :param out_q:   結果を返すキュー
+        :param timeout: 待つ秒数(0の場合は待たない)
+        :return:        解析が完了したメールログ(またはformatterで変換した文字列)のリスト
+        """
+        import queue
+
+        try:
+            kind, payload = out_q.get(timeout > 0, timeout)
+        except queue.Empty:
+            self._check_workers()
+            raise
+        if kind == "text":
+            return [payload]
+        if kind == "records":
+            for m in payload:
+                self._intern(m)
+            return payload
+        if kind == "error":
+            error, detail = payload
+            logging.error("ワーカープロセスで例外が発生しました。\n{0}".format(detail))
+            raise error
+        noncomplete, count = payload
+        for m in noncomplete:
+            self._intern(m)
+        self._noncomplete.extend(noncomplete)
+        self._parsed_count += count
+        self._running -= 1
+        return []
+
+    def _send(self, in_q, out_q, block):
+        """
+        ワーカーへブロックを送ります。ワーカーへのキューが一杯の間は結果を受け取り、
+        結果の送信を待っているワーカーが止まったままにならないようにします。
+        :param in_q:    ワーカーへのキュー
+        :param out_q:   結果を返すキュー
+        :param block:   ブロック(入力の終わりはNone)
+        :return:        送信を待つ間に受け取った結果
+        """
+        import queue
+
+        while True:
+            try:
+                in_q.put(block, False)
+                return
+            except queue.Full:
+                pass
+            try:
+                yield from self._receive(out_q, PIPELINE_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _collect(self, out_q):
+        """
+        届いている結果を待たずに受け取ります。
+        :param out_q:   結果を返すキュー
+        :return:        受け取った結果
+        """
+        import queue
+
+        while True:
+            try:
+                yield from self._receive(out_q)
+            except queue.Empty:
+                return
+
+    def _blocks(self, raw):
+        """
+        入力を行の途中で切れないブロックに分けます。
+        最後の改行より後の部分は、圧縮ファイルの場合のみ最後に返します(MaillogParserと同様に、
+        非圧縮ファイルでは書き込み途中の行とみなします)。
+        :param raw: 入力(バイナリ)
+        :return:    ブロック(bytes)
+        """
+        mp = self._parser
+        size = self._block_size
+        offset = mp.start_offset
+        rest = b""
+        while True:
+            data = raw.read(size)
+            if not data:
+                break
+            cut = data.rfind(b"\n") + 1
+            if cut == 0:
+                rest += data
+                continue
+            block = rest + data[:cut]
+            offset += len(block)
+            yield block
+            rest = data[cut:]
+        if mp.compressed:
+            if rest:
+                yield rest
+        else:
+            if rest:
+                logging.info("最後の行が改行で終わっていないため、解析しません。")
+            self._end_offset = offset
+
+    def parse(self):
+        """
+        メールログをパースします。
+        :return: 解析が完了したメールログ(formatterを指定した場合は書き込む文字列)
+        """
+        import multiprocessing
+        import queue
+
+        n = self._workers
+        mp = self._parser
+        self._noncomplete = []
+        self._parsed_count = 0
+        self._procs = []
+        self._end_offset = None
+        try:
+            # テキストとして開き、文字コードのみを使用して下位のバイナリを読み取る
+            fo = mp._open_text()
+            out_q = multiprocessing.Queue(PIPELINE_QUEUE_DEPTH * n)
+            in_qs = [multiprocessing.Queue(PIPELINE_QUEUE_DEPTH) for _ in range(n)]
+            self._procs = [multiprocessing.Process(
+                target=self._work,
+                args=(i, n, q, out_q, fo.encoding, mp.year, mp.line_profile,
+                      MaillogParser.line_profiles[mp.line_profile],
+                      mp.collect_recipients, mp.service_handlers, self._formatter),
+                daemon=True) for i, q in enumerate(in_qs)]
+            for proc in self._procs:
+                proc.start()
+            self._running = n
+
+            for block in self._blocks(fo.buffer):
+                for q in in_qs:
+                    yield from self._send(q, out_q, block)
+                # 送信の合間に届いている結果を受け取る
+                yield from self._collect(out_q)
+
+            for q in in_qs:
+                yield from self._send(q, out_q, None)
+
+            # 全てのワーカーが終了するまで結果を受け取る
+            while self._running:
+                try:
+                    yield from self._receive(out_q, PIPELINE_POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+
+            for proc in self._procs:
+                proc.join()
+
+        finally:
+            mp._close_input()
+            for proc in self._procs:
+                if proc.is_alive():
+                    proc.terminate()
+        return
+
+    def get_noncomplete_maillog(self):
+        """
+        全てのワーカーで解析が終わっていないメールログを返します。parseの後に呼び出してください。
+        :return: 解析が終わっていないメールログ
+        """
+        return iter(self._noncomplete)
+
+
+class MaillogMerger:
+    """
+    複数のホストのログを時刻順に並べて、1つのパーサーで解析するクラスです。
+    各入力から1行ずつ読み取り、ヒープ(heapq.merge)で最も古い行から順に取り出すため、
+    メモリの使用量は入力の数に比例し、入力の大きさには依存しません。
+    各入力の時刻は単調に増加するものとして並べます。時計のずれなどで時刻が戻った行は
+    直前の行と同じ時刻として扱い、入力内の順序を保ちます。
+    時刻を読み取れない行も直前の行と同じ時刻として扱います。
+    RFC 3339形式でタイムゾーンを持つ時刻は、MaillogParserと同様にUTCに変換して比較します。
+    行の時刻は入力ごとの年で解析し、パーサーには解析した時刻を付与して渡すため、
+    年を含まない形式でも入力ごとの年がメールログの時刻に反映されます。
+    """
+    re_date = re.compile(MaillogParser.re_date)
+
+    def __init__(self, parser, inputs, skew=MERGE_MAX_SKEW, yearfromctime=False):
+        """
+        :param parser:          圧縮状態、年、行形式のプロファイルを設定済みのMaillogParser
+        :param inputs:          入力ファイルのリスト
+        :param skew:            警告せずに許容する時刻の戻り(秒)
+        :param yearfromctime:   入力ごとにctimeから年を決める場合はTrue
+        """
+        self._parser = parser
+        self._inputs = list(inputs)
+        self._skew = skew
+        # 入力ごとの年
+        self._years = []
+        for fn in self._inputs:
+            if yearfromctime:
+                self._years.append(datetime.datetime.fromtimestamp(os.stat(fn).st_ctime).year)
+            else:
+                self._years.append(parser.year)
+        if self._years:
+            parser.year = min(self._years)
+        self._readers = []
+        # 許容範囲内で時刻が戻った行の数と、許容範囲を超えて時刻が戻った行の数
+        self.clamped = 0
+        self.jumps = 0
+
+    @property
+    def parsed_count(self):
+        return self._parser.parsed_count
+
+    @property
+    def end_offset(self):
+        return None
+
+    def _keyed(self, reader, rows):
+        """
+        各行に並べ替えのための時刻と、行の時刻を付与します。
+        行の時刻は入力を開いたMaillogParserの日付の解析(年の繰り上げを含む)で求めるため、
+        入力ごとの年で解析されます。
+        :param reader:  入力を開いたMaillogParser
+        :param rows:    行のイテレータ
+        :return:        (並べ替えの時刻, 行の時刻, 行)
+        """
+        match_date = self.re_date.match
+        dateparse = reader._dateparse
+        skew = datetime.timedelta(seconds=self._skew)
+        last = None
+        for row in rows:
+            s = match_date(row)
+            try:
+                dt = dateparse(s) if s else None
+            except (TypeError, ValueError):
+                dt = None
+
+            if last is not None and (dt is None or dt < last):
+                if dt is not None and last - dt > skew:
+                    self.jumps += 1
+                else:
+                    self.clamped += 1
+                yield last, dt, row
+            else:
+                last = dt
+                yield dt, dt, row
+
+    def _merged(self):
+        """
+        全ての入力の行を時刻順に並べ、行の時刻と共に返します。
+        :return: (行の時刻, 行)のイテレータ
+        """
+        import heapq
+
+        try:
+            streams = []
+            for fn, year in zip(self._inputs, self._years):
+                reader = MaillogParser(fn, year)
+                reader.compressed = self._parser.compressed
+                self._readers.append(reader)
+                streams.append(self._keyed(reader, reader._open_text()))
+
+            # 時刻を読み取れない行が先頭にある場合はNoneになるため、最も古い時刻として扱う
+            oldest = datetime.datetime.min
+            for _, dt, row in heapq.merge(*streams, key=lambda kr: kr[0] or oldest):
+                yield dt, row
+        finally:
+            for reader in self._readers:
+                reader._close_input()
+            self._readers = []
+
+    def lines(self):
+        """
+        全ての入力の行を時刻順に返します。
+        :return: 行のイテレータ
+        """
+        for _, row in self._merged():
+            yield row
+
+    def parse(self):
+        """
+        全ての入力を時刻順に並べてメールログをパースします。
+        :return: 解析が完了したメールログ
+        """
+        try:
+            yield from self._parser.parse_dated_lines(self._merged())
+        finally:
+            if self.jumps:
+                logging.warning("時刻が{0}秒以上戻った行が{1}行ありました。".format(self._skew, self.jumps))
+        return
+
+    def get_noncomplete_maillog(self):
+        return self._parser.get_noncomplete_maillog()
+
+
+class MaillogCorrelator:
+    """
+    ホストやキューIDをまたがるメールログを1つの経路(trace)に結合するクラスです。
+    message_idが一致するレコード、もしくは中継時の「queued as {QUEUE_ID}」で
+    引き渡し先が分かるレコードを同じ経路として扱います。1件のレコードが複数の経路に
+    一致した場合は、それらの経路を1つにまとめます。
+    キューIDはホストごとに重複するため「ホスト名/キューID」で索引を作成します。
+    引き渡し先のホスト名は中継先(relay)のホスト名の先頭のラベルを使用し、
+    ループバックへの中継(コンテンツフィルタなど)は同じホストへの引き渡しとして扱います。
+    時刻は入力ごとに管理し、全ての入力の時刻の最小値からwindow秒を経過した経路を
+    索引から取り除いて出力します。複数のファイルを順に入力する場合は、最後のファイルを
+    読み始めるまで経路を保持するため、保持する経路の数はmax_entriesで制限されます。
+    宛先ごとの配送の試行(MaillogParser.collect_recipients)を記録したメールログを追加してください。
+    """
+    re_queued_as = re.compile(r'queued as (?P<queue_id>[0-9A-Za-z]+)')
+
+    def __init__(self, window=3600, max_entries=100000, inputs=None):
+        """
+        :param window:      経路を保持する時間(秒)
+        :param max_entries: 保持する経路の最大数
+        :param inputs:      addに指定する入力名のリスト(省略した場合は1つの入力として扱う)
+        """
+        self._window = datetime.timedelta(seconds=window)
+        self._max_entries = max_entries
+        # 経路(最終更新順)
+        self._traces = collections.OrderedDict()
+        # message_id -> 経路
+        self._by_msgid = {}
+        # ホスト名/キューID -> 経路 (自身のキューIDと引き渡し先のキューID)
+        self._by_qid = {}
+        # 入力 -> 最新の時刻
+        self._inputs = list(inputs) if inputs else [None]
+        self._clock = {}
+        # 全ての入力の時刻の最小値(全ての入力を読み始めるまではNone)
+        self._watermark = None
+
+    @staticmethod
+    def _qkey(host, qid) -> str:
+        """
+        キューIDの索引のキーを作成します。ホスト名はドメインを除いて小文字にします。
+        :param host:    ホスト名
+        :param qid:     キューID
+        :return:        ホスト名/キューID
+        """
+        return "{0}/{1}".format(host.split(".", 1)[0].lower(), qid)
+
+    def _handoff_keys(self, m):
+        """
+        smtp行の応答メッセージから引き渡し先の「ホスト名/キューID」を取得します。
+        :param m: メールログ
+        :return:  キーのリスト
+        """
+        if "rcpt" in m:
+            attempts = [(a[3], a[4], a[10]) for a in m["rcpt"]]
+        elif len(m["relay_host"]) == len(m["relay_ip"]) == len(m["smtp_message"]):
+            attempts = zip(m["relay_host"], m["relay_ip"], m["smtp_message"])
+        else:
+            # 中継先と応答メッセージの対応が分からない
+            return []
+
+        keys = []
+        for relay_host, relay_ip, msg in attempts:
+            s = self.re_queued_as.search(msg)
+            if not s:
+                continue
+            host = relay_host
+            if relay_ip.startswith("127.") or relay_ip == "::1" or relay_host == "localhost":
+                host = m["host"]
+            key = self._qkey(host, s.group('queue_id'))
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    def _lookup(self, msgid, qkeys):
+        """
+        message_id、キューIDのいずれかが一致する経路を返します。
+        :return: 経路のリスト(重複なし)
+        """
+        found = []
+        if msgid and msgid in self._by_msgid:
+            found.append(self._by_msgid[msgid])
+        for key in qkeys:
+            tr = self._by_qid.get(key)
+            if tr is not None and not any(tr is f for f in found):
+                found.append(tr)
+        return found
+
+    def _join(self, tr, other):
+        """
+        経路otherを経路trにまとめます。
+        """
+        self._traces.pop(id(other), None)
+        tr["records"].extend(other["records"])
+        for msgid in other["msgids"]:
+            tr["msgids"].add(msgid)
+            self._by_msgid[msgid] = tr
+        for key in other["qids"]:
+            tr["qids"].add(key)
+            self._by_qid[key] = tr
+        if not tr["message_id"]:
+            tr["message_id"] = other["message_id"]
+        if other["last"] is not None and (tr["last"] is None or tr["last"] < other["last"]):
+            tr["last"] = other["last"]
+
+    def _advance(self, source, dt):
+        """
+        入力の時刻を進め、全ての入力の時刻の最小値を更新します。
+        """
+        latest = self._clock.get(source)
+        if latest is not None and latest >= dt:
+            return
+        self._clock[source] = dt
+        if len(self._clock) >= len(self._inputs):
+            self._watermark = min(self._clock.values())
+
+    def add(self, m, source=None):
+        """
+        解析済みのメールログを追加します。
+        :param m:       MaillogParserが返すメールログ
+        :param source:  メールログを読み込んだ入力(inputsに指定した名前)
+        :return:        保持期間を過ぎて確定した経路のリスト
+        """
+        msgid = m["message_id"]
+        if msgid == '<>':
+            msgid = ""
+        qkeys = [self._qkey(m["host"], m["queue_id"])] + self._handoff_keys(m)
+        found = self._lookup(msgid, qkeys)
+        if not found:
+            tr = {"message_id": msgid, "records": [], "msgids": set(), "qids": set(), "last": None}
+            self._traces[id(tr)] = tr
+        else:
+            tr = found[0]
+            for other in found[1:]:
+                self._join(tr, other)
+            self._traces.move_to_end(id(tr))
+
+        tr["records"].append(m)
+        if msgid and msgid not in tr["msgids"]:
+            tr["msgids"].add(msgid)
+            self._by_msgid[msgid] = tr
+            if not tr["message_id"]:
+                tr["message_id"] = msgid
+        for key in qkeys:
+            if key not in tr["qids"]:
+                tr["qids"].add(key)
+                self._by_qid[key] = tr
+
+        dt = m["date_end_date"]
+        if dt is not None:
+            if tr["last"] is None or tr["last"] < dt:
+                tr["last"] = dt
+            self._advance(source, dt)
+
+        return self._evict()
+
+    def _remove(self, tr):
+        self._traces.pop(id(tr), None)
+        for msgid in tr["msgids"]:
+            if self._by_msgid.get(msgid) is tr:
+                del self._by_msgid[msgid]
+        for key in tr["qids"]:
+            if self._by_qid.get(key) is tr:
+                del self._by_qid[key]
+        return self._build_trace(tr)
+
+    def _evict(self):
+        done = []
+        while self._traces:
+            tr = next(iter(self._traces.values()))
+            if len(self._traces) > self._max_entries:
+                done.append(self._remove(tr))
+            elif (self._watermark is not None and tr["last"] is not None
+                  and self._watermark - tr["last"] > self._window):
+                done.append(self._remove(tr))
+            else:
+                break
+        return done
+
+    def flush(self):
+        """
+        保持している全ての経路を確定させて返します。
+        :return: 経路のリスト
+        """
+        done = []
+        while self._traces:
+            done.append(self._remove(next(iter(self._traces.values()))))
+        return done
+
+    @staticmethod
+    def _build_trace(tr):
+        """
+        経路の出力形式を作成します。ホップは開始日時順に並べ、ホップごとの
+        処理時間(latency)と前のホップの終了からの待ち時間(wait)を秒で付与します。
+        :param tr: 経路
+        :return:   経路のディクショナリ
+        """
+        records = sorted(tr["records"], key=lambda r: r["date_start_date"] or datetime.datetime.min)
+        hops = []
+        prev_end = None
+        for r in records:
+            start = r["date_start_date"]
+            end = r["date_end_date"]
+            hop = {"host": r["host"], "queue_id": r["queue_id"], "start": start, "end": end,
+                   "parse_end": r["parse_end"], "client_ip": r["client_ip"],
+                   "relay_host": r["relay_host"], "status": r["status"],
+                   "delay": r["delay"], "latency": 0.0, "wait": 0.0}
+            if start is not None and end is not None:
+                hop["latency"] = (end - start).total_seconds()
+                if prev_end is not None:
+                    hop["wait"] = max((start - prev_end).total_seconds(), 0.0)
+                prev_end = end
+            hops.append(hop)
+
+        starts = [h["start"] for h in hops if h["start"] is not None]
+        ends = [h["end"] for h in hops if h["end"] is not None]
+        total = 0.0
+        if starts and ends:
+            total = (max(ends) - min(starts)).total_seconds()
+        return {"message_id": tr["message_id"], "hop_count": len(hops),
+                "start": min(starts) if starts else None, "end": max(ends) if ends else None,
+                "total_latency": total, "hops": hops}
+
+
+class SmtpdEventCollector:
+    """
+    smtpdのイベント(接続、切断、キュー投入前の拒否)を受け取るクラスです。
+    MaillogParser.event_sinkに指定すると、イベントを1行1JSONで書き込み、
+    クライアントのIPアドレスごとに件数と拒否の頻度を集計します。
+    集計するIPアドレスの数はmax_clientsまでに制限し、超えた場合は最も長く
+    イベントのなかったIPアドレスから集計を破棄します。
+    """
+
+    def __init__(self, path=None, max_clients=EVENT_MAX_CLIENTS, window=60):
+        """
+        :param path:        イベントを書き込むファイル(書き込まない場合はNone)
+        :param max_clients: 集計するIPアドレスの最大数
+        :param window:      拒否の頻度(ピーク)を数える時間枠(秒)
+        """
+        if max_clients < 1:
+            raise ValueError("集計するIPアドレスの最大数は1以上を指定してください。")
+        self._fs = None
+        if path:
+            self._fs = open(path, mode='w', buffering=WRITE_BUFFER)
+        self.max_clients = max_clients
+        self.window = window
+        self._clients = collections.OrderedDict()
+        # 集計を破棄したIPアドレスの数
+        self.evicted = 0
+        # イベントの種類ごとの件数
+        self.totals = collections.Counter()
+
+    def __call__(self, ev):
+        """
+        イベントを書き込み、集計に加えます。
+        :param ev:  MaillogParserが作成したイベント
+        :return: なし
+        """
+        if self._fs:
+            self._fs.write(json.dumps(ev, default=support_datetime_default))
+            self._fs.write("\n")
+        self.add(ev)
+
+    def add(self, ev):
+        """
+        イベントを集計に加えます。
+        :param ev:  MaillogParserが作成したイベント
+        :return: なし
+        """
+        self.totals[ev["event"]] += 1
+        ip = ev["client_ip"]
+        if not ip:
+            return
+        dt = ev["date"]
+        st = self._clients.get(ip)
+        if st is None:
+            st = {"client_ip": ip, "client_host": ev["client_host"], "first": dt, "last": dt,
+                  "connect": 0, "disconnect": 0, "reject": 0, "codes": collections.Counter(),
+                  "window_start": dt, "window_rejects": 0, "peak": 0}
+            self._clients[ip] = st
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._clients.move_to_end(ip)
+            if st["last"] < dt:
+                st["last"] = dt
+        st[ev["event"]] += 1
+
+        if ev["event"] == "reject":
+            st["codes"][ev["reject_code"]] += 1
+            # 時間枠ごとの拒否の件数
+            if (dt - st["window_start"]).total_seconds() >= self.window:
+                st["window_start"] = dt
+                st["window_rejects"] = 0
+            st["window_rejects"] += 1
+            if st["peak"] < st["window_rejects"]:
+                st["peak"] = st["window_rejects"]
+
+    def summary(self):
+        """
+        IPアドレスごとの集計を拒否の多い順に返します。
+        reject_per_minは最初から最後のイベントまで(時間枠未満の場合は時間枠)の1分あたりの拒否の件数です。
+        :return: 集計結果のリスト
+        """
+        rows = []
+        for st in self._clients.values():
+            span = max((st["last"] - st["first"]).total_seconds(), self.window)
+            rows.append({
+                "client_ip": st["client_ip"],
+                "client_host": st["client_host"],
+                "connect": st["connect"],
+                "disconnect": st["disconnect"],
+                "reject": st["reject"],
+                "reject_per_min": round(st["reject"] * 60 / span, 3),
+                "peak_per_window": st["peak"],
+                "first": st["first"],
+                "last": st["last"],
+                "codes": ",".join("{0}:{1}".format(k, v) for k, v in st["codes"].most_common()),
+            })
+        rows.sort(key=lambda r: (-r["reject"], -r["connect"], r["client_ip"]))
+        return rows
+
+    def write_summary(self, path):
+        """
+        IPアドレスごとの集計をタブ区切りで書き込みます。
+        :param path:    出力先のファイル
+        :return: なし
+        """
+        cols = ("client_ip", "client_host", "connect", "disconnect", "reject", "reject_per_min",
+                "peak_per_window", "first", "last", "codes")
+        with open(path, mode='w') as fs:
+            fs.write("\t".join(cols))
+            fs.write("\n")
+            for r in self.summary():
+                fs.write("\t".join(
+                    r[c].isoformat() if isinstance(r[c], datetime.datetime) else str(r[c]) for c in cols))
+                fs.write("\n")
+
+    def close(self):
+        """
+        イベントのファイルを閉じます。
+        :return: なし
+        """
+        if self._fs:
+            self._fs.close()
+            self._fs = None
+        logging.info("smtpd events: {0}, clients: {1}, evicted: {2}".format(
+            dict(self.totals), len(self._clients), self.evicted))
+
+
+class ProcessManifest:
+    """
+    処理済みの入力ファイルを記録するマニフェストです。
+    入力ファイルごとにinode、サイズ、更新日時、先頭と末尾のハッシュ、解析を終えた位置、
+    ファイル名、出力先を記録し、変更されていないファイルは解析を省略し、追記されたファイルは
+    前回の続きから解析できるようにします。
+    記録はデバイスとinodeをキーとするため、ローテートで名前が変わったファイルも同じ記録として
+    扱います。名前が変わったファイルの出力先はrelocateで新しい名前に合わせて移動します。
+    追記されたファイルを前回の続きから解析する場合、前回の終わりで解析途中だったログは
+    PendingStoreに保存していなければ、2件に分かれて出力されます。
+    """
+    # ハッシュを計算するバイト数
+    HASH_SIZE = 4096
+
+    def __init__(self, path):
+        """
+        :param path: マニフェストファイルのパス(JSON)
+        """
+        self._path = path
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'rt') as fs:
+                    entries = json.load(fs)
+            except ValueError as ve:
+                logging.warning("マニフェストを読み込めませんでしたが、無視します - {0}".format(ve))
+            else:
+                for key, ent in entries.items():
+                    # ファイル名をキーとしていた記録は、キーをファイル名として保持する
+                    ent.setdefault("path", key)
+                    self._entries[self._key(ent)] = ent
+
+    @staticmethod
+    def _key(fp) -> str:
+        """
+        記録のキー(デバイス:inode)を返します。
+        :param fp:  指紋もしくは記録
+        :return:    キー
+        """
+        return "{0}:{1}".format(fp["dev"], fp["inode"])
+
+    @classmethod
+    def _hash_range(cls, fn, start, end):
+        """
+        ファイルの指定範囲のハッシュを返します。
+        :param fn:      ファイル名
+        :param start:   開始位置
+        :param end:     終了位置
+        :return:        SHA-1(16進数)
+        """
+        with open(fn, 'rb') as fs:
+            fs.seek(start)
+            return hashlib.sha1(fs.read(max(end - start, 0))).hexdigest()
+
+    @classmethod
+    def fingerprint(cls, fn):
+        """
+        ファイルの指紋(inode, サイズ, 更新日時, 先頭のハッシュ)を返します。
+        :param fn: ファイル名
+        :return:   指紋のディクショナリ
+        """
+        st = os.stat(fn)
+        head_size = min(st.st_size, cls.HASH_SIZE)
+        return {"dev": st.st_dev, "inode": st.st_ino, "size": st.st_size, "mtime": st.st_mtime,
+                "head": cls._hash_range(fn, 0, head_size), "head_size": head_size}
+
+    def _same_head(self, fn, fp, ent):
+        """
+        記録された先頭のハッシュとファイルの先頭が一致するか確認します。
+        記録時のファイルがHASH_SIZEより小さい場合は、記録時と同じ範囲で比較します。
+        :param fn:  ファイル名
+        :param fp:  fingerprintで作成した指紋
+        :param ent: 記録
+        :return:    一致する場合はTrue
+        """
+        if fp["head_size"] == ent["head_size"]:
+            return fp["head"] == ent["head"]
+        if fp["size"] < ent["head_size"]:
+            return False
+        return self._hash_range(fn, 0, ent["head_size"]) == ent["head"]
+
+    def _find(self, fn, fp):
+        """
+        デバイスとinodeが一致し、先頭のハッシュが一致する記録を返します。
+        inodeが再利用された別のファイルは先頭のハッシュで区別します。
+        :param fn:  ファイル名
+        :param fp:  fingerprintで作成した指紋
+        :return:    記録(見つからない場合はNone)
+        """
+        ent = self._entries.get(self._key(fp))
+        if ent and self._same_head(fn, fp, ent):
+            return ent
+        return None
+
+    def renamed(self, fn):
+        """
+        前回の処理からファイル名が変わった(ローテートされた)ファイルの記録を返します。
+        :param fn:  ファイル名
+        :return:    記録(名前が変わっていない場合や記録がない場合はNone)
+        """
+        ent = self._find(fn, self.fingerprint(fn))
+        if ent and ent["path"] != os.path.abspath(fn):
+            return ent
+        return None
+
+    def relocate(self, fn, output):
+        """
+        名前が変わったファイルの記録を新しいファイル名と出力先で記録し直します。
+        :param fn:      ファイル名
+        :param output:  移動後の出力先
+        :return: なし
+        """
+        ent = self._find(fn, self.fingerprint(fn))
+        if ent:
+            ent["path"] = os.path.abspath(fn)
+            ent["output"] = output
+
+    def check(self, fn, compressed=False):
+        """
+        ファイルの処理状態を返します。
+            new       : 未処理か内容が変更されたため、先頭から解析する
+            unchanged : 前回から変更されていないため、解析を省略する
+            grown     : 前回の続きに追記されたため、前回の位置から解析する
+        :param fn:          ファイル名
+        :param compressed:  圧縮ファイルかどうか(圧縮ファイルは途中から解析できない)
+        :return:            (状態, 解析を開始する位置, 指紋)
+        """
+        fp = self.fingerprint(fn)
+        ent = self._find(fn, fp)
+        if ent is None or not self._same_head(fn, fp, ent):
+            return "new", 0, fp
+
+        offset = ent["offset"]
+        if fp["size"] == offset and fp["mtime"] == ent["mtime"]:
+            return "unchanged", offset, fp
+
+        if not compressed and fp["size"] > offset > 0 and \
+                self._hash_range(fn, max(offset - self.HASH_SIZE, 0), offset) == ent["tail"]:
+            return "grown", offset, fp
+
+        return "new", 0, fp
+
+    def update(self, fn, fp, offset, output):
+        """
+        処理結果を記録します。
+        :param fn:      ファイル名
+        :param fp:      解析前にcheckで取得した指紋
+        :param offset:  解析を終えた位置(Noneの場合は解析前のサイズ)
+        :param output:  出力先
+        :return: なし
+        """
+        if offset is None:
+            offset = fp["size"]
+        ent = dict(fp)
+        ent["offset"] = offset
+        ent["mtime"] = os.stat(fn).st_mtime
+        ent["tail"] = self._hash_range(fn, max(offset - self.HASH_SIZE, 0), offset)
+        ent["path"] = os.path.abspath(fn)
+        ent["output"] = output
+        self._entries[self._key(fp)] = ent
+
+    def save(self):
+        """
+        マニフェストをファイルに書き込みます。書き込み途中で中断しても
+        壊れないよう、一時ファイルに書き込んでから置き換えます。
+        :return: なし
+        """
+        tmp = "{0}.tmp".format(self._path)
+        with open(tmp, 'wt') as fs:
+            json.dump(self._entries, fs, indent=1, sort_keys=True)
+        os.replace(tmp, self._path)
+
+
+class RecordCache:
+    """
+    解析済みのメールログを入力ファイルごとに保存するキャッシュです。
+    入力ファイルの指紋(ProcessManifest.fingerprint)と、年、圧縮状態、行形式のプロファイルなど
+    解析結果に影響する設定とハンドラのコードからキーを作成し、「{キー}.plc」にメールログを
+    FRAME_SIZE件ずつまとめて1行1JSONで書き込みます。
+    pickleやmarshalのバイナリ形式は不正なデータを読み込んだ場合に安全ではないため、使用しません。
+    日時は{"$dt": [年, 月, 日, 時, 分, 秒, マイクロ秒(, UTCとの差の秒)]}として保存し、
+    宛先ごとの試行のdelaysはタプルに戻します。ハンドラが追加した値のうち、タプルはリストとして読み込まれます。
+    同じファイルを別の出力形式で出力し直す場合は、ファイルを解析せずにキャッシュから読み込みます。
+    組み込みのハンドラが使用する処理を変更した場合はVERSIONを上げてください。
+    """
+    VERSION = 4
+    FRAME_SIZE = 1000
+    SUFFIX = ".plc"
+
+    def __init__(self, directory):
+        """
+        :param directory: キャッシュを保存するディレクトリ
+        """
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _default(o):
+        """
+        JSONに変換できない値(日時)を変換します。PendingStoreでも使用します。
+        """
+        if isinstance(o, datetime.datetime):
+            v = [o.year, o.month, o.day, o.hour, o.minute, o.second, o.microsecond]
+            offset = o.utcoffset()
+            if offset is not None:
+                v.append(offset.total_seconds())
+            return {"$dt": v}
+        raise TypeError("キャッシュに保存できない値です。{0!r}".format(o))
+
+    @staticmethod
+    def _object_hook(d):
+        """
+        _defaultで変換した日時を復元します。
+        """
+        v = d.get("$dt")
+        if v is not None and len(d) == 1:
+            if len(v) == 8:
+                return datetime.datetime(*v[:7], tzinfo=datetime.timezone(datetime.timedelta(seconds=v[7])))
+            return datetime.datetime(*v)
+        return d
+
+    @staticmethod
+    def _restore(m):
+        """
+        JSONから読み込んだメールログの宛先ごとの試行のdelaysをタプルに戻します。
+        :param m:   メールログ
+        :return:    メールログ
+        """
+        i = MaillogParser._rcpt_index["delays"]
+        for r in m.get("rcpt", ()):
+            if r[i] is not None:
+                r[i] = tuple(r[i])
+        return m
+
+    def key(self, mp) -> str:
+        """
+        入力ファイルと解析の設定からキャッシュのキーを作成します。
+        :param mp:  ファイル、圧縮状態、年、行形式のプロファイルを設定済みのMaillogParser
+        :return:    キー(SHA-1の16進数)
+        """
+        fp = ProcessManifest.fingerprint(mp.filepath)
+        src = {
+            "version": self.VERSION,
+            "fingerprint": fp,
+            "year": mp.year,
+            "compressed": mp.compressed,
+            "profile": MaillogParser.line_profiles[mp.line_profile],
+            "handlers": {k: self._handler_version(v) for k, v in mp.service_handlers.items()},
+            "pop": mp.pop_parsed_line,
+            "recipients": mp.collect_recipients,
+        }
+        return hashlib.sha1(json.dumps(src, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def _handler_version(cls, handler) -> str:
+        """
+        ハンドラの名前とコードのハッシュ値を返します。ハンドラを変更すると、変更前のキャッシュは使用されません。
+        :param handler: service_handlersの値(メソッド名か、呼び出し可能なオブジェクト)
+        :return:        「名前:ハッシュ値」
+        """
+        if isinstance(handler, str):
+            handler = getattr(MaillogParser, handler)
+        func = getattr(handler, "__func__", handler)
+        code = getattr(func, "__code__", None)
+        if code is None:
+            # __call__を持つオブジェクト
+            func = type(handler)
+            code = getattr(getattr(func, "__call__", None), "__code__", None)
+        name = getattr(func, "__qualname__", type(func).__qualname__)
+        if code is None:
+            return name
+        h = hashlib.sha1()
+        cls._hash_code(code, h)
+        return "{0}:{1}".format(name, h.hexdigest())
+
+    @classmethod
+    def _hash_code(cls, code, h):
+        """
+        コードオブジェクトのバイトコード、名前、定数(内側の関数を含む)をハッシュに加えます。
+        ファイル名や行番号は含めません。
+        """
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode())
+        for c in code.co_consts:
+            if hasattr(c, "co_code"):
+                cls._hash_code(c, h)
+            else:
+                h.update(repr(c).encode())
+
+    def path(self, key) -> str:
+        return os.path.join(self._directory, key + self.SUFFIX)
+
+    def load(self, mp):
+        """
+        キャッシュが保存されている場合は、キャッシュからメールログを読み込むオブジェクトを返します。
+        :param mp:  ファイル、圧縮状態、年、行形式のプロファイルを設定済みのMaillogParser
+        :return:    CachedRecords、キャッシュがない場合はNone
+        """
+        path = self.path(self.key(mp))
+        if os.path.exists(path):
+            return CachedRecords(path)
+        return None
+
+    def record(self, mp, source):
+        """
+        解析しながらキャッシュに書き込むオブジェクトを返します。
+        :param mp:      ファイル、圧縮状態、年、行形式のプロファイルを設定済みのMaillogParser
+        :param source:  メールログを解析するオブジェクト(MaillogParser, MaillogPipeline)
+        :return:        CachingRecords
+        """
+        return CachingRecords(source, self.path(self.key(mp)), mp.filepath)
+
+
+class CachedRecords:
+    """
+    RecordCacheに保存されたメールログを読み込むクラスです。
+    MaillogParserと同じようにparseとget_noncomplete_maillogでメールログを返します。
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._noncomplete = []
+        self._parsed_count = 0
+        self._end_offset = None
+
+    @property
+    def parsed_count(self):
+        return self._parsed_count
+
+    @property
+    def end_offset(self):
+        return self._end_offset
+
+    @staticmethod
+    def _records(keys, rows):
+        """
+        キーの並びと値の行からメールログを作成します。
+        :param keys:    キーのリスト
+        :param rows:    値のリストのリスト
+        :return:        メールログのリスト
+        """
+        records = [dict(zip(keys, row)) for row in rows]
+        if "rcpt" in keys:
+            for m in records:
+                RecordCache._restore(m)
+        return records
+
+    def parse(self):
+        """
+        キャッシュから解析が完了したメールログを返します。
+        :return: 解析が完了したメールログ
+        """
+        decode = json.JSONDecoder(object_hook=RecordCache._object_hook).decode
+        self._noncomplete = []
+        with open(self._path, 'rt', encoding='utf-8') as fs:
+            header = decode(fs.readline() or "{}")
+            if header.get("version") != RecordCache.VERSION:
+                raise ValueError("キャッシュの形式が異なります。{0}".format(self._path))
+            for line in fs:
+                try:
+                    kind, payload = decode(line)
+                    if kind in ("records", "noncomplete"):
+                        records = self._records(*payload)
+                except (TypeError, KeyError, IndexError) as e:
+                    raise ValueError("キャッシュの内容が正しくありません。{0} - {1}".format(self._path, e))
+                if kind == "records":
+                    yield from records
+                elif kind == "noncomplete":
+                    self._noncomplete.extend(records)
+                else:
+                    self._parsed_count = payload["parsed_count"]
+                    self._end_offset = payload["end_offset"]
+                    return
+        raise ValueError("キャッシュが途中で終わっています。{0}".format(self._path))
+
+    def get_noncomplete_maillog(self):
+        return iter(self._noncomplete)
+
+
+class CachingRecords:
+    """
+    メールログを解析しながらRecordCacheに書き込むクラスです。
+    get_noncomplete_maillogの呼び出しで書き込みを完了します。完了しなかった場合(close)は
+    書き込み途中のファイルを削除します。
+    書き込むまでにメールログが更新されないよう、解析にはpop_parsed_line=Trueを指定してください。
+    """
+
+    def __init__(self, source, path, filepath):
+        self._source = source
+        self._path = path
+        self._tmp = path + ".tmp"
+        self._filepath = filepath
+        self._fs = None
+        self._encode = json.JSONEncoder(default=RecordCache._default, ensure_ascii=False,
+                                        separators=(',', ':')).encode
+
+    @property
+    def parsed_count(self):
+        return self._source.parsed_count
+
+    @property
+    def end_offset(self):
+        return self._source.end_offset
+
+    def _dump(self, kind, payload):
+        self._fs.write(self._encode([kind, payload]))
+        self._fs.write("\n")
+
+    def _dump_records(self, kind, records):
+        """
+        同じキーを持つ連続したメールログを、キーの並びと値の行にまとめて書き込みます。
+        :param kind:    records か noncomplete
+        :param records: メールログのリスト
+        :return: なし
+        """
+        keys = None
+        rows = []
+        for m in records:
+            k = list(m)
+            if k != keys:
+                if rows:
+                    self._dump(kind, [keys, rows])
+                keys = k
+                rows = []
+            rows.append(list(m.values()))
+        if rows:
+            self._dump(kind, [keys, rows])
+
+    def parse(self):
+        """
+        メールログを解析し、解析が完了したメールログをFRAME_SIZE件ずつ書き込みます。
+        :return: 解析が完了したメールログ
+        """
+        self._fs = open(self._tmp, 'wt', encoding='utf-8', buffering=WRITE_BUFFER)
+        self._fs.write(self._encode({"version": RecordCache.VERSION, "path": self._filepath}))
+        self._fs.write("\n")
+        size = RecordCache.FRAME_SIZE
+        buf = []
+        for m in self._source.parse():
+            buf.append(m)
+            yield m
+            if len(buf) >= size:
+                self._dump_records("records", buf)
+                buf = []
+        if buf:
+            self._dump_records("records", buf)
+        return
+
+    def get_noncomplete_maillog(self):
+        """
+        解析が終わっていないメールログを書き込み、キャッシュを完成させます。
+        :return: 解析が終わっていないメールログ
+        """
+        noncomplete = list(self._source.get_noncomplete_maillog())
+        self._dump_records("noncomplete", noncomplete)
+        self._dump("end", {"parsed_count": self.parsed_count, "end_offset": self.end_offset})
+        self._fs.close()
+        self._fs = None
+        os.replace(self._tmp, self._path)
+        return iter(noncomplete)
+
+    def close(self):
+        """
+        書き込みが完了していない場合は、書き込み途中のファイルを削除します。
+        :return: なし
+        """
+        if self._fs is not None:
+            self._fs.close()
+            self._fs = None
+            try:
+                os.remove(self._tmp)
+            except OSError:
+                pass
+
+
+class PendingStore:
+    """
+    解析途中のメールログをファイル(sqlite)に保存するクラスです。
+    「ホスト名/キューID」をキーとして保存し、実行をまたいで後から出力された行を
+    保存したメールログの続きとして解析できるようにします。
+    メールログはRecordCacheと同じ形式のJSONで保存し、読み込み時にコードを実行しないようpickleは使用しません。
+    メモリ上にはmax_memory件までの解析途中のメールログのみを保持し、超えた場合は
+    最も長く行が現れていないものから保存先に移します。
+    最後の行の日時が保存されている最も新しい日時よりexpire_days日以上古いものは
+    期限切れとして解析が終わっていないまま出力します。
+    """
+
+    # 保存する形式を変更した場合は上げてください
+    VERSION = 3
+
+    def __init__(self, path, max_memory=PENDING_MAX_MEMORY, expire_days=6):
+        """
+        :param path:        保存先のファイル(sqlite)
+        :param max_memory:  メモリ上に保持する解析途中のメールログの最大数
+        :param expire_days: 期限切れとする日数
+        """
+        import sqlite3
+        if max_memory < 1:
+            raise ValueError("メモリ上に保持する件数は1以上を指定してください。")
+        self.max_memory = max_memory
+        self.expire_days = expire_days
+        self._encode = json.JSONEncoder(default=RecordCache._default, ensure_ascii=False,
+                                        separators=(',', ':')).encode
+        self._decode = json.JSONDecoder(object_hook=RecordCache._object_hook).decode
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pending "
+                         "(skey TEXT PRIMARY KEY, last_seen REAL, data TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pending_last_seen ON pending (last_seen)")
+        # これまでに解析した最も新しい日時(newest)と、保存の形式(version)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)")
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None:
+            if self._db.execute("SELECT 1 FROM pending LIMIT 1").fetchone():
+                self._db.close()
+                raise ValueError("保存先の形式が異なります。{0}".format(path))
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('version', ?)", (self.VERSION,))
+            self._db.commit()
+        elif row[0] != self.VERSION:
+            self._db.close()
+            raise ValueError("保存先の形式が異なります。{0}".format(path))
+        # 保存されているキー(新しいキューIDごとに問い合わせないよう、キーのみメモリ上に保持する)
+        self._keys = set(r[0] for r in self._db.execute("SELECT skey FROM pending"))
+        # 保存先から読み込んだ件数、保存先に移した件数
+        self.loaded = 0
+        self.spilled = 0
+
+    def take(self, skey):
+        """
+        保存されているメールログを取り出し、保存先から削除します。
+        :param skey:    ホスト名/キューID
+        :return:        メールログ、保存されていない場合はNone
+        """
+        if skey not in self._keys:
+            return None
+        row = self._db.execute("SELECT data FROM pending WHERE skey = ?", (skey,)).fetchone()
+        self._db.execute("DELETE FROM pending WHERE skey = ?", (skey,))
+        self._keys.discard(skey)
+        if row is None:
+            return None
+        self.loaded += 1
+        return self._load(row[0])
+
+    def _load(self, data):
+        """
+        保存したメールログを復元します。
+        :param data:    saveで保存したJSON
+        :return:        メールログ
+        """
+        try:
+            return RecordCache._restore(self._decode(data))
+        except (TypeError, KeyError, IndexError, AttributeError) as e:
+            raise ValueError("保存先の内容が正しくありません。{0}".format(e))
+
+    @staticmethod
+    def _last_seen(ml) -> float:
+        dt = ml["date_end_date"]
+        return dt.timestamp() if dt else 0.0
+
+    def save(self, items):
+        """
+        メールログを保存します。
+        :param items:   (ホスト名/キューID, メールログ)のイテレータ
+        :return: なし
+        """
+        rows = [(skey, self._last_seen(ml), self._encode(ml)) for skey, ml in items]
+        self._db.executemany("INSERT OR REPLACE INTO pending (skey, last_seen, data) VALUES (?, ?, ?)", rows)
+        self._db.commit()
+        self._keys.update(r[0] for r in rows)
+
+    def spill(self, imlogs):
+        """
+        解析途中のメールログがmax_memory件を超えた場合は、最も長く行が現れていないものから保存先に移します。
+        解析済みのメールログはメモリ上から削除します。
+        :param imlogs:  MaillogParserの解析途中のメールログ(行が現れた順のOrderedDict)
+        :return: なし
+        """
+        excess = len(imlogs) - self.max_memory
+        if excess <= 0:
+            return
+        keys = []
+        for skey in imlogs:
+            if len(keys) >= excess:
+                break
+            keys.append(skey)
+        items = [(skey, imlogs.pop(skey)) for skey in keys]
+        items = [(skey, ml) for skey, ml in items if not ml["parse_end"]]
+        self.save(items)
+        self.spilled += len(items)
+
+    def finish(self, records, last_date=None):
+        """
+        解析が終わっていないメールログを保存し、期限切れのメールログを取り出します。
+        期限はこれまでに解析した最も新しい日時(last_date、保存したメールログの最後の行の日時)から数えます。
+        :param records:     解析が終わっていないメールログ
+        :param last_date:   最後に解析した行の日時
+        :return:            期限切れのメールログのリスト
+        """
+        self.save(("{0}/{1}".format(ml["host"], ml["queue_id"]), ml) for ml in records)
+        candidates = [r[0] for r in self._db.execute(
+            "SELECT MAX(last_seen) FROM pending UNION ALL SELECT value FROM meta WHERE key = 'newest'")]
+        if last_date is not None:
+            candidates.append(last_date.timestamp())
+        candidates = [c for c in candidates if c is not None]
+        if not candidates:
+            return []
+        newest = max(candidates)
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('newest', ?)", (newest,))
+        cutoff = newest - self.expire_days * 86400
+        rows = self._db.execute("SELECT skey, data FROM pending WHERE last_seen < ?", (cutoff,)).fetchall()
+        self._db.execute("DELETE FROM pending WHERE last_seen < ?", (cutoff,))
+        self._db.commit()
+        self._keys.difference_update(r[0] for r in rows)
+        return [self._load(r[1]) for r in rows]
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+        logging.info("pending: stored={0}, loaded={1}, spilled={2}".format(len(self._keys), self.loaded, self.spilled))
+
+
+class LatencySketch:
+    """
+    遅延時間(秒)の分布を対数スケールのバケットで保持するヒストグラムです(HDR Histogram方式)。
+    件数が0のバケットは保持しない(バケット番号 -> 件数のディクショナリ)ため、メモリ使用量は
+    値が入ったバケットの数に比例し、件数に関係なく最大でもバケット数(約1000)分です。
+    同じ設定のスケッチ同士はバケットごとの件数を加算するだけで結合できます。
+    パーセンタイルの相対誤差はPRECISION以内です。numpyが必要です。
+    """
+    # 最小値(これ未満は0として扱う)と最大値(これ以上は最大のバケットに入れる)
+    MIN_VALUE = 0.001
+    MAX_VALUE = 1000000.0
+    # 相対誤差
+    PRECISION = 0.01
+
+    def __init__(self, buckets=None):
+        """
+        :param buckets: バケット番号と件数のディクショナリ(保存したスケッチを読み込む場合に指定)
+        """
+        import numpy as np
+        self._np = np
+        self._log_gamma = math.log((1 + self.PRECISION) / (1 - self.PRECISION))
+        # バケット0は最小値未満(0を含む)
+        self._size = int(math.ceil(math.log(self.MAX_VALUE / self.MIN_VALUE) / self._log_gamma)) + 2
+        self.buckets = {}
+        if buckets:
+            for i, c in buckets.items():
+                if not 0 <= i < self._size:
+                    raise ValueError("スケッチのバケット番号が範囲外です。{0}".format(i))
+                if c:
+                    self.buckets[int(i)] = int(c)
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def add_many(self, values):
+        """
+        遅延時間をまとめて追加します。
+        :param values: 遅延時間(秒)のリストかnumpy配列
+        :return: なし
+        """
+        np = self._np
+        v = np.asarray(values, dtype=np.float64)
+        idx = np.zeros(v.shape, dtype=np.int64)
+        pos = v >= self.MIN_VALUE
+        idx[pos] = np.floor(np.log(v[pos] / self.MIN_VALUE) / self._log_gamma).astype(np.int64) + 1
+        np.clip(idx, 0, self._size - 1, out=idx)
+        buckets = self.buckets
+        for i, c in zip(*(a.tolist() for a in np.unique(idx, return_counts=True))):
+            buckets[i] = buckets.get(i, 0) + c
+
+    def merge(self, other):
+        """
+        他のスケッチを結合します。
+        :param other: LatencySketch
+        :return: なし
+        """
+        buckets = self.buckets
+        for i, c in other.buckets.items():
+            buckets[i] = buckets.get(i, 0) + c
+
+    def quantiles(self, qs):
+        """
+        パーセンタイルを返します。バケットの代表値(幾何平均)を返すため、
+        相対誤差はPRECISION以内です。
+        :param qs:  0から1の値のリスト (例: [0.5, 0.95, 0.99])
+        :return:    値のリスト(件数が0の場合はNone)
+        """
+        total = self.count
+        if total == 0:
+            return [None for _ in qs]
+        items = sorted(self.buckets.items())
+        result = []
+        for q in qs:
+            rank = min(max(math.ceil(q * total), 1), total)
+            cum = 0
+            for i, c in items:
+                cum += c
+                if cum >= rank:
+                    break
+            if i == 0:
+                result.append(0.0)
+            else:
+                result.append(float(self.MIN_VALUE * math.exp((i - 0.5) * self._log_gamma)))
+        return result
+
+
+class LatencyAnalyzer:
+    """
+    中継先ホスト・宛先ドメイン・時間枠ごとに遅延時間のスケッチ(LatencySketch)を作成し、
+    p50/p95/p99を出力するクラスです。スケッチは保存と結合ができるため、
+    並列に処理した結果や別の日の結果を、元の値を保持せずにまとめることができます。
+    レコードのdelayは配送行の合計、delaysは配送行の最大値のため使用せず、
+    宛先ごとの配送の試行(rcpt)のdelayとdelaysを、試行の時刻の時間枠で1件ずつ数えます。
+    メールログはMaillogParser.collect_recipientsをTrueにして解析したものを追加してください。
+    """
+    metrics = ("delay", "delay_before_qmanager", "delay_qmanager", "delay_con_setup", "delay_msg_trans")
+    quantiles = (0.5, 0.95, 0.99)
+    # まとめてスケッチに追加する件数
+    FLUSH_SIZE = 4096
+
+    def __init__(self, window=3600):
+        """
+        :param window: 時間枠(秒)。1日(86400)の約数を指定してください。
+        """
+        if window <= 0 or 86400 % window != 0:
+            raise ValueError("時間枠は1日(86400秒)の約数を指定してください。{0}".format(window))
+        self._window = window
+        # (時間枠, 中継先ホスト, 宛先ドメイン, 項目) -> LatencySketch
+        self._sketches = {}
+        # スケッチに追加する前の値
+        self._pending = collections.defaultdict(list)
+        # 直前の時刻と時間枠
+        self._last_dt = None
+        self._last_window = None
+
+    def _window_start(self, dt):
+        if dt == self._last_dt:
+            return self._last_window
+        sec = dt.hour * 3600 + dt.minute * 60 + dt.second
+        start = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        self._last_dt = dt
+        self._last_window = (start + datetime.timedelta(seconds=sec - sec % self._window)).isoformat()
+        return self._last_window
+
+    def add(self, m):
+        """
+        メールログの宛先ごとの配送の試行を追加します。
+        :param m: MaillogParserが返すメールログ(rcptを含むもの)
+        :return: なし
+        """
+        attempts = m.get("rcpt")
+        if attempts is None:
+            raise ValueError("宛先ごとの配送の試行が記録されていません。MaillogParser.collect_recipientsを指定してください。")
+        metrics = self.metrics
+        for a in attempts:
+            if a[0] is None:
+                continue
+            window = self._window_start(a[0])
+            relay = a[3]
+            domain = a[1].rpartition("@")[2].lower()
+            values = (a[6],) + a[7] if a[7] else (a[6],)
+            for metric, value in zip(metrics, values):
+                key = (window, relay, domain, metric)
+                pending = self._pending[key]
+                pending.append(value)
+                if len(pending) >= self.FLUSH_SIZE:
+                    self._sketch(key).add_many(pending)
+                    del self._pending[key]
+
+    def _sketch(self, key):
+        sk = self._sketches.get(key)
+        if sk is None:
+            sk = LatencySketch()
+            self._sketches[key] = sk
+        return sk
+
+    def flush(self):
+        """
+        追加前の値をスケッチに追加します。
+        :return: なし
+        """
+        for key, values in self._pending.items():
+            self._sketch(key).add_many(values)
+        self._pending.clear()
+
+    def merge(self, other):
+        """
+        他のLatencyAnalyzerの結果を結合します。
+        :param other: LatencyAnalyzer
+        :return: なし
+        """
+        if other._window != self._window:
+            raise ValueError("時間枠が一致しないため結合できません。{0} / {1}".format(self._window, other._window))
+        other.flush()
+        for key, sk in other._sketches.items():
+            self._sketch(key).merge(sk)
+
+    def save(self, path):
+        """
+        スケッチをnumpyの.npz形式で保存します。
+        件数が0のバケットは保存せず、(スケッチの番号, バケット番号, 件数)の組で保存します。
+        :param path: ファイル名
+        :return: なし
+        """
+        import numpy as np
+        self.flush()
+        keys = sorted(self._sketches)
+        rows, buckets, counts = [], [], []
+        for i, key in enumerate(keys):
+            for b, c in self._sketches[key].buckets.items():
+                rows.append(i)
+                buckets.append(b)
+                counts.append(c)
+        with open(path, 'wb') as fs:
+            np.savez_compressed(fs, window=np.int64(self._window), keys=np.array([json.dumps(k) for k in keys]),
+                                rows=np.array(rows, dtype=np.int64), buckets=np.array(buckets, dtype=np.int64),
+                                counts=np.array(counts, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        """
+        saveで保存したスケッチを読み込みます。
+        :param path: ファイル名
+        :return: LatencyAnalyzer
+        """
+        import numpy as np
+        with np.load(path, allow_pickle=False) as data:
+            la = cls(int(data["window"]))
+            keys = [tuple(json.loads(str(key))) for key in data["keys"]]
+            if "rows" in data:
+                buckets = [{} for _ in keys]
+                for i, b, c in zip(data["rows"].tolist(), data["buckets"].tolist(), data["counts"].tolist()):
+                    buckets[i][b] = c
+            else:
+                # バケット数分の件数を保存していた形式
+                buckets = [{b: c for b, c in enumerate(row.tolist()) if c} for row in data["counts"]]
+            for key, bk in zip(keys, buckets):
+                la._sketches[key] = LatencySketch(bk)
+        return la
+
+    def report(self):
+        """
+        時間枠・中継先ホスト・宛先ドメイン・項目ごとのパーセンタイルを返します。
+        :return: (時間枠, 中継先ホスト, 宛先ドメイン, 項目, 件数, p50, p95, p99) のリスト
+        """
+        self.flush()
+        rows = []
+        for key in sorted(self._sketches):
+            sk = self._sketches[key]
+            rows.append(key + (sk.count,) + tuple(sk.quantiles(self.quantiles)))
+        return rows
+
+    def write_report(self, path):
+        """
+        パーセンタイルをタブ区切りで書き込みます。
+        :param path: ファイル名
+        :return: なし
+        """
+        with open(path, mode='w', buffering=WRITE_BUFFER) as fs:
+            fs.write("\t".join(["window", "relay_host", "domain", "metric", "count", "p50", "p95", "p99"]))
+            fs.write("\n")
+            for row in self.report():
+                fs.write("\t".join("" if v is None else str(v) for v in row))
+                fs.write("\n")
+
+
+class SyslogReceiver:
+    """
+    UDP/TCPでsyslogを受信し、MaillogParserで解析してMaillogWriterに書き込むクラスです。
+    RFC 3164(BSD syslog)とRFC 5424の形式、TCPの改行区切りとoctet-counting(RFC 6587)に対応します。
+    受信した行は上限のあるキューに入れ、まとめてparse_linesに渡します。
+    キューが一杯の場合、UDPは破棄(dropped)し、TCPは読み込みを止めて送信元を待たせます(backpressure)。
+    解析できない行(日付の誤りなど)はその行のみを読み飛ばし、errorsに数えます。
+    待ち受けているアドレスはudp_address, tcp_addressで参照できます(ポート0を指定した場合の確認用)。
+    """
+    re_rfc5424 = re.compile(
+        r'^<\d{1,3}>1 (?P<ts>\S+) (?P<host>\S+) (?P<app>\S+) (?P<procid>\S+) \S+ (?:-|(?:\[(?:[^\]\\]|\\.)*\])+) ?'
+        r'(?:\ufeff)?(?P<msg>.*)$')
+    re_pri = re.compile(r'^<\d{1,3}>')
+
+    def __init__(self, parser, writer, queue_size=100000, batch_size=1000):
+        """
+        :param parser:      MaillogParser
+        :param writer:      接続済みのMaillogWriter
+        :param queue_size:  受信した行を保持する上限
+        :param batch_size:  まとめて解析する行数
+        """
+        self._parser = parser
+        self._writer = writer
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._queue = None
+        # 受信した行数、破棄した行数、キューが一杯で待たせた回数、書き込んだ件数
+        self.received = 0
+        self.dropped = 0
+        self.backpressure = 0
+        self.written = 0
+        self.errors = 0
+        # 待ち受けているアドレス
+        self.udp_address = None
+        self.tcp_address = None
+        # 解析中の行の位置
+        self._pos = 0
+
+    def to_line(self, data):
+        """
+        受信したsyslogメッセージをログファイルと同じ形式の行に変換します。
+        RFC 5424の場合は「{TIMESTAMP} {HOST} {APP}[{PROCID}]: {MSG}」に変換します。
+        PROCIDがない(-)場合は、行の形式に合わせて0とします(プロセスIDは解析に使用しません)。
+        :param data: 受信したメッセージ(文字列)
+        :return:     行
+        """
+        data = data.rstrip("\r\n\x00")
+        if data[:1] != "<":
+            return data
+        s = self.re_rfc5424.match(data)
+        if s:
+            procid = s.group('procid')
+            return "{0} {1} {2}[{3}]: {4}".format(
+                s.group('ts'), s.group('host'), s.group('app'), "0" if procid == "-" else procid, s.group('msg'))
+        return self.re_pri.sub("", data, 1)
+
+    def _put_nowait(self, data):
+        self.received += 1
+        try:
+            self._queue.put_nowait(self.to_line(data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _put(self, data):
+        self.received += 1
+        if self._queue.full():
+            self.backpressure += 1
+        await self._queue.put(self.to_line(data))
+
+    async def _handle_tcp(self, reader, writer):
+        """
+        TCPの接続ごとにメッセージを読み込みます。
+        「数字 空白 <」で始まる場合はoctet-counting(メッセージはPRIで始まる)、それ以外は改行区切りとして扱います。
+        PRIのない行(RFC 3339形式の日付で始まる行など)は先頭が数字でも改行区切りとなります。
+        """
+        try:
+            while True:
+                c = await reader.readexactly(1)
+                if c.isdigit():
+                    token = c + await reader.readuntil(b' ')
+                    c = await reader.readexactly(1)
+                    if token[:-1].isdigit() and c == b'<':
+                        data = c + await reader.readexactly(int(token[:-1]) - 1)
+                    else:
+                        data = token + c + await reader.readuntil(b'\n')
+                else:
+                    data = c + await reader.readuntil(b'\n')
+                await self._put(data.decode('utf-8', 'replace'))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (asyncio.LimitOverrunError, ValueError) as e:
+            logging.warning("syslogメッセージを読み込めないため切断します - {0}".format(e))
+        finally:
+            writer.close()
+
+    def _feed(self, rows, start):
+        """
+        行を順に返し、返した行の位置を記録します。
+        """
+        for i in range(start, len(rows)):
+            self._pos = i
+            yield rows[i]
+
+    def _parse(self, rows):
+        """
+        行を解析して書き込みます。解析できない行があった場合は、その行の次から解析し直します。
+        :param rows: 行のリスト
+        :return: なし
+        """
+        records = []
+        start = 0
+        while start < len(rows):
+            self._pos = start
+            try:
+                for ml in self._parser.parse_lines(self._feed(rows, start)):
+                    records.append(ml)
+                break
+            except (ValueError, TypeError) as e:
+                # 日付の誤りなどで解析できない行のみを読み飛ばす
+                self.errors += 1
+                logging.warning("受信した行を解析できませんでしたが、無視します - {0}".format(e))
+                start = self._pos + 1
+        self._writer.insert_many(records)
+        self.written += len(records)
+
+    async def _consume(self):
+        """
+        キューから行をまとめて取り出し、解析して書き込みます。
+        """
+        while True:
+            rows = [await self._queue.get()]
+            while len(rows) < self._batch_size and not self._queue.empty():
+                rows.append(self._queue.get_nowait())
+            self._parse(rows)
+
+    def _drain(self):
+        """
+        キューに残っている行を解析して書き込みます。
+        """
+        rows = []
+        while not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        self._parse(rows)
+
+    def stats(self):
+        return "received={0} dropped={1} backpressure={2} written={3} errors={4} queued={5}".format(
+            self.received, self.dropped, self.backpressure, self.written, self.errors,
+            self._queue.qsize() if self._queue else 0)
+
+    async def serve(self, udp=None, tcp=None, duration=None, stats_interval=60):
+        """
+        受信を開始します。
+        :param udp:             UDPで待ち受ける(ホスト, ポート)
+        :param tcp:             TCPで待ち受ける(ホスト, ポート)
+        :param duration:        受信を続ける秒数(Noneの場合はキャンセルされるまで)
+        :param stats_interval:  受信状況をログに出力する間隔(秒)
+        :return: なし
+        """
+        # get_running_loopはPython 3.7以降
+        loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)()
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        receiver = self
+        transport = None
+        server = None
+
+        class _UdpProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                receiver._put_nowait(data.decode('utf-8', 'replace'))
+
+        if udp:
+            transport, _ = await loop.create_datagram_endpoint(_UdpProtocol, local_addr=udp)
+            self.udp_address = transport.get_extra_info('sockname')[:2]
+            logging.info("UDP {0}:{1} で受信を開始します。".format(*self.udp_address))
+        if tcp:
+            server = await asyncio.start_server(self._handle_tcp, tcp[0], tcp[1])
+            self.tcp_address = server.sockets[0].getsockname()[:2]
+            logging.info("TCP {0}:{1} で受信を開始します。".format(*self.tcp_address))
+
+        consumer = loop.create_task(self._consume())
+        try:
+            end = None if duration is None else loop.time() + duration
+            while end is None or loop.time() < end:
+                wait = stats_interval if end is None else min(stats_interval, end - loop.time())
+                done, _ = await asyncio.wait([consumer], timeout=max(wait, 0))
+                if done:
+                    # 書き込みの失敗などで解析が止まった場合は受信を止め、例外を送出する
+                    break
+                logging.info("syslog: {0}".format(self.stats()))
+        finally:
+            if transport:
+                transport.close()
+            try:
+                if server:
+                    server.close()
+                    await server.wait_closed()
+            finally:
+                # 待ち受けを閉じる途中で再度キャンセルされても、受信済みの行は書き込む
+                consumer.cancel()
+                try:
+                    await consumer
+                except asyncio.CancelledError:
+                    pass
+                self._drain()
+
+
+class ParseProfiler:
+    """
+    解析処理のプロファイルを取得するクラスです。
+    cProfile(cprofile)か、一定間隔でスタックを記録するサンプリング(sample)で実行全体を記録し、
+    入力ファイルごとに工程(read, decompress, match, date, parse, write)別の経過時間とCPU時間を計測します。
+    工程別の時間は、MaillogParser.profilerに設定(attach)したプロファイラが各工程を計測し、1回のパスで求めます。
+    圧縮ファイルの読み取りはdecompress、メモリマップの読み取りはmatchに含まれます。
+    writeはWriterのinsertの時間を計測します。
+    行の読み取りとマッチはCHUNK_SIZE行ずつまとめて計測しますが、日付の解析とメールログの組み立ては
+    呼び出しごとに計測するため、工程別の時間には計測自体の時間が含まれます。
+    cprofileの場合はcProfileによる遅れも含まれるため、工程別の時間の比較にはsampleを使用してください。
+    結果は「{prefix}.stats」(cProfile)、「{prefix}.folded」(フレームグラフ用のスタック)と
+    入力サイズを付与した「{prefix}.json」に保存されます。
+    ワーカープロセス(--workers)内の処理はcProfileとサンプリングの対象外です。
+    """
+    stages = ("read", "decompress", "match", "date", "parse", "write")
+    # 行の読み取りとマッチをまとめて計測する行数
+    CHUNK_SIZE = 1000
+
+    def __init__(self, prefix, mode="cprofile", interval=PROFILE_SAMPLE_INTERVAL):
+        """
+        :param prefix:      出力ファイル名の接頭辞
+        :param mode:        cprofile か sample
+        :param interval:    サンプリングの間隔(秒)
+        """
+        if mode not in ("cprofile", "sample"):
+            raise ValueError("プロファイルの形式が正しくありません。{0}".format(mode))
+        if mode == "sample" and not self.sampling_available():
+            raise ValueError("この環境ではサンプリング(SIGPROF)を使用できません。cprofileを指定してください。")
+        self.prefix = prefix
+        self.mode = mode
+        self.interval = interval
+        self._profile = None
+        self._samples = collections.Counter()
+        self._times = {k: [0.0, 0.0] for k in self.stages}
+        self._inputs = []
+        self._wall = None
+        self._cpu = None
+        # 計測した工程の経過時間とCPU時間の合計(CPU時間の配分に使用する)
+        self._parsing = [0.0, 0.0]
+        # 解析中の入力ファイルの情報
+        self._entry = None
+        # 計測済みの経過時間の合計と、計測中の呼び出しの深さ
+        self._measured = 0.0
+        self._depth = 0
+
+    @staticmethod
+    def sampling_available():
+        """
+        サンプリング(sample)に使用するSIGPROFとsetitimerはWindowsなどでは使用できません。
+        :return: サンプリングを使用できる場合はTrue
+        """
+        import signal
+        return hasattr(signal, "SIGPROF") and hasattr(signal, "setitimer")
+
+    def start(self):
+        """
+        プロファイルの記録を開始します。
+        :return: なし
+        """
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._resume()
+
+    def stop(self):
+        """
+        プロファイルの記録を終了します。
+        :return: なし
+        """
+        self._pause()
+        self._wall = time.perf_counter() - self._wall
+        self._cpu = time.process_time() - self._cpu
+
+    def _resume(self):
+        if self.mode == "cprofile":
+            if self._profile is None:
+                import cProfile
+                self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            import signal
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def _pause(self):
+        if self.mode == "cprofile":
+            self._profile.disable()
+        else:
+            import signal
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def _sample(self, signum, frame):
+        """
+        SIGPROFのハンドラです。割り込まれた時点のスタックを記録します。
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{0} ({1}:{2})".format(
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self._samples[";".join(reversed(stack))] += 1
+
+    def attach(self, mp):
+        """
+        MaillogParserに工程別の時間の計測を設定し、入力ファイルの情報を記録します。
+        MaillogParserはparseの各工程(行の読み取り、マッチ、日付の解析、メールログの組み立て)を
+        timed_iter、timed_callを通して呼び出すため、実際の解析と同じ1回のパスで工程別の時間を計測します。
+        状態を引き継いで次のファイルを解析する場合は、ファイルごとに呼び出してください。
+        :param mp:  ファイル、圧縮状態、年などを設定済みのMaillogParser
+        :return: なし
+        """
+        size = os.path.getsize(mp.filepath)
+        self._entry = {"path": mp.filepath, "bytes": size if mp.compressed else size - mp.start_offset,
+                       "compressed": mp.compressed, "lines": 0, "records": 0}
+        self._inputs.append(self._entry)
+        mp.profiler = self
+
+    def timed_iter(self, stage, it, counter=None, chunk=CHUNK_SIZE):
+        """
+        イテレータから要素を取り出す時間を工程の時間として計測します。
+        行のように数の多いものはchunk件ずつまとめて取り出し、計測の回数を減らします。
+        経過時間は内側で計測した工程の時間を差し引いて加算し、CPU時間は最も外側の計測でのみ求めます。
+        :param stage:   工程名(stagesのいずれか)
+        :param it:      計測するイテレータ
+        :param counter: 取り出した件数を加算する入力ファイルの項目(lines, records)
+        :param chunk:   まとめて取り出す件数
+        :return:        要素のイテレータ
+        """
+        perf_counter = time.perf_counter
+        process_time = time.process_time
+        t = self._times[stage]
+        total = self._parsing
+        entry = self._entry
+        it = iter(it)
+        while True:
+            outer = not self._depth
+            self._depth += 1
+            m0 = self._measured
+            if outer:
+                c = process_time()
+            w = perf_counter()
+            try:
+                items = list(islice(it, chunk))
+            finally:
+                elapsed = perf_counter() - w
+                own = elapsed - (self._measured - m0)
+                t[0] += own
+                self._measured += own
+                self._depth -= 1
+                if outer:
+                    total[0] += elapsed
+                    total[1] += process_time() - c
+            if not items:
+                return
+            if counter:
+                entry[counter] += len(items)
+            yield from items
+
+    def timed_call(self, stage, func):
+        """
+        関数の呼び出しを工程の時間として計測する関数を返します。
+        :param stage:   工程名(stagesのいずれか)
+        :param func:    計測する関数
+        :return:        計測する関数
+        """
+        perf_counter = time.perf_counter
+        t = self._times[stage]
+
+        def timed_func(*args):
+            w = perf_counter()
+            try:
+                return func(*args)
+            finally:
+                own = perf_counter() - w
+                t[0] += own
+                self._measured += own
+        return timed_func
+
+    def wrap_writer(self, mtw):
+        """
+        Writerのinsertとinsert_manyを、書き込みの時間を計測する関数に置き換えます。
+        :param mtw: MaillogWriter
+        :return: なし
+        """
+        if getattr(mtw, "_profiled", False):
+            return
+        t = self._times["write"]
+        perf_counter = time.perf_counter
+        process_time = time.process_time
+
+        # insert_manyの中からinsertを呼び出す場合に二重に数えないよう、呼び出しの深さを記録する
+        depth = [0]
+
+        def timed(func):
+            def timed_func(arg):
+                if depth[0]:
+                    return func(arg)
+                depth[0] += 1
+                w = perf_counter()
+                c = process_time()
+                try:
+                    return func(arg)
+                finally:
+                    t[0] += perf_counter() - w
+                    t[1] += process_time() - c
+                    depth[0] -= 1
+            return timed_func
+
+        mtw.insert = timed(mtw.insert)
+        mtw.insert_many = timed(mtw.insert_many)
+        mtw._profiled = True
+
+    def report(self):
+        """
+        プロファイルの概要を返します。
+        :return: 概要のディクショナリ
+        """
+        # write以外の工程のCPU時間は、計測した工程全体のCPU時間を経過時間の比で配分する
+        wall, cpu = self._parsing
+        ratio = cpu / wall if wall else 0.0
+        stages = {}
+        for k, v in self._times.items():
+            c = v[1] if k == "write" else v[0] * ratio
+            stages[k] = {"wall": round(v[0], 6), "cpu": round(c, 6)}
+        return {
+            "created": datetime.datetime.now().isoformat(),
+            "mode": self.mode,
+            "input_bytes": sum(i["bytes"] for i in self._inputs),
+            "input_lines": sum(i["lines"] for i in self._inputs),
+            "records": sum(i["records"] for i in self._inputs),
+            "inputs": self._inputs,
+            "total": {"wall": self._wall, "cpu": self._cpu},
+            "stages": stages,
+        }
+
+    def save(self):
+        """
+        プロファイルを保存し、工程別の時間を出力します。
+        :return: 保存した概要のディクショナリ
+        """
+        report = self.report()
+        if self.mode == "cprofile":
+            self._profile.dump_stats(self.prefix + ".stats")
+            report["profile"] = self.prefix + ".stats"
+        else:
+            with open(self.prefix + ".folded", mode='w') as fs:
+                for stack, n in self._samples.most_common():
+                    fs.write("{0} {1}\n".format(stack, n))
+            report["profile"] = self.prefix + ".folded"
+        with open(self.prefix + ".json", mode='w') as fs:
+            json.dump(report, fs, indent=2)
+
+        logging.info("=Profile=== {0} bytes, {1} lines, {2} records".format(
+            report["input_bytes"], report["input_lines"], report["records"]))
+        for k in self.stages:
+            v = report["stages"][k]
+            logging.info(" {0:<11}: wall {1:.3f}s cpu {2:.3f}s".format(k, v["wall"], v["cpu"]))
+        logging.info(" {0:<11}: wall {1:.3f}s cpu {2:.3f}s".format("total", self._wall, self._cpu))
+        return report
+
+
+def parse_listen(value):
+    """
+    --listen の指定(udp://0.0.0.0:514,tcp://0.0.0.0:514)を解析します。
+    :param value: 待ち受けの指定
+    :return:      (UDPの(ホスト, ポート), TCPの(ホスト, ポート))
+    """
+    udp = tcp = None
+    for item in value.split(","):
+        proto, _, addr = item.partition("://")
+        host, _, port = addr.rpartition(":")
+        if not port.isdigit() or proto not in ("udp", "tcp"):
+            raise ValueError("待ち受けの指定が正しくありません。{0}".format(item))
+        if proto == "udp":
+            udp = (host or "0.0.0.0", int(port))
+        else:
+            tcp = (host or "0.0.0.0", int(port))
+    return udp, tcp
+
+
+def arg_parse() -> argparse.Namespace:
+    """
+    コマンドライン引数を解析します。
+    :return: コマンドライン引数(argparse.Namespace)
+    """
+
+    # コマンドライン引数の取得
+    p = argparse.ArgumentParser()
+
+    # 対象ログファイル
+    p.add_argument(
+        '--inputs',
+        help='対象となるログファイル (ワイルドカードの利用可。)'
+    )
+
+    # syslogの受信
+    p.add_argument(
+        '--listen',
+        help='ログファイルの代わりにsyslogを受信する (例: udp://0.0.0.0:514,tcp://0.0.0.0:514)'
+    )
+
+    # syslogを受信する秒数
+    p.add_argument(
+        '--listen-duration',
+        dest='listen_duration',
+        help='syslogを受信する秒数(指定しない場合は中断されるまで受信する)',
+        type=int
+    )
+
+    # 受信した行を保持する上限
+    p.add_argument(
+        '--listen-queue',
+        dest='listen_queue',
+        help='受信した行を保持する上限(超えた場合、UDPは破棄しTCPは送信元を待たせる)',
+        type=int,
+        default=100000
+    )
+
+    # 圧縮ファイルかどうかのフラグ
+    p.add_argument(
+        '--compressed',
+        dest='compressed',
+        help='対象ファイルが圧縮ファイルかどうか.(Y or N)',
+        choices=["Y", "N"],
+        default="N"
+    )
+
+    # 出力先ディレクトリ
+    p.add_argument(
+        '--output',
+        help='出力先のディレクトリの指定もしくはデータベースとのコネクション文字列を指定',
+        required=True
+    )
+
+    # 西暦
+    p.add_argument(
+        '--year',
+        help='記録された年を指定',
+        type=int,
+        metavar='Y'
+    )
+
+    #
+    p.add_argument(
+        '--yearfromctime',
+        dest='yearfromctime',
+        help='Use year from ctime.',
+        action='store_true'
+    )
+
+    # 出力形式の指定
+    p.add_argument(
+        '--export-type',
+        dest='type',
+        help='出力ファイルのフォーマット(TSV,JSON,ORIG,RCPT,ELS,ELSwG)',
+        default='ORIG',
+        choices=['TSV', 'JSON', 'ORIG', 'RCPT', 'ELS', 'ELSwG']
+    )
+
+    # メモリマップ
+    p.add_argument(
+        '--mmap',
+        dest='mmap',
+        help='非圧縮ファイルをメモリマップし、マッチした行のみを文字列に変換して解析する'
+             '(postfix以外の行が多いログ向け。postfixの行のみのログでは遅くなる)',
+        action='store_true'
+    )
+
+    # 行形式のプロファイル
+    p.add_argument(
+        '--line-profile',
+        dest='line_profile',
+        help='行形式のプロファイル',
+        choices=list(MaillogParser.line_profiles),
+        default='default'
+    )
+
+    # syslog_name (カンマ区切りで複数指定可)
+    p.add_argument(
+        '--syslog-names',
+        dest='syslog_names',
+        help='syslog_nameをカンマ区切りで指定 (例: postfix,postfix-out)'
+    )
+
+    # キューIDの形式
+    p.add_argument(
+        '--queue-id-style',
+        dest='queue_id_style',
+        help='キューIDの形式(short:16進数, long:enable_long_queue_ids, both:両方)',
+        choices=list(MaillogParser.re_qid_styles)
+    )
+
+    # 集計のみ
+    p.add_argument(
+        '--stats-only',
+        dest='stats_only',
+        help='レコードを出力せず、メッセージ数、宛先数、バイト数、配送結果ごとの件数のみを表示する',
+        action='store_true'
+    )
+
+    # 遅延時間のパーセンタイル
+    p.add_argument(
+        '--latency-report',
+        dest='latency_report',
+        help='中継先ホスト・宛先ドメイン・時間枠ごとの遅延時間のパーセンタイルをタブ区切りで出力するファイル(numpyが必要)',
+        metavar='FILE'
+    )
+
+    # パーセンタイルの時間枠
+    p.add_argument(
+        '--latency-window',
+        dest='latency_window',
+        help='パーセンタイルを集計する時間枠(秒)',
+        type=int,
+        default=3600
+    )
+
+    # 遅延時間のスケッチの保存先
+    p.add_argument(
+        '--latency-state',
+        dest='latency_state',
+        help='遅延時間のスケッチを保存するファイル(.npz)。既に存在する場合は読み込んで結合する',
+        metavar='FILE'
+    )
+
+    # 結合する遅延時間のスケッチ
+    p.add_argument(
+        '--latency-merge',
+        dest='latency_merge',
+        help='結合する遅延時間のスケッチ(.npz)を指定 (ワイルドカードの利用可。)',
+        metavar='FILES'
+    )
 
-        for row in self._file_object:
-            # 行をパースする(date, host, proc, queue_id, message)
-            s = pat_postfix.search(row)
-            # マッチした場合のみ処理を行う
-            if s:
-                proc = s.group('proc')  # groupで何度も直接参照すると遅い
-                # プロセスが smtpd、cleanup、qmgr、smtp, local の場合は下記の処理を実行する
-                if proc == 'smtpd' or proc == 'cleanup' or proc == 'qmgr' or proc == 'smtp' or proc == 'local':
-
-                    # 既存の解析済みログに含まれるか確認する
-                    qid = s.group('queue_id')
-                    skey = "{0}/{1}".format(s.group("host"), qid)
-                    if skey in self._imlogs:
-                        ml = self._imlogs[skey]
-                    else:
-                        ml = self._create_mlog()
-                        ml["queue_id"] = qid
-                        self._imlogs[skey] = ml
-
-                    # 日付(strptimeの処理コストが高いため変更) - 0.4
-                    dt = self._dateparse(s)
-                    if ml["date_start_date"] is None:
-                        ml["date_start_date"] = dt
-                        ml["date_end_date"] = dt
-                    elif ml["date_end_date"] < dt:
-                        ml["date_end_date"] = dt
-                    elif ml["date_start_date"] > dt:
-                        ml["date_start_date"] = dt
-
-                    # プロセス
-                    ml["proc"].append(proc)
-
-                    # ホスト名
-                    ml["host"] = s.group('host')
-
-                    # プロセスがsmtpdだった場合の処理
-                    if proc == 'smtpd':
-                        for store in s.group('message').split(", "):
-                            self._parse_smtpd_line(ml, store)
-
-                    # プロセスがcleanupだった場合の処理
-                    elif proc == 'cleanup':
-                        for store in s.group('message').split(", "):
-                            self._parse_cleanup_line(ml, store)
-
-                    # プロセスがqmgrだった場合の処理
-                    elif proc == 'qmgr':
-                        for store in s.group('message').split(", "):
-                            if self._parse_qmgr_line(ml, store):
-                                yield ml
-                                # 不要になった配列を削除する
-                                if self._pop_parsed_line:
-                                    self._imlogs.pop(skey)
-
-                    # プロセスがsmtpだった場合の処理
-                    elif proc == 'smtp':
-                        for store in s.group('message').split(", "):
-                            self._parse_smtp_line(ml, store)
-
-                    # プロセスがlocalだった場合の処理
-                    elif proc == 'local':
-                        for store in s.group('message').split(", "):
-                            self._parse_local_line(ml, store)
-
-                            # プロセスがPickupだった場合は無視(uidが必要な場合は解析する)
-                            # elif s.group('proc') == 'pickup':
-                            # pass
-
-                            # プロセスがscacheだった場合は無視
-                            # 下記の情報が有用だった場合は追加で解析する
-                            # domain lookup hits=x miss=x success=x%
-                            # address lookup hits=x miss=x success=x%
-                            # max simultaneous domains=x addresses=x connection=x
-                            # elif s.group('proc') == 'scache':
-                            #    pass
-
-                            # elif s.group('proc') == 'anvil':
-                            #    pass
-
-                            # elif s.group('proc') == 'trivial-rewrite':
-                            #    pass
-
-                            # else:
-                            #    pass
-            else:
-                pass
+    # まとめて書き込む件数
+    p.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        help='Writerにまとめて渡すレコードの件数',
+        type=int,
+        default=WRITE_BATCH_SIZE
+    )
 
-        self._file_object.close()
-        return
+    # 日付とホスト名で振り分けて出力
+    p.add_argument(
+        '--partition',
+        dest='partition',
+        help='出力先のディレクトリに{日付}/{ホスト名}.{拡張子}の形式で振り分けて出力する(TSV,JSON,ORIG,RCPT)',
+        action='store_true'
+    )
 
-    def get_noncomplete_maillog(self):
-        for m in self._imlogs.values():
-            if m["parse_end"] == False:
-                yield m
+    # 振り分け出力で同時に開くファイル数
+    p.add_argument(
+        '--partition-handles',
+        dest='partition_handles',
+        help='振り分け出力で同時に開くファイルの最大数',
+        type=int,
+        default=PARTITION_MAX_HANDLES
+    )
 
+    # 処理済みファイルのマニフェスト
+    p.add_argument(
+        '--manifest',
+        help='処理済みファイルを記録するマニフェストファイルを指定。変更のないファイルは省略し、追記されたファイルは続きから解析する',
+        metavar='FILE'
+    )
 
-def arg_parse() -> argparse.Namespace:
-    """
-    コマンドライン引数を解析します。
-    :return: コマンドライン引数(argparse.Namespace)
-    """
+    # ローテートされたファイル間で解析途中の状態を引き継ぐ
+    p.add_argument(
+        '--carryover',
+        dest='carryover',
+        help='対象ファイルを更新日時の古い順に1つのパーサーで解析し、ファイルをまたがるログを1件にまとめる',
+        action='store_true'
+    )
 
-    # コマンドライン引数の取得
-    p = argparse.ArgumentParser()
+    # 解析に使用するプロセス数
+    p.add_argument(
+        '--workers',
+        help='1つの入力をキューIDで振り分けて解析するワーカープロセスの数',
+        type=int,
+        default=1,
+        metavar='N'
+    )
 
-    # 対象ログファイル
+    # smtpdのイベントの出力先
     p.add_argument(
-        '--inputs',
-        help='対象となるログファイル (ワイルドカードの利用可。)',
-        required=True
+        '--events',
+        help='キューIDを持たないsmtpdのイベント(接続、切断、拒否)を1行1JSONで出力するファイルを指定',
+        metavar='FILE'
     )
 
-    # 圧縮ファイルかどうかのフラグ
+    # クライアントごとの集計の出力先
     p.add_argument(
-        '--compressed',
-        dest='compressed',
-        help='対象ファイルが圧縮ファイルかどうか.(Y or N)',
-        choices=["Y", "N"],
-        default="N"
+        '--event-summary',
+        dest='event_summary',
+        help='クライアントのIPアドレスごとの接続数、拒否数、拒否の頻度を出力するファイル(タブ区切り)を指定',
+        metavar='FILE'
     )
 
-    # 出力先ディレクトリ
+    # 集計するクライアントの数
     p.add_argument(
-        '--output',
-        help='出力先のディレクトリの指定もしくはデータベースとのコネクション文字列を指定',
-        required=True
+        '--event-clients',
+        dest='event_clients',
+        help='集計するクライアントのIPアドレスの最大数(超えた場合は古いものから破棄する)',
+        type=int,
+        default=EVENT_MAX_CLIENTS
     )
 
-    # 西暦
+    # 拒否の頻度を数える時間枠
     p.add_argument(
-        '--year',
-        help='記録された年を指定',
+        '--event-window',
+        dest='event_window',
+        help='拒否の頻度(ピーク)を数える時間枠(秒)',
         type=int,
-        metavar='Y'
+        default=60
     )
 
-    #
+    # プロファイルの保存先
     p.add_argument(
-        '--yearfromctime',
-        dest='yearfromctime',
-        help='Use year from ctime.',
+        '--profile',
+        help='プロファイルを保存するファイル名の接頭辞({prefix}.stats, {prefix}.json)',
+        default='plp' if PROFILE_FLAG else None,
+        metavar='PREFIX'
+    )
+
+    # プロファイルの形式
+    p.add_argument(
+        '--profile-mode',
+        dest='profile_mode',
+        help='cprofile: cProfileで記録する, sample: 一定間隔でスタックを記録する(.folded)',
+        choices=['cprofile', 'sample'],
+        default='cprofile'
+    )
+
+    # 複数のホストのログを時刻順に並べる
+    p.add_argument(
+        '--merge',
+        help='対象ファイルを時刻順に並べて1つのパーサーで解析し、merged.txtに出力する',
         action='store_true'
     )
 
-    # 出力形式の指定
+    # 許容する時刻の戻り
     p.add_argument(
-        '--export-type',
-        dest='type',
-        help='出力ファイルのフォーマット(TSV,JSON,ORIG,ELS,ELSwG)',
-        default='ORIG',
-        choices=['TSV', 'JSON', 'ORIG', 'ELS', 'ELSwG']
+        '--merge-skew',
+        dest='merge_skew',
+        help='--mergeで警告せずに許容する時刻の戻り(秒)',
+        type=int,
+        default=MERGE_MAX_SKEW
+    )
+
+    # 解析済みレコードのキャッシュ
+    p.add_argument(
+        '--cache-dir',
+        dest='cache_dir',
+        help='解析済みのレコードを保存するディレクトリ。変更されていないファイルは解析せずに保存したレコードを出力する',
+        metavar='DIR'
+    )
+
+    # 解析途中のログの保存先
+    p.add_argument(
+        '--pending-store',
+        dest='pending_store',
+        help='解析が終わっていないログを保存するファイル(sqlite)を指定。次回以降の実行で続きの行と結合する',
+        metavar='FILE'
+    )
+
+    # メモリ上に保持する解析途中のログの数
+    p.add_argument(
+        '--pending-memory',
+        dest='pending_memory',
+        help='メモリ上に保持する解析途中のログの最大数(超えた場合は保存先に移す)',
+        type=int,
+        default=PENDING_MAX_MEMORY
+    )
+
+    # 期限切れとする日数
+    p.add_argument(
+        '--pending-expire',
+        dest='pending_expire',
+        help='保存した解析途中のログを期限切れとして出力するまでの日数',
+        type=float,
+        default=6
+    )
+
+    # ホストをまたがる経路の出力先
+    p.add_argument(
+        '--correlate',
+        help='message_idで結合した経路を1行1JSONで出力するファイルを指定',
+        metavar='FILE'
+    )
+
+    # 経路を保持する時間
+    p.add_argument(
+        '--correlate-window',
+        dest='correlate_window',
+        help='経路を保持する時間(秒)',
+        type=int,
+        default=3600
     )
 
     args = p.parse_args()
+    if not args.inputs and not args.listen:
+        p.error("--inputs か --listen を指定してください。")
+    if args.listen:
+        try:
+            args.listen = parse_listen(args.listen)
+        except ValueError as ve:
+            p.error(str(ve))
+        # 受信した行はrun()のファイルごとの処理を通らないため、ファイル向けの指定は使用できない
+        if args.inputs or args.partition or args.correlate or args.latency_report or args.latency_state or \
+                args.latency_merge or args.manifest or args.carryover or args.merge or args.cache_dir or \
+                args.workers > 1 or args.stats_only or args.mmap:
+            p.error("--listen は --inputs, --partition, --correlate, --latency-report, --latency-state, "
+                    "--latency-merge, --manifest, --carryover, --merge, --cache-dir, --workers, "
+                    "--stats-only, --mmap と併用できません。")
+    if args.profile and args.profile_mode == 'sample' and not ParseProfiler.sampling_available():
+        p.error("この環境では --profile-mode sample を使用できません。cprofile を指定してください。")
+    if args.partition and args.type not in ('TSV', 'JSON', 'ORIG', 'RCPT'):
+        p.error("--partition は TSV, JSON, ORIG, RCPT のみ指定できます。")
+    if args.partition and args.manifest:
+        # 先頭から解析し直すファイルのレコードを、振り分け先から取り除けないため
+        p.error("--partition は --manifest と併用できません。")
+    if args.workers < 1:
+        p.error("--workers は1以上を指定してください。")
+    if args.workers > 1 and (args.mmap or args.carryover or args.stats_only):
+        p.error("--workers は --mmap, --carryover, --stats-only と併用できません。")
+    if (args.events or args.event_summary) and (args.workers > 1 or args.stats_only):
+        p.error("--events, --event-summary は --workers, --stats-only と併用できません。")
+    if args.merge and (args.workers > 1 or args.carryover or args.manifest or args.mmap or args.stats_only):
+        p.error("--merge は --workers, --carryover, --manifest, --mmap, --stats-only と併用できません。")
+    if args.cache_dir and (args.carryover or args.merge or args.stats_only or args.events or args.event_summary):
+        p.error("--cache-dir は --carryover, --merge, --stats-only, --events, --event-summary と併用できません。")
+    if args.pending_store and (args.workers > 1 or args.cache_dir or args.stats_only):
+        p.error("--pending-store は --workers, --cache-dir, --stats-only と併用できません。")
+    if args.pending_memory < 1:
+        p.error("--pending-memory は1以上を指定してください。")
+    if args.batch_size < 1:
+        p.error("--batch-size は1以上を指定してください。")
+    if args.event_clients < 1:
+        p.error("--event-clients は1以上を指定してください。")
 
     # 標準出力
     logging.info('=ArgParse===')
     logging.info(" Input files : {0}".format(args.inputs))
+    logging.info(" Listen      : {0}".format(args.listen))
     logging.info(" Output      : {0}".format(args.output))
     logging.info(" Compressed  : {0}".format(args.compressed))
     logging.info(" Yaer        : {0}".format(args.year))
     logging.info(" Export Type : {0}".format(args.type))
+    logging.info(" Batch Size  : {0}".format(args.batch_size))
+    logging.info(" Line Profile: {0}".format(args.line_profile))
+    logging.info(" Stats Only  : {0}".format(args.stats_only))
+    logging.info(" Partition   : {0}".format(args.partition))
+    logging.info(" Manifest    : {0}".format(args.manifest))
+    logging.info(" Carryover   : {0}".format(args.carryover))
+    logging.info(" Merge       : {0}".format(args.merge))
+    logging.info(" Cache Dir   : {0}".format(args.cache_dir))
+    logging.info(" Pending Store : {0}".format(args.pending_store))
+    logging.info(" Workers     : {0}".format(args.workers))
+    logging.info(" Events      : {0}".format(args.events))
+    logging.info(" Event Summary : {0}".format(args.event_summary))
+    logging.info(" Profile     : {0}".format(args.profile))
+    logging.info(" Correlate   : {0}".format(args.correlate))
     logging.info('=ArgParse===')
 
     return args
@@ -697,9 +4400,12 @@ class MaillogWriter:
              "msg_id", "nrcpt", "relay_host", "relay_ip", "relay_port",
              "dsn", "status", "size", "client_host", "client_ip", "proc",
              "delay", "delay_before", "delay_qmgr", "delay_con", "delay_trans", "dur"]
+    # format_manyで書き込む文字列に変換できる(テキストとして書き込む)Writerの場合はTrue
+    formats_text = False
 
     def __init__(self):
         self._connection_string = ""
+        self._append = False
 
     @property
     def connection_string(self):
@@ -711,6 +4417,34 @@ class MaillogWriter:
             self._connection_string = value
         pass
 
+    @property
+    def append(self):
+        """
+        既存の出力に追記するか
+        :return: 追記する場合はTrue
+        """
+        return self._append
+
+    @append.setter
+    def append(self, value):
+        """
+        既存の出力に追記するか指定します。ファイルに出力するWriterのみ有効です。
+        :param value: True/False
+        """
+        if value:
+            self._append = True
+        else:
+            self._append = False
+
+    def _open_mode(self):
+        """
+        出力ファイルを開く際のモードを返します。
+        :return: 'a' or 'w'
+        """
+        if self._append:
+            return 'a'
+        return 'w'
+
     @abstractmethod
     def connect(self):
         print('Abstract')
@@ -721,13 +4455,92 @@ class MaillogWriter:
         print('Abstract')
         raise NotImplementedError()
 
+    def insert_many(self, ms: list):
+        """
+        複数のログをまとめて書き込みます。
+        既定ではinsertを1件ずつ呼び出します。まとめて書き込める出力先では上書きしてください。
+        :param ms: メールログのリスト
+        :return: なし
+        """
+        for m in ms:
+            self.insert(m)
+
+    def format_many(self, ms: list) -> str:
+        """
+        複数のログを書き込む文字列に変換します。出力先に接続していなくても呼び出せるため、
+        MaillogPipelineのワーカーで変換し、write_formattedで書き込むことができます。
+        formats_textがTrueのWriterのみ対応しています。
+        :param ms: メールログのリスト(1件以上)
+        :return: 書き込む文字列
+        """
+        raise NotImplementedError()
+
+    def write_formatted(self, text: str):
+        """
+        format_manyで変換した文字列を書き込みます。
+        :param text: format_manyで変換した文字列
+        :return: なし
+        """
+        raise NotImplementedError()
+
     @abstractmethod
     def disconnect(self):
         print('Abstract')
         raise NotImplementedError()
 
+    @staticmethod
+    def _without_rcpt(m: dict) -> dict:
+        """
+        宛先ごとの配送の試行(rcpt)を除いたメールログを返します。
+        rcptは遅延時間の集計や経路の結合のためにも記録されるため、RCPT以外の出力には含めません。
+        :param m:   メールログ
+        :return:    rcptがない場合は元のメールログ、ある場合はrcpt以外の値を参照するディクショナリ
+        """
+        if "rcpt" not in m:
+            return m
+        return {k: v for k, v in m.items() if k != "rcpt"}
+
+    # 派生列(遅延時間の文字列と所要時間)の元になるキー
+    _delay_keys = ("delay", "delay_before_qmanager", "delay_qmanager", "delay_con_setup", "delay_msg_trans")
+
+    @classmethod
+    def _derived(cls, m: dict) -> tuple:
+        """
+        1件のメールログの派生列を返します。
+        :param m:   メールログ
+        :return:    (delay, delay_before_qmanager, delay_qmanager, delay_con_setup, delay_msg_trans, dur)の文字列
+        """
+        return tuple(str(m[k]) for k in cls._delay_keys) + (str(m["date_end_date"] - m["date_start_date"]),)
+
+    @classmethod
+    def _derived_many(cls, ms: list) -> list:
+        """
+        複数のメールログの派生列をまとめて計算します。
+        遅延時間の組と所要時間は同じ値が繰り返し現れるため、値ごとに1度だけ文字列に変換し、
+        同じバッチ内では変換結果を再利用します。
+        :param ms:  メールログのリスト
+        :return:    _derivedと同じ形式のタプルのリスト
+        """
+        delays = itemgetter(*cls._delay_keys)
+        delay_str = {}
+        dur_str = {}
+        derived = []
+        for m in ms:
+            d = delays(m)
+            ds = delay_str.get(d)
+            if ds is None:
+                ds = delay_str[d] = tuple(map(str, d))
+            td = m["date_end_date"] - m["date_start_date"]
+            ts = dur_str.get(td)
+            if ts is None:
+                ts = dur_str[td] = str(td)
+            derived.append(ds + (ts,))
+        return derived
+
 
 class MaillogTSVWriter(MaillogWriter):
+    formats_text = True
+
     def __init__(self):
         super().__init__()
         self._delimiter = "\t"
@@ -740,7 +4553,10 @@ class MaillogTSVWriter(MaillogWriter):
         return
 
     def connect(self):
-        self._fs = open(self._connection_string, mode='w', buffering=WRITE_BUFFER)
+        self._fs = open(self._connection_string, mode=self._open_mode(), buffering=WRITE_BUFFER)
+        # 追記する場合、既にヘッダーが書き込まれていればヘッダーは書き込まない
+        if self._append and self._fs.tell() > 0:
+            self._header_flg = True
 
     def insert(self, m: dict):
         if self._fs:
@@ -752,6 +4568,23 @@ class MaillogTSVWriter(MaillogWriter):
         else:
             raise IOError()
 
+    def insert_many(self, ms: list):
+        if ms:
+            self.write_formatted(self.format_many(ms))
+
+    def format_many(self, ms: list) -> str:
+        # 派生列をまとめて計算し、1つの文字列にする
+        return "\n".join(map(self._dumps, ms, self._derived_many(ms))) + "\n"
+
+    def write_formatted(self, text: str):
+        if self._fs:
+            if not self._header_flg:
+                self._write_header()
+                self._header_flg = True
+            self._fs.write(text)
+        else:
+            raise IOError()
+
     def _header(self) -> str:
         return self._delimiter.join(super()._cols)
 
@@ -759,14 +4592,17 @@ class MaillogTSVWriter(MaillogWriter):
         self._fs.write(self._header())
         self._fs.write("\n")
 
-    def _dumps(self, m: dict) -> str:
+    def _dumps(self, m: dict, derived=None) -> str:
         """
 
+        :param derived: _derived_manyで計算済みの派生列
         :rtype: str
         """
         tmp = []
         dlm = self._delimiter
         rep = self._replace_char
+        if derived is None:
+            derived = self._derived(m)
         try:
             tmp.append(str(m["parse_end"]))
             tmp.append(m["date_start_date"].isoformat())
@@ -787,12 +4623,7 @@ class MaillogTSVWriter(MaillogWriter):
             tmp.append(m["client_host"].replace(dlm, rep))
             tmp.append(m["client_ip"].replace(dlm, rep))
             tmp.append(','.join(m["proc"]).replace(dlm, rep))
-            tmp.append(str(m["delay"]))
-            tmp.append(str(m["delay_before_qmanager"]))
-            tmp.append(str(m["delay_qmanager"]))
-            tmp.append(str(m["delay_con_setup"]))
-            tmp.append(str(m["delay_msg_trans"]))
-            tmp.append(str(m["date_end_date"] - m["date_start_date"]))
+            tmp.extend(derived)
             tmp.append(','.join(m["smtp_message"]).replace(dlm, rep))
 
         except TypeError as te:
@@ -806,14 +4637,83 @@ class MaillogTSVWriter(MaillogWriter):
             self._fs = None
 
 
+class MaillogRcptWriter(MaillogTSVWriter):
+    """
+    宛先ごとの配送の試行(rcpt)を1行としてタブ区切りで書き込むクラスです。
+    メッセージ単位の列は1件のメールログにつき1度だけ文字列にし、同じメールログの行で共有します。
+    配送の試行がないメールログは、宛先の列を空にした1行を書き込みます。
+    メールログはMaillogParser.collect_recipientsをTrueにして解析したものを指定してください。
+    """
+    _parent_cols = ["analyzed", "start", "end", "host", "qid", "from", "msg_id", "nrcpt",
+                    "size", "client_host", "client_ip", "dur"]
+    _rcpt_cols = ["date", "to", "org_to", "relay_host", "relay_ip", "relay_port", "delay",
+                  "delay_before", "delay_qmgr", "delay_con", "delay_trans", "dsn", "status", "message"]
+
+    def _header(self) -> str:
+        return self._delimiter.join(self._parent_cols + self._rcpt_cols)
+
+    def _dumps(self, m: dict, derived=None) -> str:
+        """
+
+        :param derived: _derived_manyで計算済みの派生列(所要時間のみ使用)
+        :rtype: str
+        """
+        dlm = self._delimiter
+        rep = self._replace_char
+        if derived is None:
+            derived = self._derived(m)
+        parent = dlm.join((
+            str(m["parse_end"]),
+            m["date_start_date"].isoformat(),
+            m["date_end_date"].isoformat(),
+            m["host"].replace(dlm, rep),
+            m["queue_id"].replace(dlm, rep),
+            m["envelope_from"].replace(dlm, rep),
+            m["message_id"].replace(dlm, rep),
+            str(m["nrcpt"]),
+            str(m["size"]),
+            m["client_host"].replace(dlm, rep),
+            m["client_ip"].replace(dlm, rep),
+            derived[-1])) + dlm
+
+        rcpt = m.get("rcpt")
+        if not rcpt:
+            return parent + dlm * (len(self._rcpt_cols) - 1)
+        return "\n".join([parent + self._dumps_rcpt(a) for a in rcpt])
+
+    def _dumps_rcpt(self, a: list) -> str:
+        """
+        1つの配送の試行の列を文字列にします。
+        :param a:   メールログのrcptの要素
+        :rtype: str
+        """
+        dlm = self._delimiter
+        rep = self._replace_char
+        delays = a[7]
+        return dlm.join((
+            a[0].isoformat() if a[0] else "",
+            a[1].replace(dlm, rep),
+            a[2].replace(dlm, rep),
+            a[3].replace(dlm, rep),
+            a[4].replace(dlm, rep),
+            a[5].replace(dlm, rep),
+            str(a[6]),
+            dlm.join(map(str, delays)) if delays else dlm * 3,
+            a[8].replace(dlm, rep),
+            a[9].replace(dlm, rep),
+            a[10].replace(dlm, rep)))
+
+
 class MaillogJSONWriter(MaillogWriter):
+    formats_text = True
+
     def __init__(self):
         super().__init__()
         self._fs = None
         return
 
     def connect(self):
-        self._fs = open(self._connection_string, mode='w', buffering=WRITE_BUFFER)
+        self._fs = open(self._connection_string, mode=self._open_mode(), buffering=WRITE_BUFFER)
 
     def _dumps(self, m: dict) -> str:
         """
@@ -821,12 +4721,22 @@ class MaillogJSONWriter(MaillogWriter):
         :rtype: str
         """
 
-        return json.dumps(m, default=support_datetime_default)
+        return json.dumps(self._without_rcpt(m), default=support_datetime_default)
 
     def insert(self, m: dict):
         self._fs.write(self._dumps(m))
         self._fs.write("\n")
 
+    def insert_many(self, ms: list):
+        if ms:
+            self.write_formatted(self.format_many(ms))
+
+    def format_many(self, ms: list) -> str:
+        return "\n".join(map(self._dumps, ms)) + "\n"
+
+    def write_formatted(self, text: str):
+        self._fs.write(text)
+
     def disconnect(self):
         if self._fs:
             self._fs.close()
@@ -876,7 +4786,7 @@ class MaillogElsWriter(MaillogWriter):
 
         :rtype: str
         """
-        return json.dumps(m, default=support_datetime_default)
+        return json.dumps(self._without_rcpt(m), default=support_datetime_default)
 
     def insert(self, m: dict):
         if self._es:
@@ -884,6 +4794,17 @@ class MaillogElsWriter(MaillogWriter):
         else:
             raise IOError()
 
+    def insert_many(self, ms: list):
+        if not ms:
+            return
+        if self._es:
+            from elasticsearch import helpers
+            # Bulk APIでまとめて登録する
+            helpers.bulk(self._es, ({"_index": self._index, "_type": self._type, "_source": self._dumps(m)}
+                                    for m in ms))
+        else:
+            raise IOError()
+
     def disconnect(self):
         self._es = None
 
@@ -952,7 +4873,7 @@ class MaillogElsWithGeoWriter(MaillogWriter):
             except:
                 continue
 
-        return json.dumps(m, default=support_datetime_default)
+        return json.dumps(self._without_rcpt(m), default=support_datetime_default)
 
     def insert(self, m: dict):
         if self._es:
@@ -960,10 +4881,23 @@ class MaillogElsWithGeoWriter(MaillogWriter):
         else:
             raise IOError()
 
+    def insert_many(self, ms: list):
+        if not ms:
+            return
+        if self._es:
+            from elasticsearch import helpers
+            # Bulk APIでまとめて登録する
+            helpers.bulk(self._es, ({"_index": self._index, "_type": self._type, "_source": self._dumps(m)}
+                                    for m in ms))
+        else:
+            raise IOError()
+
     def disconnect(self):
         self._es = None
 
 class MaillogOrgWriter(MaillogWriter):
+    formats_text = True
+
     def __init__(self):
         super().__init__()
         self._fs = None
@@ -972,13 +4906,16 @@ class MaillogOrgWriter(MaillogWriter):
         return
 
     def connect(self):
-        self._fs = open(self._connection_string, mode='w', buffering=WRITE_BUFFER)
+        self._fs = open(self._connection_string, mode=self._open_mode(), buffering=WRITE_BUFFER)
 
-    def _dumps(self, m: dict) -> str:
+    def _dumps(self, m: dict, derived=None) -> str:
         """
 
+        :param derived: _derived_manyで計算済みの派生列
         :rtype: str
         """
+        if derived is None:
+            derived = self._derived(m)
         fmt = "anlyzd={0}\tstart={1}\tend={2}\thost={3}\tqid={4}\tfrom={5}\torg_to={6}\tto={7}\t" \
               "msgid={8}\tnrcpt={9}\trlyhost={10}\trlyip={11}\trlyprt={12}\tdsn={13}\t" \
               "status={14}\tsize={15}\tclhost={16}\tclip={17}\tporc={18}\tdelay={19}\t" \
@@ -1006,12 +4943,12 @@ class MaillogOrgWriter(MaillogWriter):
                 m["client_host"].replace(dlm, rep),
                 m["client_ip"].replace(dlm, rep),
                 ','.join(m["proc"]).replace(dlm, rep),
-                str(m["delay"]),
-                str(m["delay_before_qmanager"]),
-                str(m["delay_qmanager"]),
-                str(m["delay_con_setup"]),
-                str(m["delay_msg_trans"]),
-                str(m["date_end_date"] - m["date_start_date"]),
+                derived[0],
+                derived[1],
+                derived[2],
+                derived[3],
+                derived[4],
+                derived[5],
                 ','.join(m["smtp_message"]).replace(dlm, rep)
             )
 
@@ -1024,21 +4961,161 @@ class MaillogOrgWriter(MaillogWriter):
         self._fs.write(self._dumps(m))
         self._fs.write("\n")
 
+    def insert_many(self, ms: list):
+        if ms:
+            self.write_formatted(self.format_many(ms))
+
+    def format_many(self, ms: list) -> str:
+        # 派生列をまとめて計算し、1つの文字列にする
+        return "\n".join(map(self._dumps, ms, self._derived_many(ms))) + "\n"
+
+    def write_formatted(self, text: str):
+        self._fs.write(text)
+
     def disconnect(self):
         if self._fs:
             self._fs.close()
             self._fs = None
 
 
+class MaillogPartitionedWriter(MaillogWriter):
+    """
+    出力先ディレクトリの下に「{日付}/{ホスト名}.{拡張子}」の形式で
+    ログを振り分けて書き込むクラスです。
+    開いているファイルはLRUで管理し、max_handlesを超えた場合は最も長く
+    使用されていないファイルを閉じます。同じ実行中に再度開く場合は追記します。
+    """
+    # 出力形式ごとのWriterと拡張子
+    _formats = {"TSV": (MaillogTSVWriter, "tsv"), "JSON": (MaillogJSONWriter, "json"),
+                "ORIG": (MaillogOrgWriter, "txt"), "RCPT": (MaillogRcptWriter, "rcpt.tsv")}
+
+    def __init__(self, export_type="ORIG", max_handles=PARTITION_MAX_HANDLES):
+        super().__init__()
+        if export_type not in self._formats:
+            raise ValueError("振り分け出力に対応していない出力形式です。{0}".format(export_type))
+        self._export_type = export_type
+        self._max_handles = max_handles
+        # (日付, ホスト名) -> Writer
+        self._writers = collections.OrderedDict()
+        # この実行中に開いたファイル
+        self._opened = set()
+
+    def connect(self):
+        if not os.path.isdir(self._connection_string):
+            raise IOError("出力先のディレクトリがありません。{0}".format(self._connection_string))
+
+    def _partition_path(self, key):
+        return os.path.join(self._connection_string, key[0],
+                            "{0}.{1}".format(key[1], self._formats[self._export_type][1]))
+
+    @staticmethod
+    def _partition_key(m: dict) -> tuple:
+        """
+        ログの振り分け先(日付, ホスト名)を返します。
+        :param m: メールログ
+        :return:  (日付, ホスト名)
+        """
+        dt = m["date_start_date"]
+        host = m["host"].replace(os.sep, "_")
+        return dt.date().isoformat() if dt else "unknown", host or "unknown"
+
+    def _writer(self, key: tuple) -> MaillogWriter:
+        """
+        ログの振り分け先のWriterを返します。
+        :param key: 振り分け先(日付, ホスト名)
+        :return:    振り分け先のWriter
+        """
+        w = self._writers.get(key)
+        if w is not None:
+            self._writers.move_to_end(key)
+            return w
+
+        # 最も長く使用されていないファイルを閉じる
+        while len(self._writers) >= self._max_handles:
+            self._writers.popitem(last=False)[1].disconnect()
+
+        path = self._partition_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        w = self._formats[self._export_type][0]()
+        w.connection_string = path
+        w.append = self._append or path in self._opened
+        w.connect()
+        self._opened.add(path)
+        self._writers[key] = w
+        return w
+
+    def insert(self, m: dict):
+        self._writer(self._partition_key(m)).insert(m)
+
+    def insert_many(self, ms: list):
+        # 振り分け先ごとにまとめて書き込む
+        groups = collections.OrderedDict()
+        for m in ms:
+            key = self._partition_key(m)
+            if key in groups:
+                groups[key].append(m)
+            else:
+                groups[key] = [m]
+        for key, group in groups.items():
+            self._writer(key).insert_many(group)
+
+    def disconnect(self):
+        while self._writers:
+            self._writers.popitem(last=False)[1].disconnect()
+
+
+def output_path(input_fn: str, output: str) -> str:
+    """
+    ファイルに出力する場合の出力先のパスを返します。
+    :param input_fn:    入力ファイル名
+    :param output:      出力先のディレクトリ
+    :return:            「{出力先}/{入力ファイル名}.txt」
+    """
+    basename, ext = os.path.splitext(os.path.basename(input_fn))
+    return "{0}/{1}{2}.txt".format(output, basename, ext)
+
+
+def relocate_outputs(manifest, inputs, output):
+    """
+    ローテートで名前が変わった入力ファイルの出力を、新しい名前に合わせて移動します。
+    新しく作成されたファイルの出力で前回の出力を上書きしないよう、全ての入力を解析する前に
+    呼び出してください。移動先が他の移動元になる場合(maillog.1 -> maillog.2 など)に備えて、
+    一時的な名前に移動してから移動先に移動します。
+    :param manifest:    ProcessManifest
+    :param inputs:      入力ファイル名のリスト
+    :param output:      出力先のディレクトリ
+    :return: なし
+    """
+    moves = []
+    for fn in inputs:
+        ent = manifest.renamed(fn)
+        if ent is None:
+            continue
+        target = output_path(fn, output)
+        src = ent.get("output")
+        if src and src != target and os.path.isfile(src):
+            logging.info("ローテートされたファイルの出力を移動します。{0} -> {1}".format(src, target))
+            moves.append((fn, src, target))
+        manifest.relocate(fn, target)
+
+    tmps = []
+    for i, (fn, src, target) in enumerate(moves):
+        tmp = "{0}.relocate{1}".format(target, i)
+        os.replace(src, tmp)
+        tmps.append((tmp, target))
+    for tmp, target in tmps:
+        os.replace(tmp, target)
+    manifest.save()
+
+
 def create_writer(txt: str, input_fn: str, output: str):
     """
     出力オブジェクトの生成
     :param input_fn:
-    :param txt: JSON / TSV / ORIG
+    :param txt: JSON / TSV / ORIG / RCPT
     :return: MaillogWriterを継承したオブジェクト
     """
-    basename, ext = os.path.splitext(os.path.basename(input_fn))
-    output_fn = "{0}/{1}{2}.txt".format(output, basename, ext)
+    output_fn = output_path(input_fn, output)
 
     if txt == 'JSON':
         # 1行 1JSON で書き込みます。
@@ -1052,6 +5129,12 @@ def create_writer(txt: str, input_fn: str, output: str):
         mtw.connection_string = output_fn
         return mtw
 
+    elif txt == 'RCPT':
+        # 宛先ごとの配送の試行を1行としてTab区切りで書き込みます。
+        mtw = MaillogRcptWriter()
+        mtw.connection_string = output_fn
+        return mtw
+
     elif txt == 'ELS':
         # Elasticsearchに書き込みます。
         mtw = MaillogElsWriter()
@@ -1076,8 +5159,6 @@ def main():
     メインループ
     :return: void
     """
-    stime = datetime.datetime.now()
-
     # LogFormatの指定
     logging.basicConfig(
         format='%(asctime)s : %(levelname)s:%(message)s',
@@ -1087,13 +5168,148 @@ def main():
     # コマンドライン引数の取得
     args = arg_parse()
 
+    # プロファイルの記録
+    profiler = None
+    if args.profile:
+        profiler = ParseProfiler(args.profile, args.profile_mode)
+        profiler.start()
+    try:
+        run(args, profiler)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.save()
+
+
+def run(args, profiler=None):
+    """
+    コマンドライン引数に従って解析を実行します。
+    :param args:        コマンドライン引数
+    :param profiler:    工程別の時間を計測する場合はParseProfiler
+    :return: void
+    """
+    stime = datetime.datetime.now()
+
+    # 行形式のプロファイル
+    # syslog_nameかキューIDの形式が指定された場合は、指定されたプロファイルを元に登録し直す
+    if args.syslog_names or args.queue_id_style:
+        base = MaillogParser.line_profiles.get(args.line_profile, MaillogParser.line_profiles["default"])
+        names = base["syslog_names"]
+        if args.syslog_names:
+            names = [n for n in args.syslog_names.split(",") if n]
+        MaillogParser.register_line_profile(
+            "cli", syslog_names=names, queue_id=args.queue_id_style or base["queue_id"])
+        args.line_profile = "cli"
+    # コンパイルは起動時に1度だけ行う
+    MaillogParser.line_pattern(args.line_profile)
+
+    # 集計結果
+    totals = {}
+
+    # 遅延時間のパーセンタイル
+    latency = None
+    if args.latency_report or args.latency_state:
+        if args.latency_state and os.path.exists(args.latency_state):
+            latency = LatencyAnalyzer.load(args.latency_state)
+        else:
+            latency = LatencyAnalyzer(args.latency_window)
+        if args.latency_merge:
+            for fn in glob.glob(args.latency_merge):
+                latency.merge(LatencyAnalyzer.load(fn))
+
+    # smtpdのイベント
+    events = None
+    if args.events or args.event_summary:
+        events = SmtpdEventCollector(args.events, args.event_clients, args.event_window)
+
+    # 解析途中のログの保存先
+    pending = None
+    if args.pending_store:
+        pending = PendingStore(args.pending_store, args.pending_memory, args.pending_expire)
+
+    # syslogを受信して解析する
+    if args.listen:
+        try:
+            listen(args, events, pending)
+        finally:
+            if pending:
+                pending.close()
+        close_events(events, args.event_summary)
+        logging.info('=Parse end.=== {0}'.format(datetime.datetime.now() - stime))
+        return
+
+    # 処理済みファイルのマニフェスト
+    manifest = None
+    if args.manifest and not args.stats_only:
+        manifest = ProcessManifest(args.manifest)
+
+    # 日付とホスト名で振り分けて出力する場合は、全ての入力で1つのWriterを使用する
+    partition_writer = None
+    if args.partition:
+        partition_writer = MaillogPartitionedWriter(args.type, args.partition_handles)
+        partition_writer.connection_string = args.output
+        partition_writer.connect()
+
+    # 解析済みレコードのキャッシュ
+    record_cache = None
+    if args.cache_dir:
+        record_cache = RecordCache(args.cache_dir)
+
     # ファイル名の指定
     inputs = glob.glob(args.inputs)
-    for input_fn in inputs:
+
+    # ローテートで名前が変わったファイルの出力は、新しいファイルの出力で上書きする前に移動する
+    if manifest and args.type not in ('ELS', 'ELSwG'):
+        relocate_outputs(manifest, inputs, args.output)
+    mp = None
+    if args.carryover:
+        # ローテートされたファイルを古い順に並べ、1つのパーサーで解析途中の状態を引き継ぐ
+        inputs.sort(key=lambda fn: os.stat(fn).st_mtime)
+        mp = MaillogParser(None)
+        mp.pop_parsed_line = True
+
+    # 全ての入力を時刻順に並べ、1つのパーサーで解析して「merged」に出力する
+    merge_inputs = None
+    if args.merge:
+        merge_inputs = inputs
+        inputs = ["merged"]
+
+    # 経路の結合(時刻は入力ごとに管理する)
+    correlator = None
+    trace_fs = None
+    if args.correlate:
+        correlator = MaillogCorrelator(window=args.correlate_window, inputs=inputs)
+        trace_fs = open(args.correlate, mode='w', buffering=WRITE_BUFFER)
+
+    # マニフェストで処理済みかを確認
+    # 状態を引き継ぐ場合は、解析が終わっていないログを最後に解析するファイルの出力に書き込むため、先に確認する
+    states = {}
+    if manifest:
+        for input_fn in inputs:
+            states[input_fn] = manifest.check(input_fn, args.compressed == 'Y')
+    last_index = len(inputs) - 1
+    while last_index > 0 and states.get(inputs[last_index], ("new",))[0] == "unchanged":
+        last_index -= 1
+
+    for i, input_fn in enumerate(inputs):
 
         # パーサーオブジェクトの指定
         logging.info(" Analyzing [{0}]".format(input_fn))
-        mp = MaillogParser(input_fn)
+        if args.carryover:
+            mp.filepath = input_fn
+        else:
+            mp = MaillogParser(input_fn)
+            # キャッシュする場合や保存先を使用する場合は、記録した後にレコードが更新されないよう
+            # 解析済みのログを取り除く
+            mp.pop_parsed_line = record_cache is not None or pending is not None
+        mp.line_profile = args.line_profile
+        mp.use_mmap = args.mmap
+        mp.event_sink = events
+        mp.pending_store = pending
+        mp.collect_recipients = args.type == 'RCPT' or correlator is not None or latency is not None
+        # 解析が終わっていないログは最後に解析するファイルでのみ書き込む
+        last_input = not args.carryover or i == last_index
+        cnt_before = mp.parsed_count
 
         # 圧縮状態の指定
         if args.compressed == 'Y':
@@ -1104,38 +5320,124 @@ def main():
         # 年号の設定
         if args.year is not None:
             # 引数で明示的に年賀指定された場合
-            mp.year = args.year
-        elif args.yearfromctime:
+            # 状態を引き継ぐ場合は年の繰り上げを維持するため最初のファイルでのみ設定する
+            if not args.carryover or i == 0:
+                mp.year = args.year
+        elif args.yearfromctime and not merge_inputs:
             # 引数でctimeが指定された場合。
             # WindowsとLinuxでctimeの意味するところが異なるので注意
             dt = datetime.datetime.fromtimestamp(os.stat(input_fn).st_ctime)
             mp.year = dt.year
 
+        # マニフェストで処理済みの場合
+        mp.start_offset = 0
+        append = False
+        fingerprint = None
+        if manifest:
+            state, offset, fingerprint = states[input_fn]
+            if state == "unchanged":
+                logging.info("前回から変更されていないため、解析を省略します。")
+                continue
+            elif state == "grown":
+                logging.info("前回の位置({0})から解析します。".format(offset))
+                if not pending:
+                    logging.warning("前回の終わりで解析途中だったログは2件に分かれて出力されます。"
+                                    "続きとして解析するには --pending-store を指定してください。")
+                mp.start_offset = offset
+                append = True
+
         # ログのパース実行
+        mtw = None
+        recording = None
         try:
+            # 工程別の時間の計測
+            if profiler and not merge_inputs:
+                profiler.attach(mp)
+
             # 標準出力
             ps = datetime.datetime.now()
             logging.info("Start analysis.")
 
+            # 集計のみを行う場合はWriterを作成しない
+            if args.stats_only:
+                for k, v in mp.scan_summary().items():
+                    totals[k] = totals.get(k, 0) + v
+                logging.info("The processing take {0}".format((datetime.datetime.now() - ps)))
+                continue
+
             # Writerの作成
-            mtw = create_writer(args.type, input_fn, args.output)
-            mtw.connect()
+            if partition_writer:
+                mtw = partition_writer
+            else:
+                mtw = create_writer(args.type, input_fn, args.output)
+                mtw.append = append
+                mtw.connect()
+            if profiler:
+                profiler.wrap_writer(mtw)
+
+            # 複数のプロセスで解析する場合
+            source = mp
+            formatted = False
+            if merge_inputs:
+                source = MaillogMerger(mp, merge_inputs, args.merge_skew, args.yearfromctime)
+            elif args.workers > 1:
+                # メールログを書き込み以外に使用しない場合は、ワーカーで書き込む文字列に変換する
+                formatted = mtw.formats_text and not (correlator or latency or record_cache or profiler)
+                source = MaillogPipeline(mp, args.workers, formatter=type(mtw) if formatted else None)
+                cnt_before = 0
+
+            # 解析済みのレコードがキャッシュされている場合は解析しない
+            # 追記された部分のみを解析する場合はキャッシュしない
+            if record_cache and not mp.start_offset:
+                cached = record_cache.load(mp)
+                if cached:
+                    logging.info("キャッシュからレコードを読み込みます。")
+                    source = cached
+                    cnt_before = 0
+                else:
+                    source = recording = record_cache.record(mp, source)
 
-            # 解析が終わったログを書き込み
-            for imlog in mp.parse():
-                logging.debug(imlog)
-                mtw.insert(imlog)
+            if formatted:
+                # ワーカーが変換した文字列をそのまま書き込み
+                for text in source.parse():
+                    mtw.write_formatted(text)
+            else:
+                # 解析が終わったログをbatch_size件ずつ書き込み
+                batch = []
+                for imlog in source.parse():
+                    logging.debug(imlog)
+                    batch.append(imlog)
+                    if len(batch) >= args.batch_size:
+                        mtw.insert_many(batch)
+                        batch = []
+                    if correlator:
+                        write_traces(trace_fs, correlator.add(imlog, input_fn))
+                    if latency:
+                        latency.add(imlog)
+                mtw.insert_many(batch)
 
             # 解析が終わっていないログを書き込み
-            for imlog in mp.get_noncomplete_maillog():
-                mtw.insert(imlog)
+            if last_input:
+                batch = list(source.get_noncomplete_maillog())
+                if pending:
+                    # 保存先に保存し、期限切れのログのみを書き込む
+                    batch = pending.finish(batch, mp.last_date)
+                mtw.insert_many(batch)
+                if correlator:
+                    for imlog in batch:
+                        write_traces(trace_fs, correlator.add(imlog, input_fn))
 
             # 標準出力
             pe = datetime.datetime.now()
-            cnt = mp.parsed_count
+            cnt = source.parsed_count - cnt_before
             logging.info("End analysis. The number of rows is {0}.".format(cnt))
             logging.info("The processing take {0}".format((pe - ps)))
 
+            # マニフェストに処理結果を記録
+            if manifest:
+                manifest.update(input_fn, fingerprint, source.end_offset, mtw.connection_string)
+                manifest.save()
+
         except UnicodeDecodeError as ude:
             # テキスト形式を想定してファイルを開いたが、エンコードエラーが発生した場合
             logging.error("ファイルを開いた際にデコードエラーが発生しました。{0}".format(ude))
@@ -1145,13 +5447,124 @@ def main():
             logging.error("日時に誤りがあります。当該ログの処理を中断します。{0}".format(ve))
 
         finally:
-            mtw.disconnect()
+            if recording is not None:
+                recording.close()
+            if mtw is not None and mtw is not partition_writer:
+                mtw.disconnect()
+
+    if partition_writer:
+        partition_writer.disconnect()
+
+    close_events(events, args.event_summary)
+    if pending:
+        pending.close()
+
+    # 遅延時間のパーセンタイルの出力
+    if latency:
+        if args.latency_state:
+            latency.save(args.latency_state)
+        if args.latency_report:
+            latency.write_report(args.latency_report)
+
+    # 集計結果の表示
+    if args.stats_only:
+        print(format_summary(totals))
+
+    # 残っている経路を書き込み
+    if correlator:
+        write_traces(trace_fs, correlator.flush())
+        trace_fs.close()
 
     # 標準出力
     etime = datetime.datetime.now()
     logging.info('=Parse end.=== {0}'.format(etime - stime))
 
 
+def listen(args, events=None, pending=None):
+    """
+    syslogを受信して解析し、出力先ディレクトリの「syslog.txt」に書き込みます。
+    :param args:    コマンドライン引数
+    :param events:  smtpdのイベントを受け取るSmtpdEventCollector
+    :param pending: 解析途中のログの保存先(PendingStore)
+    :return: なし
+    """
+    mp = MaillogParser(None, args.year)
+    mp.pop_parsed_line = True
+    mp.line_profile = args.line_profile
+    mp.event_sink = events
+    mp.pending_store = pending
+    mp.collect_recipients = args.type == 'RCPT'
+
+    mtw = create_writer(args.type, "syslog", args.output)
+    mtw.connect()
+    receiver = SyslogReceiver(mp, mtw, queue_size=args.listen_queue)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(receiver.serve(udp=args.listen[0], tcp=args.listen[1],
+                                           duration=args.listen_duration))
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # 受信を止め、キューに残っている行を書き込むまで待つ
+        logging.info("受信を中断しました。")
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        loop.close()
+        # 解析が終わっていないログを書き込み
+        # 保存先を指定している場合は保存し、期限切れのログのみを書き込む
+        records = list(mp.get_noncomplete_maillog())
+        if pending:
+            records = pending.finish(records, mp.last_date)
+        mtw.insert_many(records)
+        mtw.disconnect()
+        logging.info("syslog: {0}".format(receiver.stats()))
+
+
+def close_events(events, summary_path):
+    """
+    smtpdのイベントのファイルを閉じ、クライアントごとの集計を書き込みます。
+    :param events:          SmtpdEventCollector(イベントを出力しない場合はNone)
+    :param summary_path:    集計の出力先(出力しない場合はNone)
+    :return: なし
+    """
+    if events is None:
+        return
+    events.close()
+    if summary_path:
+        events.write_summary(summary_path)
+
+
+def format_summary(summary: dict) -> str:
+    """
+    scan_summaryの集計結果を表示用の文字列に変換します。
+    :param summary: 集計結果
+    :return:        表示用の文字列
+    """
+    lines = []
+    for k in ("messages", "recipients", "bytes", "removed", "sent", "deferred", "bounced"):
+        lines.append("{0:<11}: {1}".format(k, summary.get(k, 0)))
+    for k in sorted(summary):
+        if k not in ("messages", "recipients", "bytes", "removed", "sent", "deferred", "bounced"):
+            lines.append("{0:<11}: {1}".format(k, summary[k]))
+    return "\n".join(lines)
+
+
+def write_traces(fs, traces):
+    """
+    MaillogCorrelatorが確定させた経路を1行1JSONで書き込みます。
+    :param fs:      出力先のファイルオブジェクト
+    :param traces:  経路のリスト
+    :return: なし
+    """
+    for tr in traces:
+        fs.write(json.dumps(tr, default=support_datetime_default))
+        fs.write("\n")
+
+
 def support_datetime_default(obj) -> str:
     """
     json.dumpsでdatetimeオブジェクトを扱うためのコールバック
@@ -1166,15 +5579,4 @@ def support_datetime_default(obj) -> str:
 
 
 if __name__ == '__main__':
-
-    if PROFILE_FLAG:
-        import cProfile
-
-        cp = cProfile.Profile()
-        cp.enable()
-        main()
-        cp.disable()
-        # cp.print_stats()
-        cp.dump_stats('plp.stats')
-    else:
-        main()
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# 行形式のプロファイルから生成した正規表現のマッチの時間を、プロファイル導入前の固定の正規表現と比較します。
+#  python benchmarks/bench_line_profile.py --messages 20000
+#
+# 生成したログの全行にsearchを実行し、repeat回の最小値を表示します。
+# 既定のプロファイル(default)がプロファイル導入前と同じ時間で済むこと、syslog_nameやキューIDの形式を
+# 増やした場合の時間の増加を確認します。
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+
+from support import sample_lines  # noqa: E402
+from PostfixLogParser import MaillogParser  # noqa: E402
+
+# プロファイル導入前の行の正規表現
+BEFORE = r'^%s %s postfix/%s\[\d+\]: %s:\s*%s' % (
+    MaillogParser.re_date, MaillogParser.re_host, r'(?P<proc>\w+)', r'(?P<queue_id>[0-9A-F]+)', MaillogParser.re_msg)
+
+
+def best(pat, lines, repeat):
+    """
+    :return: (最小の秒数, マッチした行数)
+    """
+    search = pat.search
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n = sum(1 for m in map(search, lines) if m)
+        elapsed = time.perf_counter() - start
+        if result is None or elapsed < result[0]:
+            result = (elapsed, n)
+    return result
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--messages', type=int, default=20000, help='生成するログのメッセージ数(ホストごと)')
+    p.add_argument('--repeat', type=int, default=30, help='計測の回数(最小値を表示)')
+    args = p.parse_args()
+
+    MaillogParser.register_line_profile("multi", ["postfix", "postfix-out", "postfix/submission"], "short")
+    MaillogParser.register_line_profile("both", ["postfix"], "both")
+    short = sample_lines(args.messages, hosts=("mx1", "mx2"))
+    long = sample_lines(args.messages, hosts=("mx1", "mx2"), long_queue_id=True)
+    print("lines: {0}".format(len(short)))
+
+    cases = [
+        ("before", re.compile(BEFORE), short),
+        ("default", MaillogParser.line_pattern("default"), short),
+        ("multi", MaillogParser.line_pattern("multi"), short),
+        ("both", MaillogParser.line_pattern("both"), short),
+        ("long_queue_id", MaillogParser.line_pattern("long_queue_id"), long),
+        ("both(long)", MaillogParser.line_pattern("both"), long),
+    ]
+    base = None
+    for name, pat, lines in cases:
+        elapsed, n = best(pat, lines, args.repeat)
+        if base is None:
+            base = elapsed
+        print("{0:14s}: {1:.4f}s matched {2} (x{3:.2f})".format(name, elapsed, n, elapsed / base))
+
+
+if __name__ == "__main__":
+    main()
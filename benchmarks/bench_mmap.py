@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# メモリマップ(--mmap)による解析の時間を、テキストとして読み取る通常の解析と比較します。
+#  python benchmarks/bench_mmap.py --messages 20000 --other 0,1,3,9
+#
+# postfix以外の行(sshd, dovecot, kernel)をメッセージの行1行あたりother行の割合で混ぜたログを作成し、
+# 解析の時間(repeat回の最小値)を表示します。メモリマップはpostfix以外の行を文字列に変換しない代わりに、
+# 行ごとの検索の呼び出しが多くなるため、postfixの行のみのログでは通常の解析より遅くなります。
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+
+from support import sample_lines  # noqa: E402
+from PostfixLogParser import MaillogParser  # noqa: E402
+
+OTHER_LINES = (
+    "Mar  1 00:00:00 mx1 sshd[2001]: Accepted publickey for admin from 192.0.2.10 port 50022 ssh2: RSA SHA256:abc",
+    "Mar  1 00:00:00 mx1 dovecot: imap-login: Login: user=<b1@example.org>, method=PLAIN, rip=192.0.2.20, "
+    "lip=192.0.2.1, mpid=3001, TLS",
+    "Mar  1 00:00:00 mx1 kernel: [12345.678901] IN=eth0 OUT= SRC=198.51.100.7 DST=192.0.2.1 PROTO=TCP DPT=25",
+)
+
+
+def write_log(fn, messages, other):
+    """
+    postfixの行1行ごとにpostfix以外の行をother行挿入したログを作成します。
+    """
+    with open(fn, "w") as fo:
+        k = 0
+        for line in sample_lines(messages, hosts=("mx1", "mx2")):
+            fo.write(line + "\n")
+            for _ in range(other):
+                fo.write(OTHER_LINES[k % len(OTHER_LINES)] + "\n")
+                k += 1
+
+
+def best(fn, use_mmap, repeat):
+    """
+    :return: (最小のCPU時間, 件数)
+    """
+    result = None
+    for _ in range(repeat):
+        mp = MaillogParser(fn, 2017)
+        mp.use_mmap = use_mmap
+        mp.pop_parsed_line = True
+        start = time.process_time()
+        n = sum(1 for _ in mp.parse())
+        elapsed = time.process_time() - start
+        if result is None or elapsed < result[0]:
+            result = (elapsed, n)
+    return result
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--messages', type=int, default=20000, help='生成するログのメッセージ数(ホストごと)')
+    p.add_argument('--other', default="0,1,3,9", help='postfixの行1行あたりのpostfix以外の行数(カンマ区切り)')
+    p.add_argument('--repeat', type=int, default=5, help='計測の回数(最小値を表示)')
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for other in [int(v) for v in args.other.split(",")]:
+            fn = os.path.join(tmpdir, "maillog")
+            write_log(fn, args.messages, other)
+            text = best(fn, False, args.repeat)
+            mm = best(fn, True, args.repeat)
+            print("postfix lines {0:3.0f}%: {1} bytes, text {2:.3f}s, mmap {3:.3f}s (x{4:.2f}) records {5}".format(
+                100.0 / (other + 1), os.path.getsize(fn), text[0], mm[0], text[0] / mm[0], mm[1]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# MaillogPipeline(--workers)の処理時間を1プロセスの解析と比較します。
+#  python benchmarks/bench_pipeline.py --messages 100000 --workers 1,2,4
+#
+# 読み取りプロセスとワーカーのCPU時間を別々に計測し、ワーカー数分のCPUがある場合の
+# 処理時間の下限(読み取りプロセスのCPU時間と、ワーカー1つあたりのCPU時間の大きい方)から
+# 見込みの速度向上を表示します。CPUがワーカー数より少ない環境では実時間は短くなりません。
+import argparse
+import gzip
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+
+from support import sample_lines  # noqa: E402
+from PostfixLogParser import MaillogParser, MaillogPipeline, MaillogTSVWriter  # noqa: E402
+
+
+def children_cpu():
+    r = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r.ru_utime + r.ru_stime
+
+
+def run_single(fn, compressed):
+    """
+    1プロセスで解析し、TSVの文字列に変換します。
+    :return: (実時間, CPU時間, 件数)
+    """
+    mp = MaillogParser(fn, 2017)
+    mp.compressed = compressed
+    mp.pop_parsed_line = True
+    fmt = MaillogTSVWriter()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    batch = []
+    for m in mp.parse():
+        batch.append(m)
+        if len(batch) >= 1000:
+            fmt.format_many(batch)
+            batch = []
+    if batch:
+        fmt.format_many(batch)
+    return time.perf_counter() - wall, time.process_time() - cpu, mp.parsed_count
+
+
+def run_pipeline(fn, compressed, workers):
+    """
+    ワーカーでTSVの文字列に変換して解析します。
+    :return: (実時間, 読み取りプロセスのCPU時間, 全ワーカーのCPU時間, 件数)
+    """
+    mp = MaillogParser(fn, 2017)
+    mp.compressed = compressed
+    source = MaillogPipeline(mp, workers, formatter=MaillogTSVWriter)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    child = children_cpu()
+    for _ in source.parse():
+        pass
+    return (time.perf_counter() - wall, time.process_time() - cpu, children_cpu() - child,
+            source.parsed_count)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--input', help='解析するログ(省略した場合は生成したログ)')
+    p.add_argument('--messages', type=int, default=50000, help='生成するログのメッセージ数(ホストごと)')
+    p.add_argument('--workers', default="1,2,4", help='ワーカー数(カンマ区切り)')
+    p.add_argument('--plain', action='store_true', help='生成したログを圧縮しない')
+    p.add_argument('--repeat', type=int, default=3, help='計測の回数(最小値を表示)')
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = args.input
+        if fn is None:
+            fn = os.path.join(tmpdir, "maillog" if args.plain else "maillog.gz")
+            text = "\n".join(sample_lines(args.messages, hosts=("mx1", "mx2"))) + "\n"
+            with (open(fn, "w") if args.plain else gzip.open(fn, "wt")) as f:
+                f.write(text)
+        compressed = fn.endswith(".gz")
+
+        print("input: {0} ({1} bytes), cpus: {2}".format(fn, os.path.getsize(fn), os.cpu_count()))
+        single = min(run_single(fn, compressed) for _ in range(args.repeat))
+        print("single   : wall {0:.2f}s cpu {1:.2f}s records {2}".format(*single))
+        for n in [int(v) for v in args.workers.split(",")]:
+            r = min(run_pipeline(fn, compressed, n) for _ in range(args.repeat))
+            # ワーカー数分のCPUがある場合の処理時間の下限
+            bound = max(r[1], r[2] / n)
+            print("workers={0}: wall {1:.2f}s reader cpu {2:.2f}s worker cpu {3:.2f}s ({4:.2f}s/worker) "
+                  "records {5} -> expected speedup x{6:.2f} with {0} cpus".format(
+                      n, r[0], r[1], r[2], r[2] / n, r[3], single[1] / bound))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
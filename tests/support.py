@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# テストで使用するログの生成と、書き込んだメールログを保持するWriter
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PostfixLogParser import MaillogWriter  # noqa: E402
+
+
+def sample_lines(count, hosts=("mx1",), start_second=0, long_queue_id=False):
+    """
+    1通あたり5行(smtpd, cleanup, qmgr, smtp, qmgr removed)のログを作成します。
+    ホストごとに同じキューIDを使用するため、ホスト名とキューIDで区別されることも確認できます。
+    :param count:           メッセージの数(ホストごと)
+    :param hosts:           ホスト名のリスト
+    :param start_second:    最初の行の時刻(0時からの秒)
+    :param long_queue_id:   enable_long_queue_ids形式のキューIDを使用する場合はTrue
+    :return:                行のリスト(時刻順)
+    """
+    lines = []
+    for i in range(count):
+        sec = start_second + i
+        ts = "Mar  1 {0:02d}:{1:02d}:{2:02d}".format(sec // 3600 % 24, sec // 60 % 60, sec % 60)
+        qid = "3Vq{0:07d}Bz".format(i) if long_queue_id else "{0:X}".format(0xA00000 + i)
+        for host in hosts:
+            lines.extend([
+                "{0} {1} postfix/smtpd[100]: {2}: client=ext.example.com[198.51.100.7]".format(ts, host, qid),
+                "{0} {1} postfix/cleanup[101]: {2}: message-id=<{3}.{2}@example.com>".format(ts, host, qid, host),
+                "{0} {1} postfix/qmgr[102]: {2}: from=<a{3}@example.com>, size={3}, nrcpt=1 (queue active)".format(
+                    ts, host, qid, i),
+                "{0} {1} postfix/smtp[103]: {2}: to=<b{3}@example.org>, relay=relay.example.net[203.0.113.5]:25, "
+                "delay=0.{4}, delays=0/0/0/0.{4}, dsn=2.0.0, status=sent (250 2.0.0 Ok: queued as F{2})".format(
+                    ts, host, qid, i, i % 10),
+                "{0} {1} postfix/qmgr[102]: {2}: removed".format(ts, host, qid),
+            ])
+    return lines
+
+
+class ListWriter(MaillogWriter):
+    """
+    書き込まれたメールログをリストに保持するWriterです。
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def connect(self):
+        pass
+
+    def insert(self, m: dict):
+        self.records.append(m)
+
+    def insert_many(self, ms: list):
+        self.records.extend(ms)
+
+    def disconnect(self):
+        pass
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# RecordCacheに保存したメールログが、解析した結果と一致することを確認します。
+#  python -m unittest discover tests
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, RecordCache
+
+
+class RecordCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = RecordCache(os.path.join(self.tmpdir, "cache"))
+        self.fn = os.path.join(self.tmpdir, "maillog")
+        lines = sample_lines(30, hosts=("mx1", "mx2"))
+        # RFC 3339形式(マイクロ秒あり)の行と、解析が終わらないメールログ
+        lines.append("2017-03-01T09:00:00.250000+09:00 mx1 postfix/smtpd[100]: B00000: client=a.example.com[192.0.2.1]")
+        lines.append("Mar  1 01:00:00 mx2 postfix/smtpd[100]: B00001: client=b.example.com[192.0.2.2]")
+        with open(self.fn, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _parser(self):
+        mp = MaillogParser(self.fn, 2017)
+        mp.pop_parsed_line = True
+        mp.collect_recipients = True
+        return mp
+
+    def test_round_trip(self):
+        self.assertIsNone(self.cache.load(self._parser()))
+        mp = self._parser()
+        recording = self.cache.record(mp, mp)
+        parsed = list(recording.parse())
+        noncomplete = list(recording.get_noncomplete_maillog())
+
+        cached = self.cache.load(self._parser())
+        self.assertIsNotNone(cached)
+        self.assertEqual(list(cached.parse()), parsed)
+        self.assertEqual(list(cached.get_noncomplete_maillog()), noncomplete)
+        self.assertEqual(cached.parsed_count, mp.parsed_count)
+        self.assertEqual(len(noncomplete), 2)
+        # 宛先ごとの試行のdelaysはタプル、日時はマイクロ秒も含めて復元される
+        self.assertIsInstance(parsed[0]["rcpt"][0][MaillogParser._rcpt_index["delays"]], tuple)
+        self.assertEqual([m["date_start_date"] for m in cached.get_noncomplete_maillog()],
+                         [m["date_start_date"] for m in noncomplete])
+
+    def test_datetime_codec(self):
+        # 日時は数値の並びとして保存し、タイムゾーン(UTCとの差)とマイクロ秒も復元する
+        values = [datetime.datetime(2017, 3, 1, 9, 0, 0, 250000),
+                  datetime.datetime(2017, 12, 31, 23, 59, 59, tzinfo=datetime.timezone(datetime.timedelta(hours=9)))]
+        text = json.dumps(values, default=RecordCache._default)
+        self.assertNotIn("T", text)
+        restored = json.loads(text, object_hook=RecordCache._object_hook)
+        self.assertEqual(restored, values)
+        self.assertEqual(restored[1].utcoffset(), values[1].utcoffset())
+
+    def test_key_follows_handler_code(self):
+        def handler(ml, store):
+            return False
+
+        def changed(ml, store):
+            return True
+
+        mp = self._parser()
+        base = self.cache.key(mp)
+        mp.register_handler("test", handler)
+        registered = self.cache.key(mp)
+        mp.register_handler("test", changed)
+        self.assertEqual(len({base, registered, self.cache.key(mp)}), 3)
+        mp.register_handler("test", handler)
+        self.assertEqual(self.cache.key(mp), registered)
+        # 他のパーサーのキーは変わらない
+        self.assertEqual(self.cache.key(self._parser()), base)
+
+    def test_broken_cache(self):
+        mp = self._parser()
+        recording = self.cache.record(mp, mp)
+        list(recording.parse())
+        recording.get_noncomplete_maillog()
+        path = self.cache.path(self.cache.key(mp))
+        with open(path, "a") as f:
+            f.write('["records", [["host"], [1]]]\n')
+        with open(path) as f:
+            lines = f.readlines()
+        with open(path, "w") as f:
+            f.writelines(lines[:1] + lines[-1:])
+        with self.assertRaises(ValueError):
+            list(self.cache.load(mp).parse())
+
+
+if __name__ == "__main__":
+    unittest.main()
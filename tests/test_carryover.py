@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# ローテートされたファイルを1つのパーサーで解析する(--carryover)場合の出力を確認します。
+#  python -m unittest discover tests
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from support import sample_lines
+from PostfixLogParser import arg_parse, run
+
+
+class CarryoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, "in")
+        self.outdir = os.path.join(self.tmpdir, "out")
+        os.makedirs(self.indir)
+        os.makedirs(self.outdir)
+        # ローテートされた古いファイル(b.log)の方が、名前の順では後になる
+        now = time.time()
+        lines = sample_lines(2)
+        self._write("b.log", lines[:3], now - 10)
+        self._write("a.log", lines[3:], now)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, lines, mtime):
+        fn = os.path.join(self.indir, name)
+        with open(fn, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.utime(fn, (mtime, mtime))
+
+    def _run(self, *options):
+        argv = ["PostfixLogParser.py", "--inputs", os.path.join(self.indir, "*.log"), "--output", self.outdir,
+                "--year", "2017", "--export-type", "JSON"] + list(options)
+        with mock.patch("sys.argv", argv), self.assertLogs(level="INFO"):
+            run(arg_parse())
+
+    def _output(self, name):
+        with open(os.path.join(self.outdir, name + ".log.txt")) as f:
+            return [(m["queue_id"], m["parse_end"], len(m["proc"])) for m in map(json.loads, f)]
+
+    def test_carryover(self):
+        # ファイルをまたがるメールログは1件にまとめられ、新しいファイルの出力に書き込まれる
+        self._run("--carryover")
+        self.assertEqual(self._output("b"), [])
+        self.assertEqual(self._output("a"), [("A00000", True, 5), ("A00001", True, 5)])
+
+    def test_without_carryover(self):
+        # ファイルごとに解析すると、ファイルをまたがるメールログは2件に分かれる
+        self._run()
+        self.assertEqual(self._output("b"), [("A00000", False, 3)])
+        self.assertEqual(self._output("a"), [("A00000", True, 2), ("A00001", True, 5)])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# MaillogCorrelator(--correlate)がホストをまたがるメールログを1つの経路に結合することを確認します。
+#  python -m unittest discover tests
+import datetime
+import re
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, MaillogCorrelator
+
+# mx1からrelay1への中継(応答の「queued as」で引き渡し先が分かる)と、relay1での配送
+RELAY_LINES = [
+    "Mar  1 10:00:01 mx1 postfix/smtpd[100]: 3A1B2C: client=ext.example.com[198.51.100.7]",
+    "Mar  1 10:00:01 mx1 postfix/cleanup[101]: 3A1B2C: message-id=<abc@example.com>",
+    "Mar  1 10:00:01 mx1 postfix/qmgr[102]: 3A1B2C: from=<a@example.com>, size=100, nrcpt=1 (queue active)",
+    "Mar  1 10:00:02 mx1 postfix/smtp[103]: 3A1B2C: to=<b@example.org>, relay=relay1.example.net[203.0.113.5]:25, "
+    "delay=1, delays=0/0/0/1, dsn=2.0.0, status=sent (250 2.0.0 Ok: queued as 9F8E7D)",
+    "Mar  1 10:00:02 mx1 postfix/qmgr[102]: 3A1B2C: removed",
+    "Mar  1 10:00:03 relay1 postfix/smtpd[200]: 9F8E7D: client=mx1.example.com[203.0.113.1]",
+    # 中継先でmessage-idが付け直された場合も、キューIDで結合する
+    "Mar  1 10:00:03 relay1 postfix/cleanup[201]: 9F8E7D: message-id=<rewritten@relay1.example.net>",
+    "Mar  1 10:00:03 relay1 postfix/qmgr[202]: 9F8E7D: from=<a@example.com>, size=120, nrcpt=1 (queue active)",
+    "Mar  1 10:00:05 relay1 postfix/local[203]: 9F8E7D: to=<b@example.org>, relay=local, delay=2, "
+    "delays=0/0/0/2, dsn=2.0.0, status=sent (delivered to mailbox)",
+    "Mar  1 10:00:05 relay1 postfix/qmgr[202]: 9F8E7D: removed",
+]
+
+
+def _records(lines):
+    mp = MaillogParser(None, 2017)
+    mp.pop_parsed_line = True
+    mp.collect_recipients = True
+    return list(mp.parse_lines(lines))
+
+
+class MaillogCorrelatorTest(unittest.TestCase):
+
+    def test_relay_handoff(self):
+        mc = MaillogCorrelator()
+        for m in _records(RELAY_LINES):
+            self.assertEqual(mc.add(m), [])
+        traces = mc.flush()
+        self.assertEqual(len(traces), 1)
+        tr = traces[0]
+        self.assertEqual(tr["message_id"], "abc@example.com")
+        self.assertEqual([(h["host"], h["queue_id"]) for h in tr["hops"]], [("mx1", "3A1B2C"), ("relay1", "9F8E7D")])
+        self.assertEqual(tr["hops"][1]["wait"], 1.0)
+        self.assertEqual(tr["total_latency"], 4.0)
+
+    def test_message_id_across_hosts(self):
+        # 応答に引き渡し先のキューIDがない場合、同じキューID(A00000)でもホストとmessage-idが異なれば別の経路
+        lines = [re.sub(r"Ok: queued as \w+", "Ok", line) for line in sample_lines(2, hosts=("mx1", "mx2"))]
+        records = _records(lines)
+        mc = MaillogCorrelator()
+        for m in records:
+            mc.add(m)
+        traces = mc.flush()
+        self.assertEqual(len(traces), 4)
+        self.assertEqual({t["hop_count"] for t in traces}, {1})
+
+        # message-idが一致するレコードは1つの経路にまとめる
+        for m in records:
+            m["message_id"] = "same-{0}@example.com".format(m["queue_id"])
+        mc = MaillogCorrelator()
+        for m in records:
+            mc.add(m)
+        traces = mc.flush()
+        self.assertEqual(sorted((t["message_id"], t["hop_count"]) for t in traces),
+                         [("same-A00000@example.com", 2), ("same-A00001@example.com", 2)])
+
+    def test_shared_handoff(self):
+        # 引き渡し先(relay/FA00000)が同じレコードは、message-idが異なっても1つの経路にまとめる
+        mc = MaillogCorrelator()
+        for m in _records(sample_lines(1, hosts=("mx1", "mx2"))):
+            mc.add(m)
+        self.assertEqual([t["hop_count"] for t in mc.flush()], [2])
+
+    def test_window(self):
+        # 最後の更新からwindow秒を超えた経路は、次のレコードの追加で確定する
+        mc = MaillogCorrelator(window=60)
+        records = _records(sample_lines(1) + sample_lines(2, start_second=119)[5:])
+        first, later = records[0], records[1]
+        self.assertEqual(first["date_end_date"], datetime.datetime(2017, 3, 1, 0, 0, 0))
+        self.assertEqual(mc.add(first), [])
+        done = mc.add(later)
+        self.assertEqual([t["hops"][0]["queue_id"] for t in done], ["A00000"])
+
+    def test_max_entries(self):
+        mc = MaillogCorrelator(max_entries=2)
+        done = []
+        for m in _records(sample_lines(3)):
+            done.extend(mc.add(m))
+        self.assertEqual([t["hops"][0]["queue_id"] for t in done], ["A00000"])
+        self.assertEqual(len(mc.flush()), 2)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# ログの日付(RFC 3339形式と年を含まない形式)の解析を確認します。
+#  python -m unittest discover tests
+import datetime
+import os
+import time
+import unittest
+
+import support  # noqa: F401
+from PostfixLogParser import MaillogParser
+
+
+def _starts(lines, year=2017):
+    """
+    1行ずつ別のキューIDの行を解析し、各メールログの開始日時を返します。
+    """
+    mp = MaillogParser(None, year)
+    rows = ["{0} mx1 postfix/smtpd[100]: A{1:05X}: client=a.example.com[192.0.2.1]".format(d, i)
+            for i, d in enumerate(lines)]
+    list(mp.parse_lines(rows))
+    return [m["date_start_date"] for m in sorted(mp.get_noncomplete_maillog(), key=lambda m: m["queue_id"])]
+
+
+class DateParseTest(unittest.TestCase):
+
+    def test_rfc3339(self):
+        # タイムゾーンがある場合はUTCに変換し、ない場合はそのまま返す(マイクロ秒は保持する)
+        self.assertEqual(_starts([
+            "2017-03-01T09:00:00.25+09:00",
+            "2017-03-01T00:00:01Z",
+            "2017-02-28T19:00:02-0500",
+            "2017-03-01T09:00:03.123456789",
+            "2017-03-01T09:00:04",
+        ]), [
+            datetime.datetime(2017, 3, 1, 0, 0, 0, 250000),
+            datetime.datetime(2017, 3, 1, 0, 0, 1),
+            datetime.datetime(2017, 3, 1, 0, 0, 2),
+            datetime.datetime(2017, 3, 1, 9, 0, 3, 123456),
+            datetime.datetime(2017, 3, 1, 9, 0, 4),
+        ])
+
+    @unittest.skipUnless(hasattr(time, "tzset"), "time.tzset is not available")
+    def test_rfc3339_does_not_depend_on_local_timezone(self):
+        lines = ["2017-03-01T09:00:00+09:00", "2017-03-01T09:00:01Z"]
+        expected = _starts(lines)
+        tz = os.environ.get("TZ")
+        try:
+            for name in ("UTC", "Asia/Tokyo", "America/New_York"):
+                os.environ["TZ"] = name
+                time.tzset()
+                self.assertEqual(_starts(lines), expected)
+        finally:
+            if tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = tz
+            time.tzset()
+
+    def test_year_rollover(self):
+        # 12月から1月に戻った時点で年を繰り上げ、その後に遅れて届いた12月の行は前年とする
+        self.assertEqual(_starts([
+            "Dec 31 23:59:58",
+            "Jan  1 00:00:01",
+            "Dec 31 23:59:59",
+            "Jan  2 00:00:00",
+            "Feb  1 00:00:00",
+        ]), [
+            datetime.datetime(2017, 12, 31, 23, 59, 58),
+            datetime.datetime(2018, 1, 1, 0, 0, 1),
+            datetime.datetime(2017, 12, 31, 23, 59, 59),
+            datetime.datetime(2018, 1, 2, 0, 0, 0),
+            datetime.datetime(2018, 2, 1, 0, 0, 0),
+        ])
+
+    def test_invalid_date(self):
+        with self.assertRaises(ValueError):
+            _starts(["Feb 30 00:00:00"])
+
+
+if __name__ == "__main__":
+    unittest.main()
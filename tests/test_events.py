@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# smtpdのイベント(接続、切断、キュー投入前の拒否)の抽出と、SmtpdEventCollectorの集計を確認します。
+#  python -m unittest discover tests
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, SmtpdEventCollector
+
+EVENT_LINES = [
+    "Mar  1 00:00:00 mx1 postfix/smtpd[100]: connect from unknown[192.0.2.1]",
+    "Mar  1 00:00:01 mx1 postfix/smtpd[100]: NOQUEUE: reject: RCPT from unknown[192.0.2.1]: 554 5.7.1 "
+    "<x@example.com>: Relay access denied; from=<a@example.net> to=<x@example.com> proto=ESMTP helo=<example.net>",
+    "Mar  1 00:00:02 mx1 postfix/smtpd[100]: NOQUEUE: reject: RCPT from unknown[192.0.2.1]: 450 4.7.1 "
+    "<y@example.com>: Recipient address rejected: greylisted; from=<a@example.net> to=<y@example.com> proto=ESMTP "
+    "helo=<example.net>",
+    "Mar  1 00:03:00 mx1 postfix/smtpd[100]: NOQUEUE: reject: RCPT from unknown[192.0.2.1]: 554 5.7.1 "
+    "<z@example.com>: Relay access denied; from=<a@example.net> to=<z@example.com> proto=ESMTP helo=<example.net>",
+    "Mar  1 00:03:01 mx1 postfix/smtpd[100]: disconnect from unknown[192.0.2.1] ehlo=1 rcpt=0/3 quit=1 commands=2/5",
+    "Mar  1 00:03:02 mx1 postfix/smtpd[101]: connect from ext.example.com[198.51.100.7]",
+]
+
+
+class SmtpdEventTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _parse(self, collector, lines):
+        mp = MaillogParser(None, 2017)
+        mp.event_sink = collector
+        return list(mp.parse_lines(lines))
+
+    def test_events(self):
+        events = []
+        # イベントの行はメールログには含まれない
+        records = self._parse(events.append, sample_lines(1) + EVENT_LINES)
+        self.assertEqual([m["queue_id"] for m in records], ["A00000"])
+        self.assertEqual([ev["event"] for ev in events],
+                         ["connect", "reject", "reject", "reject", "disconnect", "connect"])
+        ev = events[1]
+        self.assertEqual(ev["date"], datetime.datetime(2017, 3, 1, 0, 0, 1))
+        self.assertEqual((ev["client_ip"], ev["reject_stage"], ev["reject_code"], ev["dsn"]),
+                         ("192.0.2.1", "RCPT", "554", "5.7.1"))
+        self.assertEqual((ev["sender"], ev["recipient"], ev["helo"]), ("a@example.net", "x@example.com", "example.net"))
+        self.assertEqual(ev["reason"], "<x@example.com>: Relay access denied")
+        self.assertEqual((events[0]["client_host"], events[0]["client_ip"]), ("unknown", "192.0.2.1"))
+
+    def test_summary(self):
+        path = os.path.join(self.tmpdir, "events.json")
+        collector = SmtpdEventCollector(path, window=60)
+        self._parse(collector, EVENT_LINES)
+        collector.close()
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 6)
+        self.assertEqual(dict(collector.totals), {"connect": 2, "reject": 3, "disconnect": 1})
+        rows = collector.summary()
+        self.assertEqual([r["client_ip"] for r in rows], ["192.0.2.1", "198.51.100.7"])
+        r = rows[0]
+        self.assertEqual((r["connect"], r["disconnect"], r["reject"]), (1, 1, 3))
+        # 00:00:01と00:00:02の拒否は同じ時間枠、00:03:00は次の時間枠
+        self.assertEqual(r["peak_per_window"], 2)
+        self.assertEqual(r["reject_per_min"], round(3 * 60 / 181, 3))
+        self.assertEqual(r["codes"], "554:2,450:1")
+
+    def test_max_clients(self):
+        collector = SmtpdEventCollector(max_clients=1)
+        self._parse(collector, EVENT_LINES)
+        self.assertEqual([r["client_ip"] for r in collector.summary()], ["198.51.100.7"])
+        self.assertEqual(collector.evicted, 1)
+        with self.assertRaises(ValueError):
+            SmtpdEventCollector(max_clients=0)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# 種類の少ない値(ホスト名、プロセス名、中継先、配送結果)が、メールログ間で同じ文字列オブジェクトを共有することを確認します。
+#  python -m unittest discover tests
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser
+
+SHARED = ("host", "relay_host", "relay_ip", "relay_port", "dsn", "status")
+
+
+class InternTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "maillog")
+        with open(self.fn, "w") as fo:
+            fo.write("\n".join(sample_lines(3)) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, records):
+        self.assertEqual(len(records), 3)
+        first = records[0]
+        for m in records[1:]:
+            for k in SHARED:
+                a = first[k][0] if isinstance(first[k], list) else first[k]
+                b = m[k][0] if isinstance(m[k], list) else m[k]
+                self.assertEqual(a, b, k)
+                self.assertIs(a, b, k)
+            for a, b in zip(first["proc"], m["proc"]):
+                self.assertIs(a, b)
+
+    def test_text(self):
+        mp = MaillogParser(self.fn, 2017)
+        mp.pop_parsed_line = True
+        self._check(list(mp.parse()))
+
+    def test_mmap(self):
+        mp = MaillogParser(self.fn, 2017)
+        mp.use_mmap = True
+        mp.pop_parsed_line = True
+        self._check(list(mp.parse()))
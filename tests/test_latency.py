@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# 遅延時間のスケッチ(LatencySketch)とLatencyAnalyzer(--latency-report)のパーセンタイル、結合、保存を確認します。
+#  python -m unittest discover tests
+import math
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, LatencySketch, LatencyAnalyzer
+
+try:
+    import numpy  # noqa: F401
+except ImportError:
+    numpy = None
+
+
+def _exact(values, q):
+    """
+    LatencySketch.quantilesと同じ順位(ceil(q×件数))の値を返します。
+    """
+    values = sorted(values)
+    return values[min(max(math.ceil(q * len(values)), 1), len(values)) - 1]
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class LatencySketchTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(0)
+        self.values = [rnd.lognormvariate(0, 2) for _ in range(20000)]
+
+    def test_relative_error(self):
+        sk = LatencySketch()
+        sk.add_many(self.values)
+        self.assertEqual(sk.count, len(self.values))
+        for q, v in zip(LatencyAnalyzer.quantiles, sk.quantiles(LatencyAnalyzer.quantiles)):
+            exact = _exact(self.values, q)
+            self.assertLessEqual(abs(v - exact) / exact, LatencySketch.PRECISION, q)
+
+    def test_merge(self):
+        whole = LatencySketch()
+        whole.add_many(self.values)
+        a = LatencySketch()
+        b = LatencySketch()
+        a.add_many(self.values[:5000])
+        b.add_many(self.values[5000:])
+        a.merge(b)
+        self.assertEqual(a.buckets, whole.buckets)
+
+    def test_small_and_empty(self):
+        sk = LatencySketch()
+        self.assertEqual(sk.quantiles([0.5]), [None])
+        sk.add_many([0, 0.0001])
+        self.assertEqual(sk.quantiles([0.5, 0.99]), [0.0, 0.0])
+        with self.assertRaises(ValueError):
+            LatencySketch({-1: 1})
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class LatencyAnalyzerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _analyzer(lines, window=3600):
+        mp = MaillogParser(None, 2017)
+        mp.collect_recipients = True
+        la = LatencyAnalyzer(window)
+        for m in mp.parse_lines(lines):
+            la.add(m)
+        return la
+
+    def test_report(self):
+        # 10通(delay=0.0〜0.9)が同じ時間枠・中継先・宛先ドメインに集計される
+        la = self._analyzer(sample_lines(10))
+        rows = {row[3]: row for row in la.report()}
+        self.assertEqual(set(rows), set(LatencyAnalyzer.metrics))
+        window, relay, domain, _, count, p50, p95, p99 = rows["delay"]
+        self.assertEqual((window, relay, domain, count),
+                         ("2017-03-01T00:00:00", "relay.example.net", "example.org", 10))
+        self.assertAlmostEqual(p50, 0.4, delta=0.4 * LatencySketch.PRECISION)
+        self.assertAlmostEqual(p99, 0.9, delta=0.9 * LatencySketch.PRECISION)
+
+    def test_windows(self):
+        la = self._analyzer(sample_lines(2, start_second=3599), window=3600)
+        windows = sorted({row[0] for row in la.report()})
+        self.assertEqual(windows, ["2017-03-01T00:00:00", "2017-03-01T01:00:00"])
+        with self.assertRaises(ValueError):
+            LatencyAnalyzer(7)
+
+    def test_save_load_merge(self):
+        a = self._analyzer(sample_lines(10))
+        b = self._analyzer(sample_lines(20)[50:])
+        path = os.path.join(self.tmpdir, "a.npz")
+        a.save(path)
+        merged = LatencyAnalyzer.load(path)
+        self.assertEqual(merged.report(), a.report())
+        merged.merge(b)
+        whole = self._analyzer(sample_lines(20))
+        self.assertEqual(merged.report(), whole.report())
+        with self.assertRaises(ValueError):
+            merged.merge(LatencyAnalyzer(60))
+
+    def test_requires_recipients(self):
+        mp = MaillogParser(None, 2017)
+        m = next(iter(mp.parse_lines(sample_lines(1))))
+        with self.assertRaises(ValueError):
+            LatencyAnalyzer().add(m)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# 行形式のプロファイル(syslog_name、キューIDの形式)ごとに解析される行を確認します。
+#  python -m unittest discover tests
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser
+
+
+def _parse(lines, profile):
+    mp = MaillogParser(None, 2017)
+    mp.line_profile = profile
+    return [(m["host"], m["queue_id"]) for m in mp.parse_lines(lines)]
+
+
+class LineProfileTest(unittest.TestCase):
+
+    def tearDown(self):
+        for name in ("test_multi", "test_both"):
+            MaillogParser.line_profiles.pop(name, None)
+
+    def test_syslog_names(self):
+        # マルチインスタンス(postfix-out)の行は、syslog_namesに含めた場合のみ解析する
+        lines = sample_lines(1) + [line.replace("postfix/", "postfix-out/") for line in sample_lines(2)[5:]]
+        self.assertEqual(_parse(lines, "default"), [("mx1", "A00000")])
+        MaillogParser.register_line_profile("test_multi", ["postfix", "postfix-out"])
+        self.assertEqual(_parse(lines, "test_multi"), [("mx1", "A00000"), ("mx1", "A00001")])
+
+    def test_queue_id_styles(self):
+        short = sample_lines(1)
+        long = sample_lines(2, long_queue_id=True)[5:]
+        self.assertEqual(_parse(short + long, "default"), [("mx1", "A00000")])
+        self.assertEqual(_parse(short + long, "long_queue_id"), [("mx1", "3Vq0000001Bz")])
+        MaillogParser.register_line_profile("test_both", queue_id="both")
+        self.assertEqual(_parse(short + long, "test_both"), [("mx1", "A00000"), ("mx1", "3Vq0000001Bz")])
+
+    def test_process_name_with_hyphen(self):
+        line = "Mar  1 00:00:00 mx1 postfix/trivial-rewrite[105]: A00000: whatever"
+        s = MaillogParser.line_pattern().search(line)
+        self.assertEqual(s.group("proc"), "trivial-rewrite")
+
+    def test_pattern_is_compiled_once(self):
+        self.assertIs(MaillogParser.line_pattern("default"), MaillogParser.line_pattern("default"))
+        self.assertIs(MaillogParser.line_pattern("default", binary=True),
+                      MaillogParser.line_pattern("default", binary=True))
+        # 登録し直した場合は新しい正規表現を生成する
+        MaillogParser.register_line_profile("test_multi", ["postfix"])
+        before = MaillogParser.line_pattern("test_multi")
+        MaillogParser.register_line_profile("test_multi", ["postfix", "postfix-out"])
+        self.assertIsNot(MaillogParser.line_pattern("test_multi"), before)
+
+    def test_invalid_profile(self):
+        with self.assertRaises(ValueError):
+            MaillogParser.register_line_profile("test_multi", queue_id="unknown")
+        with self.assertRaises(ValueError):
+            MaillogParser(None, 2017).line_profile = "unknown"
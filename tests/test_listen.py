@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# SyslogReceiverをローカルの送信元から受信させて確認します。
+#  python -m unittest discover tests
+# 受信の処理速度(1コア)の下限は環境変数 PLP_LISTEN_MIN_RATE (行/秒) で変更できます。
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import time
+import unittest
+from unittest import mock
+
+from support import sample_lines, ListWriter
+from PostfixLogParser import MaillogParser, SyslogReceiver, arg_parse
+
+MIN_RATE = float(os.environ.get("PLP_LISTEN_MIN_RATE", "10000"))
+
+
+class FailingWriter(ListWriter):
+    """
+    書き込みに失敗するWriterです。
+    """
+    def insert_many(self, ms: list):
+        raise OSError("disk full")
+
+
+class SyslogReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.writer = ListWriter()
+        mp = MaillogParser(None, 2017)
+        mp.pop_parsed_line = True
+        self.receiver = SyslogReceiver(mp, self.writer)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _serve(self, send, expected, timeout=60):
+        """
+        ポート0で待ち受け、send(receiver)で送信した後、expected件書き込まれるまで待ってから停止します。
+        :return: 送信を開始してから書き込まれるまでの秒数
+        """
+        async def scenario():
+            task = self.loop.create_task(self.receiver.serve(
+                udp=("127.0.0.1", 0), tcp=("127.0.0.1", 0), stats_interval=3600))
+            while self.receiver.tcp_address is None or self.receiver.udp_address is None:
+                await asyncio.sleep(0.01)
+            try:
+                start = time.perf_counter()
+                await send(self.receiver)
+                end = start + timeout
+                while self.receiver.written < expected and time.perf_counter() < end:
+                    await asyncio.sleep(0.01)
+                return time.perf_counter() - start
+            finally:
+                # キャンセルしても、待ち受けを閉じてキューに残った行を書き込む
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+        return self.loop.run_until_complete(scenario())
+
+    def test_framing(self):
+        lines = sample_lines(3)
+
+        async def send(receiver):
+            _, w = await asyncio.open_connection(*receiver.tcp_address)
+            # 改行区切り(RFC 3164)
+            w.write(("<22>" + "\n<22>".join(lines[:5]) + "\n").encode())
+            # octet-counting(RFC 6587)
+            for line in lines[5:10]:
+                data = ("<22>" + line).encode()
+                w.write("{0} ".format(len(data)).encode() + data)
+            await w.drain()
+            w.close()
+            # UDP(RFC 5424)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                for line in lines[10:]:
+                    head, msg = line.split(": ", 1)
+                    host, app = head.split()[3:5]
+                    proc, pid = app[:-1].split("[")
+                    s.sendto("<22>1 2017-03-01T00:00:02Z {0} {1} {2} - - {3}".format(
+                        host, proc, pid, msg).encode(), receiver.udp_address)
+
+        self._serve(send, 3)
+        self.assertEqual(self.receiver.errors, 0)
+        self.assertEqual(sorted(m["queue_id"] for m in self.writer.records), ["A00000", "A00001", "A00002"])
+        self.assertTrue(all(m["parse_end"] for m in self.writer.records))
+
+    def test_pri_less_lines_over_tcp(self):
+        # PRIのないRFC 3339形式の行は先頭が数字でも改行区切りとして扱い、octet-countingと混在できる
+        lines = sample_lines(2)
+        iso = [line.replace("Mar  1 00:00:00", "2017-03-01T00:00:00Z", 1) for line in lines[:5]]
+
+        async def send(receiver):
+            _, w = await asyncio.open_connection(*receiver.tcp_address)
+            w.write(("\n".join(iso) + "\n").encode())
+            for line in lines[5:]:
+                data = ("<22>" + line).encode()
+                w.write("{0} ".format(len(data)).encode() + data)
+            await w.drain()
+            w.close()
+
+        self._serve(send, 2)
+        self.assertEqual(self.receiver.errors, 0)
+        self.assertEqual(sorted(m["queue_id"] for m in self.writer.records), ["A00000", "A00001"])
+
+    def test_rfc5424_without_procid(self):
+        line = self.receiver.to_line("<22>1 2017-03-01T00:00:00Z mx1 postfix/qmgr - - - A00000: removed")
+        self.assertEqual(line, "2017-03-01T00:00:00Z mx1 postfix/qmgr[0]: A00000: removed")
+        self.assertIsNotNone(MaillogParser.line_pattern().search(line))
+
+    def test_writer_error_stops_serving(self):
+        # 書き込みに失敗した場合は受信を続けずに例外を送出する
+        self.receiver = SyslogReceiver(MaillogParser(None, 2017), FailingWriter())
+        lines = sample_lines(1)
+
+        async def scenario():
+            task = self.loop.create_task(self.receiver.serve(tcp=("127.0.0.1", 0), stats_interval=3600))
+            while self.receiver.tcp_address is None:
+                await asyncio.sleep(0.01)
+            _, w = await asyncio.open_connection(*self.receiver.tcp_address)
+            w.write(("\n".join(lines) + "\n").encode())
+            await w.drain()
+            w.close()
+            await asyncio.wait_for(task, 10)
+
+        with self.assertRaisesRegex(OSError, "disk full"):
+            self.loop.run_until_complete(scenario())
+
+    def test_file_options_are_rejected(self):
+        # 受信した行に適用されない指定は、黙って無視せずにエラーにする
+        for option in (["--partition"], ["--correlate", "trace.json"], ["--latency-report", "latency.tsv"],
+                       ["--workers", "2"]):
+            argv = ["PostfixLogParser.py", "--listen", "udp://127.0.0.1:0", "--output", "out"] + option
+            with mock.patch("sys.argv", argv), contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    arg_parse()
+
+    def test_bad_line_is_skipped(self):
+        lines = sample_lines(2)
+        lines.insert(1, "Feb 30 00:00:00 mx1 postfix/cleanup[101]: A00000: message-id=<bad@example.com>")
+
+        async def send(receiver):
+            _, w = await asyncio.open_connection(*receiver.tcp_address)
+            w.write(("\n".join(lines) + "\n").encode())
+            await w.drain()
+            w.close()
+
+        self._serve(send, 2)
+        # 解析できない行のみを読み飛ばし、同じバッチの残りの行は解析する
+        self.assertEqual(self.receiver.errors, 1)
+        self.assertEqual(len(self.writer.records), 2)
+        self.assertEqual(self.writer.records[0]["message_id"], "mx1.A00000@example.com")
+
+    def test_throughput(self):
+        count = 20000
+        lines = sample_lines(count)
+        payload = ("\n".join(lines) + "\n").encode()
+
+        async def send(receiver):
+            _, w = await asyncio.open_connection(*receiver.tcp_address)
+            w.write(payload)
+            await w.drain()
+            w.close()
+
+        elapsed = self._serve(send, count)
+        rate = len(lines) / elapsed
+        print("\nsyslog: {0} lines in {1:.2f}s ({2:.0f} lines/s) {3}".format(
+            len(lines), elapsed, rate, self.receiver.stats()))
+        self.assertEqual(self.receiver.written, count)
+        self.assertEqual(self.receiver.dropped, 0)
+        self.assertGreaterEqual(rate, MIN_RATE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# マニフェスト(--manifest)で処理済みのファイルを省略した場合の出力を確認します。
+#  python -m unittest discover tests
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from support import sample_lines
+from PostfixLogParser import arg_parse, run
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, "in")
+        self.outdir = os.path.join(self.tmpdir, "out")
+        os.makedirs(self.indir)
+        os.makedirs(self.outdir)
+        self.manifest = os.path.join(self.tmpdir, "manifest.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, lines, mtime, mode="w"):
+        fn = os.path.join(self.indir, name)
+        with open(fn, mode) as f:
+            f.write("\n".join(lines) + "\n")
+        os.utime(fn, (mtime, mtime))
+        return fn
+
+    def _run(self, *options):
+        argv = ["PostfixLogParser.py", "--inputs", os.path.join(self.indir, "*.log"), "--output", self.outdir,
+                "--year", "2017", "--export-type", "JSON", "--manifest", self.manifest] + list(options)
+        with mock.patch("sys.argv", argv), self.assertLogs(level="INFO"):
+            run(arg_parse())
+
+    def _output(self, name):
+        with open(os.path.join(self.outdir, name + ".log.txt")) as f:
+            return [json.loads(line) for line in f]
+
+    def test_carryover_with_unchanged_last_input(self):
+        # 最後のファイルが変更されておらず省略された場合も、引き継いだ解析途中のログを書き込む
+        now = time.time()
+        lines = sample_lines(3)
+        self._write("a.log", lines[:5], now - 20)
+        self._write("b.log", lines[5:10], now - 10)
+        self._run("--carryover")
+        self.assertEqual(len(self._output("a")), 1)
+        self.assertEqual(len(self._output("b")), 1)
+
+        # 古い方のファイルに追記され、途中のメールログが解析を終えないまま残る
+        self._write("a.log", lines[10:12], now - 20, mode="a")
+        self._run("--carryover")
+        appended = self._output("a")
+        self.assertEqual(len(appended), 2)
+        self.assertEqual(appended[1]["queue_id"], "A00002")
+        self.assertFalse(appended[1]["parse_end"])
+        self.assertEqual(len(self._output("b")), 1)
+
+    def test_grown_after_partial_line(self):
+        # 書き込み途中の行で終わっていたファイルは、次回その行の先頭から解析する
+        lines = sample_lines(2)
+        fn = os.path.join(self.indir, "a.log")
+        with open(fn, "w") as f:
+            f.write("\n".join(lines[:4]) + "\n" + lines[4][:20])
+        self._run()
+        self.assertEqual([(m["queue_id"], m["parse_end"]) for m in self._output("a")], [("A00000", False)])
+        with open(fn, "a") as f:
+            f.write(lines[4][20:] + "\n" + "\n".join(lines[5:]) + "\n")
+        self._run()
+        out = self._output("a")
+        # 前回の実行で解析途中だったメールログは2件に分かれ、途中の行を含む後半は完了する
+        self.assertEqual([(m["queue_id"], m["parse_end"]) for m in out],
+                         [("A00000", False), ("A00000", True), ("A00001", True)])
+        self.assertEqual(out[1]["proc"], ["qmgr"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# MaillogMerger(--merge)で複数のホストのログが時刻順に並び、入力ごとの年で解析されることを確認します。
+#  python -m unittest discover tests
+import datetime
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, MaillogMerger
+
+
+def _shift(lines, date):
+    """
+    sample_linesの日付(Mar  1)を置き換えます。
+    """
+    return [line.replace("Mar  1", date, 1) for line in lines]
+
+
+class MaillogMergerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, lines):
+        fn = os.path.join(self.tmpdir, name)
+        with open(fn, "w") as fo:
+            fo.write("\n".join(lines) + "\n")
+        return fn
+
+    def _parse(self, merger):
+        mp = merger._parser
+        records = list(merger.parse()) + list(mp.get_noncomplete_maillog())
+        return {(m["host"], m["queue_id"]): m["date_start_date"] for m in records}
+
+    def test_lines_are_ordered(self):
+        a = self._write("mx1.log", sample_lines(4, hosts=("mx1",)))
+        b = self._write("mx2.log", sample_lines(3, hosts=("mx2",), start_second=1))
+        merger = MaillogMerger(MaillogParser(None, 2017), [a, b])
+        lines = list(merger.lines())
+        self.assertEqual(len(lines), 35)
+        self.assertEqual([line[:15] for line in lines], sorted(line[:15] for line in lines))
+        self.assertEqual(merger.clamped, 0)
+
+    def test_clock_going_back_keeps_input_order(self):
+        lines = sample_lines(3, start_second=10)
+        late = sample_lines(1, start_second=5)[0].replace("A00000", "B00000")
+        a = self._write("mx1.log", lines[:5] + [late] + lines[5:])
+        merger = MaillogMerger(MaillogParser(None, 2017), [a])
+        self.assertEqual(list(merger.lines())[5].rstrip("\n"), late)
+        self.assertEqual(merger.clamped, 1)
+        self.assertEqual(merger.jumps, 0)
+        # 並べ替えでは直前の行と同じ時刻として扱うが、メールログには行の時刻を記録する
+        merger = MaillogMerger(MaillogParser(None, 2017), [a])
+        self.assertEqual(self._parse(merger)[("mx1", "B00000")], datetime.datetime(2017, 3, 1, 0, 0, 5))
+
+    def test_year_per_input(self):
+        # 2016年に作成されたmx1と2017年に作成されたmx2は、同じ月日でも年の異なる行として記録する
+        a = self._write("mx1.log", sample_lines(1, hosts=("mx1",)))
+        b = self._write("mx2.log", sample_lines(1, hosts=("mx2",), start_second=1))
+        ctimes = {a: datetime.datetime(2016, 6, 1).timestamp(), b: datetime.datetime(2017, 6, 1).timestamp()}
+        with mock.patch("PostfixLogParser.os.stat", lambda fn: types.SimpleNamespace(st_ctime=ctimes[fn])):
+            merger = MaillogMerger(MaillogParser(None, 2017), [a, b], yearfromctime=True)
+        self.assertEqual(self._parse(merger), {
+            ("mx1", "A00000"): datetime.datetime(2016, 3, 1, 0, 0, 0),
+            ("mx2", "A00000"): datetime.datetime(2017, 3, 1, 0, 0, 1),
+        })
+
+    def test_year_rollover_within_input(self):
+        lines = (_shift(sample_lines(1, start_second=86399), "Dec 31") +
+                 _shift(sample_lines(2, start_second=0)[5:], "Jan  1"))
+        a = self._write("mx1.log", lines)
+        merger = MaillogMerger(MaillogParser(None, 2016), [a])
+        self.assertEqual(self._parse(merger), {
+            ("mx1", "A00000"): datetime.datetime(2016, 12, 31, 23, 59, 59),
+            ("mx1", "A00001"): datetime.datetime(2017, 1, 1, 0, 0, 1),
+        })
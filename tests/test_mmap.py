@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# メモリマップ(--mmap)で解析した結果が、テキストとして読み取った場合と一致することを確認します。
+#  python -m unittest discover tests
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser
+
+OTHER_LINES = [
+    "Mar  1 00:00:00 mx1 sshd[2001]: Accepted publickey for admin from 192.0.2.10 port 50022 ssh2",
+    # postfixを含むがpostfixの行ではない
+    "Mar  1 00:00:00 mx1 sudo[2002]: admin : COMMAND=/usr/sbin/postfix reload",
+    "Mar  1 00:00:00 mx1 kernel: [12345.678901] IN=eth0 OUT= SRC=198.51.100.7 DST=192.0.2.1 PROTO=TCP DPT=25",
+]
+
+
+class MmapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "maillog")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, data, fn=None):
+        with (gzip.open if fn else open)(fn or self.fn, "wt") as fo:
+            fo.write(data)
+
+    def _parse(self, use_mmap, compressed=False, fn=None):
+        mp = MaillogParser(fn or self.fn, 2017)
+        mp.use_mmap = use_mmap
+        mp.compressed = compressed
+        mp.pop_parsed_line = True
+        records = list(mp.parse()) + list(mp.get_noncomplete_maillog())
+        return [(m["host"], m["queue_id"], m["proc"], m["date_start_date"], m["status"]) for m in records], mp
+
+    def test_same_as_text(self):
+        lines = []
+        for i, line in enumerate(sample_lines(20, hosts=("mx1", "mx2"))):
+            lines.append(line)
+            lines.append(OTHER_LINES[i % len(OTHER_LINES)])
+        self._write("\n".join(lines[:-3]) + "\n")
+        text, mp_text = self._parse(False)
+        mm, mp_mm = self._parse(True)
+        self.assertEqual(len(text), 40)
+        self.assertEqual(mm, text)
+        self.assertEqual(mp_mm.parsed_count, mp_text.parsed_count)
+        self.assertEqual(mp_mm.end_offset, mp_text.end_offset)
+
+    def test_first_line_and_no_trailing_newline(self):
+        # 先頭の行もpostfixの行として検索し、改行で終わっていない最後の行は解析しない
+        lines = sample_lines(2)
+        self._write("\n".join(lines))
+        mm, mp = self._parse(True)
+        self.assertEqual([(r[1], len(r[2])) for r in mm], [("A00000", 5), ("A00001", 4)])
+        self.assertEqual(mp.end_offset, len("\n".join(lines[:-1]).encode()) + 1)
+
+    def test_empty_file(self):
+        self._write("")
+        mm, mp = self._parse(True)
+        self.assertEqual(mm, [])
+        self.assertEqual(mp.end_offset, 0)
+
+    def test_compressed_ignores_mmap(self):
+        fn = os.path.join(self.tmpdir, "maillog.gz")
+        self._write("\n".join(sample_lines(3)) + "\n", fn)
+        mm, _ = self._parse(True, compressed=True, fn=fn)
+        self.assertEqual([r[1] for r in mm], ["A00000", "A00001", "A00002"])
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# MaillogParserが返したメールログの扱いを確認します。
+#  python -m unittest discover tests
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser
+
+
+class MaillogParserTest(unittest.TestCase):
+
+    def test_returned_maillog_is_not_updated(self):
+        # pop_parsed_line=Falseで同じキューIDが再利用されても、返したメールログは変わらない
+        lines = sample_lines(3) + sample_lines(3, start_second=60)
+        mp = MaillogParser(None, 2017)
+        mp.collect_recipients = True
+        returned = []
+        snapshots = []
+        for m in mp.parse_lines(lines):
+            returned.append(m)
+            snapshots.append(copy.deepcopy(m))
+        self.assertEqual(returned, snapshots)
+        self.assertEqual(len(returned), 6)
+        # 再利用された後のメールログは、以前の行も含めて続けて解析される
+        self.assertEqual(returned[3]["proc"], ["smtpd", "cleanup", "qmgr", "smtp", "qmgr"] * 2)
+        self.assertEqual(len(returned[3]["rcpt"]), 2)
+        self.assertEqual(len(returned[0]["rcpt"]), 1)
+
+    def test_custom_handler(self):
+        # 登録したハンドラがTrueを返したメールログは完了として数えられ、解析途中として再度返されない
+        def handler(ml, store):
+            if store.startswith("result="):
+                ml["smtp_message"].append(store[7:])
+                return True
+            return False
+
+        lines = [
+            "Mar  1 00:00:00 mx1 postfix/smtpd[100]: A00000: client=ext.example.com[198.51.100.7]",
+            "Mar  1 00:00:01 mx1 postfix/custom[104]: A00000: result=done",
+            "Mar  1 00:00:02 mx1 postfix/smtpd[100]: A00001: client=ext.example.com[198.51.100.7]",
+        ]
+        mp = MaillogParser(None, 2017)
+        mp.register_handler("custom", handler)
+        parsed = list(mp.parse_lines(lines))
+        self.assertEqual([m["queue_id"] for m in parsed], ["A00000"])
+        self.assertTrue(parsed[0]["parse_end"])
+        self.assertEqual(parsed[0]["smtp_message"], ["done"])
+        self.assertEqual(mp.parsed_count, 1)
+        self.assertEqual([m["queue_id"] for m in mp.get_noncomplete_maillog()], ["A00001"])
+
+        # 同じキューIDの続きの行は、返したメールログを複製して解析する
+        list(mp.parse_lines(["Mar  1 00:00:03 mx1 postfix/qmgr[102]: A00000: removed"]))
+        self.assertEqual(parsed[0]["proc"], ["smtpd", "custom"])
+        self.assertEqual(mp.parsed_count, 2)
+
+        # 登録は他のパーサーやクラスの対応表に影響しない
+        self.assertNotIn("custom", MaillogParser.service_handlers)
+        other = MaillogParser(None, 2017)
+        self.assertEqual(list(other.parse_lines(lines)), [])
+
+
+class ResumeTest(unittest.TestCase):
+    """
+    解析を終えた位置(end_offset)から続きを解析する場合(--manifest)を確認します。
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "maillog")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _parse(self, start_offset, use_mmap):
+        mp = MaillogParser(self.fn, 2017)
+        mp.pop_parsed_line = True
+        mp.use_mmap = use_mmap
+        mp.start_offset = start_offset
+        records = list(mp.parse())
+        return records, list(mp.get_noncomplete_maillog()), mp.end_offset
+
+    def _check(self, use_mmap):
+        lines = sample_lines(4)
+        head = "\n".join(lines[:12]) + "\n"
+        # 書き込み途中の行(改行がない)で終わるファイル
+        partial, rest = lines[12][:30], lines[12][30:]
+        with open(self.fn, "w") as f:
+            f.write(head + partial)
+        records, noncomplete, offset = self._parse(0, use_mmap)
+        self.assertEqual(len(records), 2)
+        self.assertEqual([m["queue_id"] for m in noncomplete], ["A00002"])
+        # 途中の行は解析せず、その行の先頭から続きを解析する
+        self.assertEqual(offset, len(head))
+
+        with open(self.fn, "a") as f:
+            f.write(rest + "\n" + "\n".join(lines[13:]) + "\n")
+        records, noncomplete, offset = self._parse(offset, use_mmap)
+        self.assertEqual([m["queue_id"] for m in records], ["A00002", "A00003"])
+        self.assertEqual(noncomplete, [])
+        # 書き込み途中だった行は、書き込まれた後に1度だけ解析される
+        self.assertEqual(records[0]["proc"], ["qmgr", "smtp", "qmgr"])
+        self.assertEqual(records[0]["envelope_from"], "a2@example.com")
+        self.assertEqual(offset, os.path.getsize(self.fn))
+
+    def test_text(self):
+        self._check(False)
+
+    def test_mmap(self):
+        self._check(True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# MaillogPartitionedWriter(--partition)が日付とホスト名ごとのファイルに振り分けて書き込むことを確認します。
+#  python -m unittest discover tests
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, MaillogPartitionedWriter
+
+
+class PartitionedWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        mp = MaillogParser(None, 2017)
+        mp.pop_parsed_line = True
+        self.records = list(mp.parse_lines(sample_lines(4, hosts=("mx1", "mx2"))))
+        # A00002以降は翌日のメールログとする
+        for m in self.records:
+            if m["queue_id"] >= "A00002":
+                m["date_start_date"] += datetime.timedelta(days=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _writer(self, max_handles):
+        w = MaillogPartitionedWriter("JSON", max_handles)
+        w.connection_string = self.tmpdir
+        w.connect()
+        return w
+
+    def _read(self, day, host):
+        with open(os.path.join(self.tmpdir, day, host + ".json")) as f:
+            return [json.loads(line)["queue_id"] for line in f]
+
+    def _check(self):
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["2017-03-01", "2017-03-02"])
+        self.assertEqual(self._read("2017-03-01", "mx1"), ["A00000", "A00001"])
+        self.assertEqual(self._read("2017-03-01", "mx2"), ["A00000", "A00001"])
+        self.assertEqual(self._read("2017-03-02", "mx1"), ["A00002", "A00003"])
+        self.assertEqual(self._read("2017-03-02", "mx2"), ["A00002", "A00003"])
+
+    def test_insert(self):
+        # 開いておけるファイルが1つでも、閉じたファイルを再び開く場合は追記する
+        w = self._writer(1)
+        for m in self.records:
+            w.insert(m)
+        w.disconnect()
+        self._check()
+
+    def test_insert_many(self):
+        w = self._writer(2)
+        w.insert_many(self.records[:3])
+        w.insert_many(self.records[3:])
+        w.disconnect()
+        self._check()
+
+    def test_unsafe_host_and_missing_date(self):
+        m = dict(self.records[0], host="a" + os.sep + "b", date_start_date=None)
+        w = self._writer(2)
+        w.insert(m)
+        w.disconnect()
+        self.assertEqual(self._read("unknown", "a_b"), ["A00000"])
+
+    def test_unsupported_type(self):
+        with self.assertRaises(ValueError):
+            MaillogPartitionedWriter("ELS")
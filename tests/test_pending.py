@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# PendingStore(--pending-store)に保存した解析途中のメールログが、続きの行と1件にまとめられることを確認します。
+#  python -m unittest discover tests
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, PendingStore
+
+# 保存先から読み込んだ際にpickleが実行されたかの記録
+_executed = []
+
+
+class _Payload:
+    def __reduce__(self):
+        return _executed.append, ("executed",)
+
+
+class PendingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "pending.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _parser(self, store):
+        mp = MaillogParser(None, 2017)
+        mp.pop_parsed_line = True
+        mp.collect_recipients = True
+        mp.pending_store = store
+        return mp
+
+    def test_resume_across_runs(self):
+        # 1回目の実行の終わりで解析途中だったメールログは、2回目の実行の続きの行と1件になる
+        lines = sample_lines(5)
+        single = list(self._parser(None).parse_lines(lines))
+
+        store = PendingStore(self.path)
+        mp = self._parser(store)
+        first = list(mp.parse_lines(lines[:12]))
+        self.assertEqual(store.finish(list(mp.get_noncomplete_maillog()), mp.last_date), [])
+        store.close()
+
+        store = PendingStore(self.path)
+        mp = self._parser(store)
+        second = list(mp.parse_lines(lines[12:]))
+        self.assertEqual(store.finish(list(mp.get_noncomplete_maillog()), mp.last_date), [])
+        store.close()
+        self.assertEqual(first + second, single)
+        # 宛先ごとの試行のdelaysはタプルに戻る
+        self.assertIsInstance(second[0]["rcpt"][0][MaillogParser._rcpt_index["delays"]], tuple)
+
+    def test_spill_least_recently_seen(self):
+        # 上限を超えた場合は、最も長く行が現れていないメールログを保存先に移す
+        lines = [
+            "Mar  1 00:00:00 mx1 postfix/smtpd[100]: A00000: client=a.example.com[192.0.2.1]",
+            "Mar  1 00:00:01 mx1 postfix/smtpd[100]: A00001: client=b.example.com[192.0.2.2]",
+            "Mar  1 00:00:02 mx1 postfix/cleanup[101]: A00000: message-id=<a@example.com>",
+            "Mar  1 00:00:03 mx1 postfix/smtpd[100]: A00002: client=c.example.com[192.0.2.3]",
+            "Mar  1 00:00:04 mx1 postfix/smtpd[100]: A00003: client=d.example.com[192.0.2.4]",
+        ]
+        store = PendingStore(self.path, max_memory=2)
+        mp = self._parser(store)
+        with mock.patch("PostfixLogParser.PENDING_SPILL_INTERVAL", 1):
+            self.assertEqual(list(mp.parse_lines(lines)), [])
+        self.assertEqual(sorted(m["queue_id"] for m in mp.get_noncomplete_maillog()), ["A00000", "A00002", "A00003"])
+        self.assertEqual(store.spilled, 1)
+        self.assertEqual(store.take("mx1/A00001")["client_host"], "b.example.com")
+        store.close()
+
+    def test_pickle_is_not_loaded(self):
+        # 保存先にpickleが書き込まれていても実行しない
+        store = PendingStore(self.path)
+        store.close()
+        db = sqlite3.connect(self.path)
+        db.execute("INSERT INTO pending (skey, last_seen, data) VALUES (?, ?, ?)",
+                   ("mx1/A00000", 0.0, pickle.dumps(_Payload())))
+        db.commit()
+        db.close()
+
+        store = PendingStore(self.path)
+        with self.assertRaises(ValueError):
+            store.take("mx1/A00000")
+        store.close()
+        self.assertEqual(_executed, [])
+
+    def test_old_format(self):
+        # 形式を記録していない(pickleで保存した)保存先は読み込まない
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE pending (skey TEXT PRIMARY KEY, last_seen REAL, data BLOB)")
+        db.execute("INSERT INTO pending (skey, last_seen, data) VALUES (?, ?, ?)",
+                   ("mx1/A00000", 0.0, pickle.dumps({})))
+        db.commit()
+        db.close()
+        with self.assertRaises(ValueError):
+            PendingStore(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# MaillogPipeline(--workers)の結果が1プロセスで解析した結果と一致することを確認します。
+#  python -m unittest discover tests
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, MaillogPipeline, MaillogTSVWriter, PIPELINE_BLOCK_SIZE
+
+
+def _key(m):
+    return m["host"], m["queue_id"], m["date_start_date"]
+
+
+# ワーカーで呼び出されるハンドラ(spawnでもpickleできるようモジュールの関数にする)
+def _raise_handler(ml, store):
+    raise RuntimeError("handler failed: " + store)
+
+
+def _exit_handler(ml, store):
+    os._exit(3)
+
+
+class MaillogPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, lines):
+        fn = os.path.join(self.tmpdir, "maillog")
+        with open(fn, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return fn
+
+    def _parse(self, fn, workers, profile="default", collect_recipients=False, **kwargs):
+        """
+        :return: (解析が完了したメールログ, 解析が終わっていないメールログ, 件数)
+        """
+        mp = MaillogParser(fn, 2017)
+        # ワーカーと同様に、解析が完了したメールログは破棄する(再利用されたキューIDを別のメールとして扱う)
+        mp.pop_parsed_line = True
+        mp.line_profile = profile
+        mp.collect_recipients = collect_recipients
+        source = mp if workers is None else MaillogPipeline(mp, workers, **kwargs)
+        records = list(source.parse())
+        noncomplete = list(source.get_noncomplete_maillog())
+        return sorted(records, key=_key), sorted(noncomplete, key=_key), source.parsed_count
+
+    def _assert_same(self, fn, block_size=4096, **kwargs):
+        single = self._parse(fn, None, **kwargs)
+        piped = self._parse(fn, 3, block_size=block_size, **kwargs)
+        self.assertEqual(piped[0], single[0])
+        self.assertEqual(piped[1], single[1])
+        self.assertEqual(piped[2], single[2])
+        return single, piped
+
+    def test_hosts_and_reused_queue_ids(self):
+        # 2台のホストが同じキューIDを使い、さらに後の時刻で同じキューIDを再利用する
+        lines = sample_lines(500, hosts=("mx1", "mx2")) + sample_lines(500, hosts=("mx1", "mx2"), start_second=3600)
+        # キューIDを持たない行と、解析が終わらないメールログ
+        lines[10:10] = [
+            "Mar  1 00:00:02 mx1 postfix/smtpd[100]: connect from ext.example.com[198.51.100.7]",
+            "Mar  1 00:00:02 mx1 postfix/smtpd[100]: NOQUEUE: reject: RCPT from ext.example.com[198.51.100.7]: "
+            "554 5.7.1 <x@example.org>: Relay access denied; from=<a@example.com> to=<x@example.org> proto=ESMTP",
+        ]
+        lines.append("Mar  1 02:00:00 mx2 postfix/smtpd[100]: B00000: client=ext.example.com[198.51.100.7]")
+        single, piped = self._assert_same(self._write(lines), collect_recipients=True)
+        self.assertEqual(len(single[0]), 2000)
+        self.assertEqual(len(single[1]), 1)
+        # ワーカーから受け取った値も、読み取りプロセスで同じ文字列オブジェクトを共有する
+        self.assertTrue(all(m["host"] is piped[0][0]["host"] for m in piped[0] if m["host"] == "mx1"))
+        self.assertTrue(all(m["status"][0] is piped[0][0]["status"][0] for m in piped[0]))
+
+    def test_long_queue_ids(self):
+        lines = sample_lines(300, hosts=("mx1", "mx2"), long_queue_id=True)
+        single, _ = self._assert_same(self._write(lines), profile="long_queue_id")
+        self.assertEqual(len(single[0]), 600)
+        self.assertTrue(all(m["parse_end"] for m in single[0]))
+
+    def test_large_input(self):
+        # 結果のキューに上限があっても、ワーカーと読み取りが互いに待ち続けないこと
+        # 処理時間の比較は benchmarks/bench_pipeline.py で行う
+        lines = sample_lines(20000, hosts=("mx1", "mx2"))
+        self._assert_same(self._write(lines), block_size=PIPELINE_BLOCK_SIZE)
+
+    def test_formatter(self):
+        # ワーカーで変換した文字列は、1プロセスで解析したメールログを書き込む文字列と同じ行になる
+        lines = sample_lines(300, hosts=("mx1", "mx2"))
+        # CRLFの行と、解析が終わらないメールログ
+        lines[-1] += "\r"
+        lines.append("Mar  1 01:00:00 mx1 postfix/smtpd[100]: B00000: client=ext.example.com[198.51.100.7]")
+        fn = self._write(lines)
+        single = self._parse(fn, None)
+        mp = MaillogParser(fn, 2017)
+        source = MaillogPipeline(mp, 3, block_size=4096, formatter=MaillogTSVWriter)
+        text = "".join(source.parse())
+        expected = MaillogTSVWriter().format_many(single[0])
+        self.assertEqual(sorted(text.splitlines()), sorted(expected.splitlines()))
+        self.assertEqual(sorted(source.get_noncomplete_maillog(), key=_key), single[1])
+        self.assertEqual(len(single[1]), 1)
+        self.assertEqual(source.parsed_count, 600)
+
+    def test_partial_last_line(self):
+        # 改行で終わらない最後の行は解析せず、解析を終えた位置はその行の先頭になる
+        lines = sample_lines(100, hosts=("mx1", "mx2"))
+        fn = self._write(lines)
+        size = os.path.getsize(fn)
+        with open(fn, "a") as f:
+            f.write("Mar  1 01:00:00 mx1 postfix/smtpd[100]: B00000: client=ext.exa")
+        mp = MaillogParser(fn, 2017)
+        source = MaillogPipeline(mp, 2, block_size=1024)
+        self.assertEqual(len(list(source.parse())), 200)
+        self.assertEqual(list(source.get_noncomplete_maillog()), [])
+        self.assertEqual(source.end_offset, size)
+
+    def test_worker_exception(self):
+        # ワーカーのハンドラで発生した例外は、読み取りプロセスで同じ種類の例外になる(待ち続けない)
+        mp = MaillogParser(self._write(sample_lines(50)), 2017)
+        mp.register_handler("cleanup", _raise_handler)
+        with self.assertLogs(level="ERROR") as logs:
+            with self.assertRaisesRegex(RuntimeError, "handler failed: message-id"):
+                list(MaillogPipeline(mp, 2, block_size=1024).parse())
+        self.assertIn("_raise_handler", logs.output[0])
+
+    def test_worker_crash(self):
+        # 結果を返さずに終了したワーカーがある場合は、RuntimeErrorになる(待ち続けない)
+        mp = MaillogParser(self._write(sample_lines(50)), 2017)
+        mp.register_handler("cleanup", _exit_handler)
+        with self.assertRaisesRegex(RuntimeError, "終了コード: 3"):
+            list(MaillogPipeline(mp, 2, block_size=1024).parse())
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# ParseProfiler(--profile)の工程別の時間の計測を確認します。
+#  python -m unittest discover tests
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser, ParseProfiler
+
+
+class ParseProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lines = sample_lines(300)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _parse(self, data, compressed=False, use_mmap=False):
+        fn = os.path.join(self.tmpdir, "maillog.gz" if compressed else "maillog")
+        with (gzip.open if compressed else open)(fn, "wt") as fo:
+            fo.write(data)
+        profiler = ParseProfiler(os.path.join(self.tmpdir, "plp"))
+        mp = MaillogParser(fn, 2017)
+        mp.compressed = compressed
+        mp.use_mmap = use_mmap
+        mp.pop_parsed_line = True
+        profiler.attach(mp)
+        records = list(mp.parse())
+        return mp, profiler.report(), records
+
+    def _check(self, report, read_stage):
+        self.assertEqual(report["input_lines"], 1500)
+        self.assertEqual(report["records"], 300)
+        for stage in ("match", "date", "parse"):
+            self.assertGreater(report["stages"][stage]["wall"], 0, stage)
+        if read_stage:
+            self.assertGreater(report["stages"][read_stage]["wall"], 0)
+
+    def test_text(self):
+        mp, report, records = self._parse("\n".join(self.lines) + "\n")
+        self._check(report, "read")
+        self.assertEqual(report["stages"]["decompress"]["wall"], 0)
+        # パーサーのメソッドは置き換えない
+        self.assertFalse({"_open_text", "_search_rows", "_dateparse", "_parse_matches"} & set(vars(mp)))
+
+    def test_compressed(self):
+        _, report, _ = self._parse("\n".join(self.lines) + "\n", compressed=True)
+        self._check(report, "decompress")
+        self.assertEqual(report["stages"]["read"]["wall"], 0)
+
+    def test_mmap(self):
+        _, report, _ = self._parse("\n".join(self.lines) + "\n", use_mmap=True)
+        self._check(report, None)
+
+    def test_partial_last_line(self):
+        # 改行で終わっていない最後の行は解析せず、その行の先頭で終える
+        data = "\n".join(self.lines) + "\n"
+        mp, report, _ = self._parse(data + self.lines[0][:20])
+        self.assertEqual(report["input_lines"], 1500)
+        self.assertEqual(mp.end_offset, len(data.encode()))
+
+    def test_sampling_unavailable(self):
+        with mock.patch.object(ParseProfiler, "sampling_available", return_value=False):
+            with self.assertRaises(ValueError):
+                ParseProfiler(os.path.join(self.tmpdir, "plp"), "sample")
+            ParseProfiler(os.path.join(self.tmpdir, "plp"), "cprofile")
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# 宛先ごとの配送の試行(rcpt)の記録と、RecipientRow、MaillogRcptWriter(--export-type RCPT)の出力を確認します。
+#  python -m unittest discover tests
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import support  # noqa: F401
+from PostfixLogParser import MaillogParser, MaillogRcptWriter, stream_records
+
+# 2件の宛先のうち1件は再送後に配送され、1件はaliasで転送される
+LINES = [
+    "Mar  1 00:00:00 mx1 postfix/smtpd[100]: B00000: client=ext.example.com[198.51.100.7]",
+    "Mar  1 00:00:00 mx1 postfix/cleanup[101]: B00000: message-id=<multi@example.com>",
+    "Mar  1 00:00:00 mx1 postfix/qmgr[102]: B00000: from=<a@example.com>, size=300, nrcpt=2 (queue active)",
+    "Mar  1 00:00:01 mx1 postfix/smtp[103]: B00000: to=<b@example.org>, relay=none, delay=1, "
+    "delays=0/0/1/0, dsn=4.4.1, status=deferred (connect to example.org[192.0.2.9]:25: Connection refused)",
+    "Mar  1 00:00:01 mx1 postfix/local[104]: B00000: to=<c@mx1.example.com>, orig_to=<info@example.com>, "
+    "relay=local, delay=1, delays=0/0/0/1, dsn=2.0.0, status=sent (delivered to mailbox)",
+    "Mar  1 00:10:00 mx1 postfix/qmgr[102]: B00000: from=<a@example.com>, size=300, nrcpt=1 (queue active)",
+    "Mar  1 00:10:01 mx1 postfix/smtp[103]: B00000: to=<b@example.org>, relay=mx.example.org[192.0.2.9]:25, "
+    "delay=601, delays=600/0/0.5/0.5, dsn=2.0.0, status=sent (250 2.0.0 Ok)",
+    "Mar  1 00:10:01 mx1 postfix/qmgr[102]: B00000: removed",
+    # 配送の行がないメールログ
+    "Mar  1 00:20:00 mx1 postfix/qmgr[102]: B00001: from=<>, size=10, nrcpt=1 (queue active)",
+    "Mar  1 00:20:00 mx1 postfix/qmgr[102]: B00001: removed",
+]
+
+
+class RecipientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "maillog")
+        with open(self.fn, "w") as fo:
+            fo.write("\n".join(LINES) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_recipient_rows(self):
+        views = list(stream_records(self.fn, 2017, recipients=True))
+        rows = views[0].recipients
+        self.assertEqual([(r.to, r.orig_to, r.relay_host, r.status, r.dsn) for r in rows], [
+            ("b@example.org", "", "none", "deferred", "4.4.1"),
+            ("c@mx1.example.com", "info@example.com", "local", "sent", "2.0.0"),
+            ("b@example.org", "", "mx.example.org", "sent", "2.0.0"),
+        ])
+        r = rows[2]
+        self.assertEqual((r.relay_ip, r.relay_port, r.delay, r.delays),
+                         ("192.0.2.9", "25", 601.0, (600.0, 0.0, 0.5, 0.5)))
+        self.assertEqual(r.date, datetime.datetime(2017, 3, 1, 0, 10, 1))
+        # メッセージ単位の値は親のRecordViewを参照する
+        self.assertIs(r.parent, views[0])
+        self.assertEqual((r.host, r.queue_id, r.message_id, r.envelope_from),
+                         ("mx1", "B00000", "multi@example.com", "a@example.com"))
+        with self.assertRaises(AttributeError):
+            r.status = "bounced"
+        self.assertEqual(views[1].recipients, ())
+        with self.assertRaises(ValueError):
+            next(iter(stream_records(self.fn, 2017))).recipients
+
+    def test_rcpt_writer(self):
+        mp = MaillogParser(self.fn, 2017)
+        mp.collect_recipients = True
+        mp.pop_parsed_line = True
+        path = os.path.join(self.tmpdir, "out.tsv")
+        w = MaillogRcptWriter()
+        w.connection_string = path
+        w.connect()
+        w.insert_many(list(mp.parse()))
+        w.disconnect()
+        with open(path) as f:
+            rows = [line.rstrip("\n").split("\t") for line in f]
+        header = rows[0]
+        self.assertEqual(len(header), len(MaillogRcptWriter._parent_cols) + len(MaillogRcptWriter._rcpt_cols))
+        self.assertEqual({len(r) for r in rows}, {len(header)})
+        data = [dict(zip(header, r)) for r in rows[1:]]
+        self.assertEqual([(d["qid"], d["to"], d["org_to"], d["status"]) for d in data], [
+            ("B00000", "b@example.org", "", "deferred"),
+            ("B00000", "c@mx1.example.com", "info@example.com", "sent"),
+            ("B00000", "b@example.org", "", "sent"),
+            ("B00001", "", "", ""),
+        ])
+        self.assertEqual({d["msg_id"] for d in data[:3]}, {"multi@example.com"})
+        self.assertEqual((data[2]["delay_before"], data[2]["delay_trans"]), ("600.0", "0.5"))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# stream_recordsで返すRecordView、RecordStreamの処理とWriterへの書き込みを確認します。
+#  python -m unittest discover tests
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines, ListWriter
+from PostfixLogParser import RecordView, stream_records
+
+
+class RecordStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "maillog")
+        lines = sample_lines(5)
+        with open(self.fn, "w") as fo:
+            # 最後のメッセージはremovedの行がなく、解析が終わっていない
+            fo.write("\n".join(lines[:-1]) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_views(self):
+        views = list(stream_records(self.fn, 2017, recipients=True))
+        self.assertEqual([(v.queue_id, v.complete) for v in views],
+                         [("A00000", True), ("A00001", True), ("A00002", True), ("A00003", True), ("A00004", False)])
+        v = views[1]
+        self.assertEqual(v.envelope_to, ("b1@example.org",))
+        self.assertEqual(v.recipients[0].status, "sent")
+        with self.assertRaises(AttributeError):
+            v.host = "mx2"
+        # to_dictはコピーを返すため、変更してもRecordViewには影響しない
+        d = v.to_dict()
+        d["envelope_to"].append("c@example.org")
+        self.assertEqual(v.envelope_to, ("b1@example.org",))
+
+    def test_filter_and_batch(self):
+        batches = list(stream_records(self.fn, 2017, include_incomplete=False)
+                       .filter(lambda v: v.queue_id != "A00001").batch(2))
+        self.assertEqual([[v.queue_id for v in b] for b in batches], [["A00000", "A00002"], ["A00003"]])
+        with self.assertRaises(ValueError):
+            stream_records(self.fn, 2017).batch(0)
+
+    def test_write_views(self):
+        writer = ListWriter()
+        cnt = stream_records(self.fn, 2017).write_to(writer, batch_size=2)
+        self.assertEqual(cnt, 5)
+        self.assertEqual([m["queue_id"] for m in writer.records], ["A00000", "A00001", "A00002", "A00003", "A00004"])
+
+    def test_write_mapped_dicts(self):
+        def anonymize(v):
+            d = v.to_dict()
+            d["client_ip"] = None
+            return d
+
+        writer = ListWriter()
+        cnt = stream_records(self.fn, 2017).map(anonymize).write_to(writer)
+        self.assertEqual(cnt, 5)
+        self.assertEqual({m["client_ip"] for m in writer.records}, {None})
+
+    def test_write_unsupported(self):
+        with self.assertRaises(TypeError):
+            stream_records(self.fn, 2017).map(lambda v: v.queue_id).write_to(ListWriter())
+
+    def test_record(self):
+        v = next(iter(stream_records(self.fn, 2017)))
+        self.assertIsInstance(v, RecordView)
+        self.assertEqual(v.record["queue_id"], v.queue_id)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# scan_summary(--stats-only)の集計が、メールログを組み立てた場合の件数と一致することを確認します。
+#  python -m unittest discover tests
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import MaillogParser
+
+# 再送されたメッセージ(qmgrのfrom=の行が2回出力される)と、宛先が2件のメッセージ
+RETRY_LINES = [
+    "Mar  1 01:00:00 mx1 postfix/smtpd[100]: B00000: client=ext.example.com[198.51.100.7]",
+    "Mar  1 01:00:00 mx1 postfix/cleanup[101]: B00000: message-id=<retry@example.com>",
+    "Mar  1 01:00:00 mx1 postfix/qmgr[102]: B00000: from=<a@example.com>, size=100, nrcpt=1 (queue active)",
+    "Mar  1 01:00:01 mx1 postfix/smtp[103]: B00000: to=<b@example.org>, relay=none, delay=1, "
+    "delays=0/0/1/0, dsn=4.4.1, status=deferred (connect to example.org[192.0.2.9]:25: Connection refused)",
+    "Mar  1 01:10:00 mx1 postfix/qmgr[102]: B00000: from=<a@example.com>, size=100, nrcpt=1 (queue active)",
+    "Mar  1 01:10:01 mx1 postfix/smtp[103]: B00000: to=<b@example.org>, relay=relay.example.net[203.0.113.5]:25, "
+    "delay=601, delays=600/0/1/0, dsn=2.0.0, status=sent (250 2.0.0 Ok)",
+    "Mar  1 01:10:01 mx1 postfix/qmgr[102]: B00000: removed",
+    "Mar  1 01:20:00 mx1 postfix/qmgr[102]: B00001: from=<a@example.com>, size=200, nrcpt=2 (queue active)",
+    "Mar  1 01:20:01 mx1 postfix/local[104]: B00001: to=<c@example.com>, relay=local, delay=1, "
+    "delays=0/0/0/1, dsn=2.0.0, status=sent (delivered to mailbox)",
+    "Mar  1 01:20:01 mx1 postfix/smtp[103]: B00001: to=<d@example.org>, relay=none, delay=1, "
+    "delays=0/0/1/0, dsn=5.1.1, status=bounced (user unknown)",
+    "Mar  1 01:20:01 mx1 sshd[200]: Accepted publickey for admin from 192.0.2.10 port 50022 ssh2",
+    "Mar  1 01:20:02 mx1 postfix/qmgr[102]: B00001: removed",
+]
+
+
+class ScanSummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "maillog")
+        with open(self.fn, "w") as fo:
+            fo.write("\n".join(sample_lines(3, hosts=("mx1", "mx2")) + RETRY_LINES) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _summary(self, use_mmap):
+        mp = MaillogParser(self.fn, 2017)
+        mp.use_mmap = use_mmap
+        return mp.scan_summary()
+
+    def test_summary(self):
+        expected = {"messages": 8, "recipients": 9, "bytes": 0 + 1 + 2 + 0 + 1 + 2 + 100 + 200, "removed": 8,
+                    "sent": 8, "deferred": 1, "bounced": 1}
+        self.assertEqual(self._summary(False), expected)
+        self.assertEqual(self._summary(True), expected)
+
+    def test_matches_parsed_records(self):
+        mp = MaillogParser(self.fn, 2017)
+        mp.pop_parsed_line = True
+        records = list(mp.parse())
+        summary = self._summary(False)
+        self.assertEqual(summary["messages"], len(records))
+        for k in ("sent", "deferred", "bounced"):
+            self.assertEqual(summary[k], sum(m["status"].count(k) for m in records), k)
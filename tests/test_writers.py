@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# テキストを書き込むWriterで、まとめて書き込んだ場合(insert_many)と1件ずつ書き込んだ場合(insert)の出力が
+# 一致することを確認します。まとめて書き込む場合は派生列(遅延時間、所要時間)をバッチごとに計算します。
+#  python -m unittest discover tests
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import sample_lines
+from PostfixLogParser import (MaillogParser, MaillogWriter, MaillogTSVWriter, MaillogJSONWriter, MaillogOrgWriter,
+                              MaillogRcptWriter)
+
+
+class TextWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        mp = MaillogParser(None, 2017)
+        mp.pop_parsed_line = True
+        mp.collect_recipients = True
+        # 遅延時間と所要時間が同じメールログが繰り返し現れる
+        self.records = list(mp.parse_lines(sample_lines(25, hosts=("mx1", "mx2"))))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, cls, name, batch):
+        path = os.path.join(self.tmpdir, name)
+        w = cls()
+        w.connection_string = path
+        w.connect()
+        if batch:
+            for i in range(0, len(self.records), batch):
+                w.insert_many(self.records[i:i + batch])
+        else:
+            for m in self.records:
+                w.insert(m)
+        w.disconnect()
+        with open(path) as f:
+            return f.read()
+
+    def test_insert_many_matches_insert(self):
+        for cls in (MaillogTSVWriter, MaillogJSONWriter, MaillogOrgWriter, MaillogRcptWriter):
+            with self.subTest(writer=cls.__name__):
+                single = self._write(cls, cls.__name__ + ".1", None)
+                self.assertEqual(self._write(cls, cls.__name__ + ".7", 7), single)
+                # ワーカーで変換する場合(MaillogPipeline)と同じ文字列(TSV, RCPTは見出しの行を除く)
+                text = cls().format_many(self.records)
+                self.assertEqual(text.count("\n"), 50)
+                self.assertTrue(single.endswith(text))
+
+    def test_derived_many(self):
+        self.assertEqual(MaillogWriter._derived_many(self.records),
+                         [MaillogWriter._derived(m) for m in self.records])
+        # 値ごとに1度だけ文字列に変換し、同じ値の列は同じ文字列オブジェクトを共有する
+        derived = MaillogWriter._derived_many(self.records)
+        same = [d for m, d in zip(self.records, derived) if m["delay"] == self.records[0]["delay"]]
+        self.assertGreater(len(same), 1)
+        self.assertTrue(all(d[0] is same[0][0] for d in same))